@@ -0,0 +1,538 @@
+"""Benchmark recording test results and writing the reports.
+
+Drives ``CoreJetOutputFormattingWrapper`` with synthetic tests of every kind
+the formatter knows about (unittest, doctest, ``DocFileCase``, manuel and
+CoreJet stories), with a share of failures and errors with deep tracebacks,
+and measures:
+
+- the time taken to record each result (``_record``),
+- the time taken by ``writeXMLReports()``, and the size of the reports,
+- the time taken to match the results against a CoreJet catalogue, and by
+  ``writeCoreJetReports()`` as a whole,
+- the peak resident set size after each of these.
+
+Each number of tests is run in a fresh interpreter, so that memory use is
+not affected by earlier runs. The results are printed, and with ``--output``
+also saved as JSON, together with the current git revision. Pass the JSON
+file of an earlier run as ``--compare`` to see what has changed::
+
+    $ python benchmarks/formatter.py --output=before.json
+    $ git checkout my-branch
+    $ python benchmarks/formatter.py --output=after.json --compare=before.json
+"""
+
+from __future__ import with_statement
+
+import datetime
+import doctest
+import json
+import optparse
+import os
+import os.path
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+DEFAULT_TESTS = '1000,10000,100000'
+
+# Share of each kind of test
+MIX = (
+    ('unittest', 0.70,),
+    ('doctest', 0.14,),
+    ('docfile', 0.02,),
+    ('manuel', 0.02,),
+    ('corejet', 0.12,),
+)
+
+TESTS_PER_CLASS = 20
+DOCTESTS_PER_MODULE = 10
+SCENARIOS_PER_STORY = 10
+
+# Every so many stories is not in the catalogue, and every so many scenarios
+# has steps which differ from the catalogue
+SUPERFLUOUS_STORY = 20
+MISMATCHED_SCENARIO = 7
+
+# ru_maxrss is in bytes on Mac OS X, and in kilobytes elsewhere
+MAX_RSS_SCALE = sys.platform == 'darwin' and 1024 or 1
+
+
+class NullFormatter(object):
+    """Stands in for zope.testrunner's output formatter.
+    """
+
+    def start_test(self, test, tests_run, total_tests):
+        pass
+
+    def stop_test(self, test):
+        pass
+
+    def test_success(self, test, seconds):
+        pass
+
+    def test_failure(self, test, seconds, exc_info):
+        pass
+
+    def test_error(self, test, seconds, exc_info):
+        pass
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // MAX_RSS_SCALE
+
+
+def nested_call(depth, exception):
+    if depth:
+        return nested_call(depth - 1, exception)
+    raise exception
+
+
+def make_exc_info(depth, exception):
+    """Return the ``exc_info`` of ``exception``, raised ``depth`` calls
+    deep.
+    """
+
+    try:
+        nested_call(depth, exception)
+    except Exception:
+        return sys.exc_info()
+
+
+def make_unittests(count):
+    tests = []
+    for first in range(0, count, TESTS_PER_CLASS):
+        names = ['test_%d' % index for index in
+                 range(first, min(first + TESTS_PER_CLASS, count))]
+        namespace = dict([(name, lambda self: None) for name in names])
+        namespace['__module__'] = 'benchmark.tests.test_module%d' % (
+            first // (TESTS_PER_CLASS * 10),)
+        testClass = type('TestCase%d' % first, (unittest.TestCase,),
+                         namespace)
+        tests.extend([testClass(name) for name in names])
+    return tests
+
+
+def make_doctests(count, directory):
+    tests = []
+    for index in range(count):
+        module = 'benchmark.module%d' % (index // DOCTESTS_PER_MODULE)
+        test = doctest.DocTest(
+            [], {}, '%s.function%d' % (module, index,),
+            os.path.join(directory, module.replace('.', os.path.sep) + '.py'),
+            index, "")
+        tests.append(doctest.DocTestCase(test))
+    return tests
+
+
+def make_doc_file_cases(count, directory):
+    tests = []
+    for index in range(count):
+        filename = os.path.join(directory, 'benchmark', 'docs',
+                                'document%d.txt' % index)
+        test = doctest.DocTest([], {}, os.path.basename(filename), filename,
+                               0, "")
+        tests.append(doctest.DocFileCase(test))
+    return tests
+
+
+def make_manuel_tests(count, directory):
+    import manuel
+    import manuel.testing
+
+    tests = []
+    for index in range(count):
+        document = manuel.Document('', location=os.path.join(
+            directory, 'benchmark', 'manuel', 'document%d.txt' % index))
+        tests.append(manuel.testing.TestCase(manuel.Manuel(), document, {}))
+    return tests
+
+
+def make_scenario_class(index):
+    from corejet.core import given
+    from corejet.core import scenario
+    from corejet.core import then
+    from corejet.core import when
+
+    @scenario("Scenario %d" % index)
+    class Scenario(object):
+
+        @given("Given %d" % index)
+        def given_step(self):
+            pass
+
+        @when("When %d" % index)
+        def when_step(self):
+            pass
+
+        @then("Then %d" % index)
+        def then_step(self):
+            pass
+
+        @then("And then %d" % index)
+        def and_then_step(self):
+            pass
+
+    return Scenario
+
+
+def make_stories(count):
+    """Return the tests for ``count`` scenarios, and the catalogue they are
+    matched against.
+    """
+
+    from corejet.core import story
+    from corejet.core.model import Epic
+    from corejet.core.model import RequirementsCatalogue
+    from corejet.core.model import Scenario
+    from corejet.core.model import Step
+    from corejet.core.model import Story
+
+    catalogue = RequirementsCatalogue(project="Benchmark")
+    epic = Epic("E1", "Benchmark epic")
+    catalogue.epics.append(epic)
+
+    tests = []
+    for first in range(0, count, SCENARIOS_PER_STORY):
+        indexes = range(first, min(first + SCENARIOS_PER_STORY, count))
+        storyId = "S%d" % first
+
+        namespace = dict([('scenario%d' % index, make_scenario_class(index),)
+                          for index in indexes])
+        namespace['__module__'] = 'benchmark.stories'
+        storyClass = story(storyId, "Story %d" % first)(
+            type('Story', (unittest.TestCase,), namespace))
+        tests.extend([storyClass(name) for name in sorted(dir(storyClass))
+                      if name.startswith('test_')])
+
+        if (first // SCENARIOS_PER_STORY) % SUPERFLUOUS_STORY == 1:
+            continue
+
+        catalogueStory = Story(storyId, "Story %d" % first, epic=epic)
+        epic.stories.append(catalogueStory)
+        for index in indexes:
+            thens = [Step("Then %d" % index, 'then')]
+            if index % MISMATCHED_SCENARIO:
+                thens.append(Step("And then %d" % index, 'then'))
+            catalogueStory.scenarios.append(Scenario(
+                "Scenario %d" % index, story=catalogueStory,
+                givens=[Step("Given %d" % index, 'given')],
+                whens=[Step("When %d" % index, 'when')],
+                thens=thens))
+
+    return tests, catalogue
+
+
+def make_tests(count, directory):
+    """Return ``count`` tests, in the proportions given by ``MIX``, and the
+    CoreJet catalogue for the stories among them.
+    """
+
+    counts = dict([(kind, int(count * share),) for kind, share in MIX])
+    counts['unittest'] += count - sum(counts.values())
+
+    storyTests, catalogue = make_stories(counts['corejet'])
+    tests = (make_unittests(counts['unittest']) +
+             make_doctests(counts['doctest'], directory) +
+             make_doc_file_cases(counts['docfile'], directory) +
+             make_manuel_tests(counts['manuel'], directory) +
+             storyTests)
+    return tests, catalogue, counts
+
+
+def record(formatter, tests, failures, errors, depth):
+    """Feed the results of ``tests`` to ``formatter``, with the given
+    percentages of failures and errors. Returns the number of each.
+    """
+
+    failure = make_exc_info(depth, AssertionError(
+        "Expected 42\nbut got 41, with a long explanation of why"))
+    error = make_exc_info(depth, KeyError('missing'))
+    counts = {'failures': 0, 'errors': 0}
+
+    total = len(tests)
+    for index, test in enumerate(tests):
+        formatter.start_test(test, index, total)
+        outcome = (index * 37) % 100
+        if outcome < failures:
+            formatter.test_failure(test, 0.001, failure)
+            counts['failures'] += 1
+        elif outcome < failures + errors:
+            formatter.test_error(test, 0.001, error)
+            counts['errors'] += 1
+        else:
+            formatter.test_success(test, 0.001)
+        formatter.stop_test(test)
+
+    return counts
+
+
+def directory_size(directory):
+    files = size = 0
+    for path, directories, filenames in os.walk(directory):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(path, filename))
+    return files, size
+
+
+def child(options, count, output):
+    """Run the benchmark for ``count`` tests, and save the results as JSON to
+    ``output``.
+    """
+
+    from corejet.testrunner.formatter import CoreJetOutputFormattingWrapper
+    from corejet.testrunner.matching import add_superfluous_scenarios
+    from corejet.testrunner.matching import match_catalogue
+
+    workingDir = tempfile.mkdtemp(prefix='corejet-benchmark-')
+    try:
+        os.chdir(workingDir)
+        tests, catalogue, kinds = make_tests(count, workingDir)
+
+        result = {'tests': len(tests), 'kinds': kinds}
+        memory = result['memory'] = {'baseline_rss_kb': peak_rss()}
+
+        formatter = CoreJetOutputFormattingWrapper(
+            NullFormatter(), workingDir, xmlStream=options.stream,
+            tracebackLimit=options.tracebackLimit,
+            xmlWorkers=options.xmlWorkers,
+            xmlFile=options.xmlFile and os.path.join(
+                workingDir, 'testreports', options.xmlFile))
+
+        start = time.time()
+        result.update(record(formatter, tests, options.failures,
+                             options.errors, options.depth))
+        elapsed = time.time() - start
+        result['record'] = {
+            'seconds': elapsed,
+            'us_per_test': elapsed / len(tests) * 1e6,
+        }
+        memory['record_rss_kb'] = peak_rss()
+
+        start = time.time()
+        formatter.writeXMLReports()
+        elapsed = time.time() - start
+        files, size = directory_size(os.path.join(workingDir, 'testreports'))
+        result['xml'] = {'seconds': elapsed, 'files': files, 'bytes': size}
+        memory['xml_rss_kb'] = peak_rss()
+
+        start = time.time()
+        superfluous = match_catalogue(catalogue, (
+            testCase for suiteName, testCase in formatter.iterTestCases()))
+        added = add_superfluous_scenarios(catalogue, superfluous)
+        result['corejet_match'] = {
+            'seconds': time.time() - start,
+            'superfluous': added,
+        }
+
+        if options.corejetReport:
+            ignored, catalogue = make_stories(kinds['corejet'])
+
+            # writeCoreJetReports() prints a summary
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                start = time.time()
+                formatter.writeCoreJetReports(None, catalogue=catalogue)
+                elapsed = time.time() - start
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+            files, size = directory_size(os.path.join(workingDir, 'corejet'))
+            result['corejet_report'] = {'seconds': elapsed, 'files': files,
+                                        'bytes': size}
+        memory['peak_rss_kb'] = peak_rss()
+    finally:
+        os.chdir(os.path.dirname(workingDir))
+        shutil.rmtree(workingDir)
+
+    with open(output, 'w') as stream:
+        json.dump(result, stream)
+
+
+def run_child(options, count):
+    """Run the benchmark for ``count`` tests ``options.repeat`` times, in
+    fresh interpreters. Times are the best of all runs, everything else
+    comes from the last one.
+    """
+
+    handle, output = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+
+    arguments = [sys.executable, os.path.abspath(__file__),
+                 '--child=%d' % count, '--child-output=%s' % output,
+                 '--failures=%d' % options.failures,
+                 '--errors=%d' % options.errors,
+                 '--depth=%d' % options.depth,
+                 '--xml-workers=%d' % options.xmlWorkers]
+    if options.tracebackLimit:
+        arguments.append('--traceback-limit=%d' % options.tracebackLimit)
+    if options.stream:
+        arguments.append('--stream')
+    if options.xmlFile:
+        arguments.append('--xml-file=%s' % options.xmlFile)
+    if not options.corejetReport:
+        arguments.append('--no-corejet-report')
+
+    best = None
+    try:
+        for i in range(options.repeat):
+            if subprocess.call(arguments) != 0:
+                raise RuntimeError("Benchmark of %d tests failed" % count)
+            with open(output) as stream:
+                result = json.load(stream)
+
+            if best is not None:
+                for name, values in result.items():
+                    if isinstance(values, dict) and 'seconds' in values:
+                        values['seconds'] = min(values['seconds'],
+                                                best[name]['seconds'])
+                result['record']['us_per_test'] = (
+                    result['record']['seconds'] / result['tests'] * 1e6)
+            best = result
+    finally:
+        os.remove(output)
+
+    return best
+
+
+def git_revision():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        process = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                                   cwd=directory, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    revision = process.communicate()[0].strip()
+    return process.returncode == 0 and revision or None
+
+
+def flatten(results):
+    """Map ``tests.stage.metric`` to each number in ``results``.
+    """
+
+    values = {}
+    for result in results:
+        for stage, metrics in result.items():
+            if not isinstance(metrics, dict) or stage == 'kinds':
+                continue
+            for metric, value in metrics.items():
+                values['%d.%s.%s' % (result['tests'], stage, metric,)] = value
+    return values
+
+
+def print_results(results):
+    for result in results:
+        print "%d tests (%d failures, %d errors):" % (
+            result['tests'], result['failures'], result['errors'],)
+        print "  record:         %8.3f s  %8.1f us/test" % (
+            result['record']['seconds'], result['record']['us_per_test'],)
+        print "  writeXMLReports %8.3f s  %8d files  %12d bytes" % (
+            result['xml']['seconds'], result['xml']['files'],
+            result['xml']['bytes'],)
+        print "  CoreJet match:  %8.3f s  %8d superfluous" % (
+            result['corejet_match']['seconds'],
+            result['corejet_match']['superfluous'],)
+        if 'corejet_report' in result:
+            print "  CoreJet report: %8.3f s  %8d files  %12d bytes" % (
+                result['corejet_report']['seconds'],
+                result['corejet_report']['files'],
+                result['corejet_report']['bytes'],)
+        memory = result['memory']
+        print "  peak RSS:       %8d KB after record, %d KB overall " \
+              "(%d KB before)" % (memory['record_rss_kb'],
+                                  memory['peak_rss_kb'],
+                                  memory['baseline_rss_kb'],)
+
+
+def print_comparison(previous, results):
+    before = flatten(previous['results'])
+    after = flatten(results)
+
+    print
+    print "Compared to %s:" % (previous.get('revision') or "previous run")
+    for name in sorted(after):
+        if name not in before or not before[name]:
+            continue
+        if name.endswith('_rss_kb') or name.split('.')[-1] in (
+                'seconds', 'bytes', 'us_per_test',):
+            change = (after[name] - before[name]) / float(before[name]) * 100
+            print "  %-40s %14.3f -> %14.3f  %+7.1f%%" % (
+                name, before[name], after[name], change,)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--tests', default=DEFAULT_TESTS,
+                      help="Comma-separated numbers of tests to run with")
+    parser.add_option('--failures', type='int', default=10,
+                      help="Percentage of tests which fail")
+    parser.add_option('--errors', type='int', default=2,
+                      help="Percentage of tests with errors")
+    parser.add_option('--depth', type='int', default=40,
+                      help="Depth of the tracebacks of failures and errors")
+    parser.add_option('--traceback-limit', type='int',
+                      dest='tracebackLimit', default=None)
+    parser.add_option('--xml-workers', type='int', dest='xmlWorkers',
+                      default=1)
+    parser.add_option('--stream', action='store_true', default=False,
+                      help="Stream the JUnit reports, like --xml-stream")
+    parser.add_option('--xml-file', dest='xmlFile', default=None,
+                      help="Write a single report with this name, like "
+                           "--xml-file, e.g. all.xml.gz")
+    parser.add_option('--no-corejet-report', action='store_false',
+                      dest='corejetReport', default=True,
+                      help="Only time matching, not writing the CoreJet "
+                           "report")
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--output', default=None,
+                      help="Save the results as JSON to this file")
+    parser.add_option('--compare', default=None,
+                      help="Compare with results saved with --output")
+    parser.add_option('--child', type='int', default=None,
+                      help=optparse.SUPPRESS_HELP)
+    parser.add_option('--child-output', dest='childOutput', default=None,
+                      help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child is not None:
+        child(options, options.child, options.childOutput)
+        return 0
+
+    results = []
+    for count in [int(count) for count in options.tests.split(',')]:
+        results.append(run_child(options, count))
+
+    print_results(results)
+
+    if options.compare:
+        with open(options.compare) as stream:
+            print_comparison(json.load(stream), results)
+
+    if options.output:
+        data = {
+            'revision': git_revision(),
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': dict([(name, getattr(options, name),) for name in (
+                'failures', 'errors', 'depth', 'tracebackLimit',
+                'xmlWorkers', 'xmlFile', 'stream', 'corejetReport',
+                'repeat',)]),
+            'results': results,
+        }
+        with open(options.output, 'w') as stream:
+            json.dump(data, stream, indent=1, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
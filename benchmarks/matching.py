@@ -0,0 +1,110 @@
+"""Benchmark matching test results against a CoreJet catalogue.
+
+Builds a synthetic catalogue and set of test results, then times
+``match_catalogue()`` and ``add_superfluous_scenarios()``. Run with the
+Python the test runner is installed for::
+
+    $ python benchmarks/matching.py --scenarios=50000
+"""
+
+import optparse
+import time
+
+from corejet.core.model import Epic
+from corejet.core.model import RequirementsCatalogue
+from corejet.core.model import Scenario
+from corejet.core.model import Step
+from corejet.core.model import Story
+
+from corejet.testrunner.formatter import ExceptionInfo
+from corejet.testrunner.formatter import TestCaseInfo
+from corejet.testrunner.formatter import TestedScenario
+from corejet.testrunner.matching import add_superfluous_scenarios
+from corejet.testrunner.matching import match_catalogue
+
+SCENARIOS_PER_STORY = 10
+STORIES_PER_EPIC = 20
+
+
+def make_catalogue(scenarios):
+    catalogue = RequirementsCatalogue(project="Benchmark")
+    epic = story = None
+    for index in range(scenarios):
+        if index % (SCENARIOS_PER_STORY * STORIES_PER_EPIC) == 0:
+            epic = Epic("E%d" % index, "Epic %d" % index)
+            catalogue.epics.append(epic)
+        if index % SCENARIOS_PER_STORY == 0:
+            story = Story("S%d" % index, "Story %d" % index, epic=epic,
+                          givens=[Step("A story step", 'given')])
+            epic.stories.append(story)
+        story.scenarios.append(Scenario(
+            "Scenario %d" % index, story=story,
+            givens=[Step("Given %d" % index, 'given')],
+            whens=[Step("When %d" % index, 'when')],
+            thens=[Step("Then %d" % index, 'then'),
+                   Step("And then %d" % index, 'then')]))
+    return catalogue
+
+
+def make_test_cases(catalogue, superfluous):
+    """One test per scenario: every fifth fails, every seventh has a
+    mismatched step, and ``superfluous`` extra tests are not in the
+    catalogue.
+    """
+
+    failure = ExceptionInfo('AssertionError', 'failed', '')
+    testCases = []
+    index = 0
+    for epic in catalogue.epics:
+        for story in epic.stories:
+            for scenario in story.scenarios:
+                thens = tuple([step.text for step in scenario.thens])
+                if index % 7 == 0:
+                    thens = thens[:-1] + (" And then something else ",)
+                testCases.append(TestCaseInfo(
+                    0.0, 'benchmark.Tests', 'test_%d' % index,
+                    failure=index % 5 == 0 and failure or None,
+                    scenario=TestedScenario(
+                        " %s " % story.name.upper(), scenario.name.upper(),
+                        ("a story step",) + tuple(
+                            [step.text for step in scenario.givens]),
+                        tuple([step.text for step in scenario.whens]),
+                        thens)))
+                index += 1
+
+    for extra in range(superfluous):
+        testCases.append(TestCaseInfo(
+            0.0, 'benchmark.Tests', 'test_extra_%d' % extra,
+            scenario=TestedScenario("Extra %d" % (extra // 10),
+                                    "Extra scenario %d" % extra,
+                                    ("x",), ("y",), ("z",))))
+
+    return testCases
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--scenarios', type='int', default=50000)
+    parser.add_option('--superfluous', type='int', default=1000)
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    for scenarios in (options.scenarios // 10, options.scenarios,):
+        best = None
+        for i in range(options.repeat):
+            catalogue = make_catalogue(scenarios)
+            testCases = make_test_cases(catalogue, options.superfluous)
+
+            start = time.time()
+            superfluous = match_catalogue(catalogue, testCases)
+            added = add_superfluous_scenarios(catalogue, superfluous)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        print "%6d scenarios, %d superfluous: %.3f seconds (%.2f us each)" % (
+            scenarios, added, best, best / scenarios * 1e6,)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Benchmark and guard the startup time of the test runner.
+
+Every ``bin/test`` run imports ``corejet.testrunner.runner``. Dependencies
+that are only needed for XML or CoreJet output must not be imported then;
+this script exits with an error if any of them are. It also reports how long
+the import takes, compared to ``zope.testrunner`` on its own, and with
+``--modules`` the slowest imports, like ``python -X importtime`` on newer
+Pythons::
+
+    $ python benchmarks/startup.py --modules
+"""
+
+import optparse
+import subprocess
+import sys
+import time
+
+MODULE = 'corejet.testrunner.runner'
+BASELINE = 'zope.testrunner.runner'
+
+# Modules which must not be imported just by starting the test runner
+LAZY = [
+    'lxml.etree',
+    'corejet.core.interfaces',
+    'corejet.core.model',
+    'corejet.visualization',
+    'zope.dottedname.resolve',
+    'manuel.testing',
+    'sqlite3',
+    'multiprocessing.pool',
+    'corejet.testrunner.background',
+    'corejet.testrunner.budgets',
+    'corejet.testrunner.capture',
+    'corejet.testrunner.catalogue',
+    'corejet.testrunner.consolidated',
+    'corejet.testrunner.daemon',
+    'corejet.testrunner.events',
+    'corejet.testrunner.failures',
+    'corejet.testrunner.impact',
+    'corejet.testrunner.matching',
+    'corejet.testrunner.profiling',
+    'corejet.testrunner.report',
+    'corejet.testrunner.resources',
+    'corejet.testrunner.sharding',
+    'corejet.testrunner.stream',
+    'corejet.testrunner.timings',
+]
+
+
+def child(module, showModules):
+    """Import ``module``, then print the import time and the modules that
+    must have been imported lazily, one per line. With ``showModules``, also
+    print the cumulative import time of each module.
+    """
+
+    import __builtin__
+
+    timings = []
+    stack = []
+    originalImport = __builtin__.__import__
+
+    def timedImport(name, *args, **kwargs):
+        if name in sys.modules:
+            return originalImport(name, *args, **kwargs)
+        stack.append(name)
+        start = time.time()
+        try:
+            return originalImport(name, *args, **kwargs)
+        finally:
+            stack.pop()
+            timings.append((time.time() - start, len(stack), name,))
+
+    if showModules:
+        __builtin__.__import__ = timedImport
+
+    start = time.time()
+    __import__(module)
+    elapsed = time.time() - start
+
+    __builtin__.__import__ = originalImport
+
+    print elapsed
+    for name in LAZY:
+        if name in sys.modules:
+            print 'loaded', name
+    for seconds, depth, name in timings:
+        print 'module %.6f %d %s' % (seconds, depth, name,)
+
+
+def measure(module, repeat, showModules=False):
+    """Import ``module`` in ``repeat`` fresh interpreters. Returns the best
+    time, the list of lazy modules imported, and the module timings of the
+    last run.
+    """
+
+    best = None
+    for i in range(repeat):
+        output = subprocess.Popen(
+            [sys.executable, __file__, '--child', module] +
+            (showModules and ['--modules'] or []),
+            stdout=subprocess.PIPE).communicate()[0].splitlines()
+        elapsed = float(output[0])
+        if best is None or elapsed < best:
+            best = elapsed
+
+    loaded = [line.split()[1] for line in output if line.startswith('loaded ')]
+    modules = [line.split()[1:] for line in output
+               if line.startswith('module ')]
+    return best, loaded, modules
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--repeat', type='int', default=10)
+    parser.add_option('--modules', action='store_true', default=False,
+                      help="Show the slowest imports")
+    parser.add_option('--top', type='int', default=20)
+    parser.add_option('--child', action='store', default=None,
+                      help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        child(options.child, options.modules)
+        return 0
+
+    baseline, ignored, ignored = measure(BASELINE, options.repeat)
+    elapsed, loaded, modules = measure(MODULE, options.repeat,
+                                       options.modules)
+
+    print "import %s: %.1f ms" % (BASELINE, baseline * 1000,)
+    print "import %s: %.1f ms (+%.1f ms)" % (
+        MODULE, elapsed * 1000, (elapsed - baseline) * 1000,)
+
+    if options.modules:
+        print
+        print "Slowest imports (cumulative):"
+        modules.sort(key=lambda m: float(m[0]), reverse=True)
+        for seconds, depth, name in modules[:options.top]:
+            print "  %8.1f ms  %s%s" % (float(seconds) * 1000,
+                                        '  ' * int(depth), name,)
+
+    if loaded:
+        print
+        print "Imported at startup, but should be imported lazily:"
+        for name in loaded:
+            print "  " + name
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
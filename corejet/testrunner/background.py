@@ -0,0 +1,220 @@
+"""Writing the reports in a detached process, so that the test run can exit
+as soon as the tests have finished.
+
+With ``--background-reports``, the test runner forks once the results of all
+layers have been merged. The forked process, detached from the terminal and
+with its output going to a log file, writes the JUnit and CoreJet reports
+from the results it has inherited, while the test runner exits with the
+outcome of the tests.
+
+Three files next to each other tell how far it has got (all named after the
+completion marker, ``reports.done`` by default):
+
+- ``reports.done.pid`` holds the id of the process while it is writing;
+- ``reports.done.log`` is the output of the process, e.g. any errors;
+- ``reports.done`` is written when the process has finished, as JSON with
+  its ``status`` (0 if all reports were written), the ``seconds`` it took
+  and the name of the ``log``.
+
+``bin/test --join-reports`` waits for the reports, shows the log and exits
+with the status, for pipelines which need the reports. A test run writing
+its reports in the background first waits for those of the previous run.
+"""
+
+from __future__ import with_statement
+
+import errno
+import json
+import os
+import os.path
+import shutil
+import sys
+import time
+import traceback
+
+from corejet.testrunner.utils import write_file_atomically
+
+# Extensions appended to the name of the completion marker
+PID_SUFFIX = '.pid'
+LOG_SUFFIX = '.log'
+
+# Seconds between checks for the completion marker
+JOIN_INTERVAL = 0.1
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def read_json(filename):
+    try:
+        with open(filename, 'rb') as stream:
+            return json.load(stream)
+    except (IOError, ValueError,):
+        return None
+
+
+def join_reports(marker, timeout=None):
+    """Wait until the reports being written in the background have been
+    written. Returns the contents of the completion marker, or None if no
+    reports are being written and there is no marker, e.g. because the
+    process writing them was killed.
+
+    Raises ValueError if the reports are not written within ``timeout``
+    seconds.
+    """
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    while True:
+        status = read_json(marker)
+        if status is not None:
+            return status
+
+        data = read_json(marker + PID_SUFFIX)
+        if data is None or not is_running(data['pid']):
+            # The process may have finished since the marker was checked
+            return read_json(marker)
+
+        if deadline is not None and time.time() > deadline:
+            raise ValueError("The reports were not written within %s "
+                             "seconds" % timeout)
+        time.sleep(JOIN_INTERVAL)
+
+
+def write_reports_in_background(runner, writeReports):
+    """Call ``writeReports(runner, catalogue)`` in a detached process, and
+    return its process id. The fragments directory of the runner is handed
+    over to that process, which removes it when it has finished.
+    """
+
+    marker = runner.options.reportsMarker
+
+    # Two processes must not write the same reports at once
+    join_reports(marker)
+    for filename in (marker, marker + PID_SUFFIX,):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    # Threads do not survive the fork, so the catalogue can only be passed on
+    # if it has been loaded already; otherwise, it is loaded again
+    catalogue = None
+    prefetch = runner.cataloguePrefetch
+    if prefetch is not None and not prefetch.thread.isAlive():
+        catalogue = prefetch.join()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    # Fork twice, so that the process is not a child of the test runner,
+    # and the test runner is not left with a zombie. The process sends its
+    # id back through a pipe once it has written its pid file, so that
+    # joining the reports works as soon as the test runner has exited; the
+    # pid file itself may be gone again by the time the test runner looks.
+    readFd, writeFd = os.pipe()
+    child = os.fork()
+    if child == 0:
+        status = 1
+        try:
+            os.close(readFd)
+            if os.fork() == 0:
+                run_detached(runner, writeReports, catalogue, writeFd)
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(writeFd)
+    try:
+        pid, status = os.waitpid(child, 0)
+        # Empty if the process exited before sending its id
+        data = os.read(readFd, 64)
+    finally:
+        os.close(readFd)
+    if status != 0 or not data.strip():
+        raise OSError("Could not start the process writing the reports")
+
+    # The fragments directory now belongs to the detached process
+    runner.fragmentsDirectory = None
+    return int(data)
+
+
+def run_detached(runner, writeReports, catalogue, readyFd):
+    """Write the reports in the detached process, then exit it. Its process
+    id is written to the pipe ``readyFd`` once the pid file is in place.
+    """
+
+    marker = runner.options.reportsMarker
+    log = marker + LOG_SUFFIX
+    status = 1
+    start = time.time()
+    try:
+        try:
+            write_file_atomically(marker + PID_SUFFIX,
+                                  json.dumps({'pid': os.getpid()}))
+            os.write(readyFd, '%d\n' % os.getpid())
+        finally:
+            os.close(readyFd)
+        os.setsid()
+        fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        for target in (1, 2,):
+            os.dup2(fd, target)
+        os.close(fd)
+        fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(fd, 0)
+        os.close(fd)
+
+        writeReports(runner, catalogue)
+        status = 0
+    except:
+        traceback.print_exc()
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        write_file_atomically(marker, json.dumps({
+            'status': status,
+            'seconds': round(time.time() - start, 3),
+            'log': log,
+        }))
+        if os.path.exists(marker + PID_SUFFIX):
+            os.remove(marker + PID_SUFFIX)
+        if runner.fragmentsDirectory:
+            shutil.rmtree(runner.fragmentsDirectory, True)
+    finally:
+        os._exit(status)
+
+
+def run_join(marker, timeout=None):
+    """Wait for the reports, show the output of the process writing them,
+    and return whether writing them failed.
+    """
+
+    try:
+        status = join_reports(marker, timeout)
+    except ValueError, e:
+        print >> sys.stderr, str(e)
+        return True
+
+    if status is None:
+        print >> sys.stderr, "No reports written in the background found " \
+            "(%s)" % marker
+        log = marker + LOG_SUFFIX
+        if os.path.exists(log):
+            print >> sys.stderr, "See %s" % log
+        return True
+
+    if os.path.exists(status['log']):
+        with open(status['log'], 'rb') as stream:
+            sys.stdout.write(stream.read())
+
+    if status['status'] == 0:
+        print "Reports written in %.3f seconds" % status['seconds']
+    else:
+        print >> sys.stderr, "Writing the reports failed"
+    return status['status'] != 0
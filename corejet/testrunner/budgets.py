@@ -0,0 +1,305 @@
+"""Duration budgets for tests, suites and layers.
+
+A budget is the number of seconds a test, or all the tests of a suite or
+layer together, may take. Budgets come from, in order of precedence:
+
+- the ``budget()`` decorator, on a test method, on a test case class (for
+  each of its tests) or on a layer;
+- a budgets file (``--budgets-file``), with a line for each pattern::
+
+      # kind  pattern                               seconds
+      test    my.package.tests.test_views.*         0.5
+      suite   my.package.tests.test_views.*         20
+      layer   my.package.testing.FunctionalLayer    300
+
+  Patterns are matched with ``fnmatch`` against the class name and name of
+  each test (``my.package.tests.test_views.ViewTests.test_edit``), the
+  suite name or the layer name; the first line matching wins;
+- the default budget of each test (``--budget``).
+
+Each test which takes longer than its budget gets ``budget-seconds`` and
+``over-budget-seconds`` properties in the JUnit reports, and may be turned
+into a failure (``--budgets-fail``). At the end of the run, all tests,
+suites and layers over their budgets are listed.
+
+When layers are run in subprocesses, each child saves the tests which went
+over their budgets and the time taken by its layers in the directory shared
+through the environment (see ``runner.py``), and the parent merges them.
+"""
+
+from __future__ import with_statement
+
+import fnmatch
+import json
+import os
+import os.path
+
+import zope.testrunner.feature
+
+from zope.testrunner.find import name_from_layer
+
+from corejet.testrunner.formatter import ExceptionInfo
+
+# Attribute set by the budget() decorator
+BUDGET_ATTRIBUTE = '__corejet_budget__'
+
+# Kinds of budgets in budgets files
+KINDS = ('test', 'suite', 'layer',)
+
+# Extension of the files holding the results of subprocesses
+BUDGETS_SUFFIX = '.budgets'
+
+# Number of violations listed in the output of a test run
+VIOLATIONS_LISTED = 20
+
+# Name of the layer the tests run in before any layer has been set up
+UNKNOWN_LAYER = 'unknown'
+
+
+def budget(seconds):
+    """Decorator setting the budget of a test method, of each test of a test
+    case class, or of all the tests of a layer together::
+
+        @budget(0.5)
+        def test_edit(self):
+            ...
+    """
+
+    def decorate(obj):
+        setattr(obj, BUDGET_ATTRIBUTE, seconds)
+        return obj
+
+    return decorate
+
+
+def read_budgets_file(filename):
+    """Return the ``(kind, pattern, seconds)`` in the budgets file
+    ``filename``, in order. Raises ValueError if it is not valid.
+    """
+
+    budgets = []
+    with open(filename, 'rb') as stream:
+        for number, line in enumerate(stream):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            parts = line.split()
+            try:
+                if len(parts) != 3 or parts[0] not in KINDS:
+                    raise ValueError()
+                seconds = float(parts[2])
+            except ValueError:
+                raise ValueError("%s, line %d: expected KIND PATTERN SECONDS, "
+                                 "where KIND is one of %s" % (
+                                     filename, number + 1,
+                                     ', '.join(KINDS),))
+            budgets.append((parts[0], parts[1], seconds,))
+    return budgets
+
+
+def decorated_budget(test):
+    """Return the budget given to a test, or its class, by ``budget()``.
+    """
+
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    seconds = getattr(method, BUDGET_ATTRIBUTE, None)
+    if seconds is None:
+        seconds = getattr(test.__class__, BUDGET_ATTRIBUTE, None)
+    return seconds
+
+
+class Violation(object):
+    """A test, suite or layer which took longer than its budget.
+    """
+
+    __slots__ = ('kind', 'name', 'seconds', 'budget',)
+
+    def __init__(self, kind, name, seconds, budget):
+        self.kind = kind
+        self.name = name
+        self.seconds = seconds
+        self.budget = budget
+
+    @property
+    def over(self):
+        return self.seconds - self.budget
+
+
+class DurationBudgets(zope.testrunner.feature.Feature):
+    """Check the duration of each test against its budget, and add up the
+    duration of each layer.
+
+    This is a test observer (see ``CoreJetOutputFormattingWrapper``) as well
+    as a feature of the test runner. Suites and layers are only checked by
+    ``report_budgets()``, once the results of subprocesses have been merged.
+    """
+
+    def __init__(self, runner, default=None, patterns=(), fail=False):
+        super(DurationBudgets, self).__init__(runner)
+        self.active = True
+        self.default = default
+        self.fail = fail
+        self.patterns = {} # kind -> list of (pattern, seconds)
+        for kind, pattern, seconds in patterns:
+            self.patterns.setdefault(kind, []).append((pattern, seconds,))
+
+        self.layerName = UNKNOWN_LAYER
+        self.layerBudgets = {} # layer name -> budget from the decorator
+        self.layers = {} # layer name -> seconds
+        self.violations = []
+        self.decorated = None # budget of the running test, by decorator
+        self.started = False
+        self.testBudgets = {} # test class name and name -> budget, or None
+
+    def match(self, kind, name):
+        for pattern, seconds in self.patterns.get(kind, ()):
+            if fnmatch.fnmatchcase(name, pattern):
+                return seconds
+        return None
+
+    def layer_setup(self, layer):
+        self.layerName = name_from_layer(layer)
+        seconds = getattr(layer, BUDGET_ATTRIBUTE, None)
+        if seconds is not None:
+            self.layerBudgets[self.layerName] = seconds
+
+    # Test observer
+
+    def startTest(self, test):
+        self.decorated = decorated_budget(test)
+        self.started = True
+
+    def stopTest(self, test):
+        pass
+
+    def recordTest(self, suiteName, testCase):
+        # A test may be recorded more than once, e.g. if both the test and
+        # its tearDown() fail; it only counts once
+        if not self.started:
+            return
+        self.started = False
+
+        seconds = testCase.time or 0.0
+        self.layers[self.layerName] = self.layers.get(
+            self.layerName, 0.0) + seconds
+
+        name = '%s.%s' % (testCase.testClassName, testCase.testName,)
+        budget = self.decorated
+        if budget is None:
+            budget = self.testBudgets.get(name, False)
+            if budget is False:
+                budget = self.testBudgets[name] = self.match('test', name)
+        if budget is None:
+            budget = self.default
+        if budget is None or seconds <= budget:
+            return
+
+        over = seconds - budget
+        testCase.properties = (testCase.properties or ()) + (
+            ('budget-seconds', budget,),
+            ('over-budget-seconds', round(over, 6),),)
+        self.violations.append(Violation('test', name, seconds, budget))
+
+        if (self.fail and testCase.failure is None and
+            testCase.error is None):
+            message = "Took %.3f seconds, over its budget of %s seconds" % (
+                seconds, budget,)
+            testCase.failure = ExceptionInfo('BudgetExceeded', message,
+                                             '')
+
+    # Subprocesses
+
+    def global_teardown(self):
+        options = self.runner.options
+        directory = self.runner.fragmentsDirectory
+        if options.resume_layer is None or not directory:
+            return
+
+        filename = os.path.join(directory, '%06d%s' % (options.resume_number,
+                                                       BUDGETS_SUFFIX,))
+        with open(filename, 'wb') as stream:
+            json.dump({
+                'violations': [(violation.name, violation.seconds,
+                                violation.budget,)
+                               for violation in self.violations],
+                'layers': self.layers,
+                'layerBudgets': self.layerBudgets,
+            }, stream)
+
+    def mergeSubprocesses(self, directory):
+        """Add the results saved by subprocesses in ``directory``.
+        """
+
+        names = [name for name in os.listdir(directory)
+                 if name.endswith(BUDGETS_SUFFIX)]
+        names.sort()
+
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as stream:
+                data = json.load(stream)
+
+            for testName, seconds, budget in data['violations']:
+                self.violations.append(Violation('test', testName, seconds,
+                                                 budget))
+            for layerName, seconds in data['layers'].items():
+                self.layers[layerName] = self.layers.get(
+                    layerName, 0.0) + seconds
+            self.layerBudgets.update(data['layerBudgets'])
+
+    # Reporting
+
+    def check(self, suites):
+        """Check the layers, and the suites given as ``(name,
+        TestSuiteInfo)``, against their budgets. Returns all violations,
+        including those of tests.
+        """
+
+        violations = list(self.violations)
+        for kind, totals, budgets in (
+                ('suite', [(name, suite.time,) for name, suite in suites],
+                 {},),
+                ('layer', self.layers.items(), self.layerBudgets,),):
+            for name, seconds in sorted(totals):
+                budget = budgets.get(name)
+                if budget is None:
+                    budget = self.match(kind, name)
+                if budget is not None and seconds > budget:
+                    violations.append(Violation(kind, name, seconds, budget))
+        return violations
+
+
+def report_budgets(budgets, output):
+    """Merge the results of subprocesses into ``budgets`` (DurationBudgets),
+    list the tests, suites and layers which went over their budgets and
+    return how many there are.
+    """
+
+    directory = budgets.runner.fragmentsDirectory
+    if directory:
+        budgets.mergeSubprocesses(directory)
+
+    violations = budgets.check(output.iterTestSuites())
+    if not violations:
+        return 0
+
+    # Furthest over their budget first, relatively
+    violations.sort(key=lambda violation: (
+        violation.over / violation.budget if violation.budget
+        else float('inf'), violation.over,), reverse=True)
+    output.info("%d tests, suites or layers over their duration budgets:" %
+                len(violations))
+    output.info("  %10s %10s %8s  %-5s  %s" % (
+        "Seconds", "Budget", "Over", "Kind", "Name",))
+    for violation in violations[:VIOLATIONS_LISTED]:
+        if violation.budget:
+            over = "+%d%%" % (100 * violation.over / violation.budget)
+        else:
+            over = "-"
+        output.info("  %10.3f %10.3f %8s  %-5s  %s" % (
+            violation.seconds, violation.budget, over, violation.kind,
+            violation.name,))
+    if len(violations) > VIOLATIONS_LISTED:
+        output.info("  ... and %d more" % (
+            len(violations) - VIOLATIONS_LISTED,))
+    return len(violations)
@@ -0,0 +1,193 @@
+"""Capturing what each test writes to ``sys.stdout`` and ``sys.stderr``.
+
+While a test runs, both streams are replaced by temporary files, which are
+reused from one test to the next. Writing to them is as fast as writing to
+any other file, and takes no memory however much a test writes. When the test
+has finished, at most a fixed number of bytes are read back: the beginning
+and the end of the output, with a note of how much was left out in between.
+The captured output ends up in the ``<system-out />`` and ``<system-err />``
+elements of the test's ``<testcase />`` in the JUnit reports.
+
+All test results are held in memory until the reports are written, so only
+short output is kept with the result. Anything longer is appended to a spill
+file, and the result only keeps its position. Spill files are kept in the
+directory shared with subprocesses (see ``runner.py``), so that the parent
+process can read the output of tests run in other processes.
+
+Output written through ``sys.stdout`` and ``sys.stderr`` is captured,
+including the output of subprocesses started with ``stdout=sys.stdout``.
+Output written directly to file descriptors 1 and 2, e.g. by C extensions,
+is not.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import re
+import sys
+import tempfile
+import threading
+
+try:
+    import ctypes
+    set_file_encoding = ctypes.pythonapi.PyFile_SetEncodingAndErrors
+    set_file_encoding.argtypes = [ctypes.py_object, ctypes.c_char_p,
+                                  ctypes.c_char_p]
+except (ImportError, AttributeError,): # e.g. not CPython
+    set_file_encoding = None
+
+# Default number of bytes kept of each stream of each test
+DEFAULT_LIMIT = 64 * 1024
+
+# Output up to this many bytes is kept in memory with the test result
+INLINE_LIMIT = 1024
+
+# Extension of the files holding longer output
+SPILL_SUFFIX = '.output'
+
+# Characters which are not allowed in XML documents
+INVALID_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def make_capture_file(original):
+    """Return a temporary file to replace the stream ``original`` with.
+    Unicode written to it is encoded like it would have been by the
+    original stream, e.g. with the terminal's encoding.
+    """
+
+    captureFile = tempfile.TemporaryFile('w+')
+    encoding = getattr(original, 'encoding', None)
+    if (encoding and set_file_encoding is not None and
+        isinstance(captureFile, file)):
+        set_file_encoding(captureFile, encoding,
+                          getattr(original, 'errors', None))
+    return captureFile
+
+
+def read_captured(captureFile, limit):
+    """Return what has been written to ``captureFile``, or only the first
+    and last ``limit / 2`` bytes of it if there is more, and empty it.
+    """
+
+    captureFile.flush()
+    size = captureFile.tell()
+    if not size:
+        return None
+
+    half = limit // 2
+    captureFile.seek(0)
+    if size <= half * 2:
+        output = captureFile.read(size)
+    else:
+        head = captureFile.read(half)
+        captureFile.seek(size - half)
+        output = "%s\n... (%d bytes omitted)\n%s" % (
+            head, size - half * 2, captureFile.read(half),)
+
+    captureFile.seek(0)
+    captureFile.truncate()
+    return output
+
+
+class SpilledOutput(object):
+    """The position of captured output in a spill file.
+    """
+
+    __slots__ = ('filename', 'offset', 'length',)
+
+    def __init__(self, filename, offset, length):
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+
+    def read(self):
+        with open(self.filename, 'rb') as stream:
+            stream.seek(self.offset)
+            return stream.read(self.length)
+
+
+class SpillFile(object):
+    """A file to which captured output is appended.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.lock = threading.Lock()
+
+    def append(self, data):
+        """Append ``data`` to the file, returning a SpilledOutput.
+        """
+
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.filename, 'ab')
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(data)
+            # The reports may be written by other threads or processes
+            self.file.flush()
+        return SpilledOutput(self.filename, offset, len(data))
+
+
+def output_text(output):
+    """Return captured output, as kept with a test result, as text which
+    can be used in an XML document.
+    """
+
+    if not isinstance(output, str):
+        output = output.read()
+    return INVALID_XML.sub(u'\ufffd', output.decode('utf-8', 'replace'))
+
+
+class OutputCapture(object):
+    """A test observer (see ``CoreJetOutputFormattingWrapper``) which
+    captures the output of each test and keeps it with its test case. Output
+    longer than ``INLINE_LIMIT`` is moved to a spill file in ``directory``.
+    """
+
+    def __init__(self, directory, limit=DEFAULT_LIMIT):
+        self.limit = limit
+        self.spillFile = SpillFile(os.path.join(
+            directory, '%d%s' % (os.getpid(), SPILL_SUFFIX,)))
+        self.captureFiles = None
+        self.streams = None
+        self.captured = None
+
+    def startTest(self, test):
+        # In case the previous test never finished
+        self.stopTest(test)
+        self.captured = None
+
+        if self.captureFiles is None:
+            self.captureFiles = (make_capture_file(sys.stdout),
+                                 make_capture_file(sys.stderr),)
+
+        self.streams = (sys.stdout, sys.stderr,)
+        sys.stdout, sys.stderr = self.captureFiles
+
+    def stopTest(self, test):
+        if self.streams is None:
+            return
+
+        sys.stdout, sys.stderr = self.streams
+        self.streams = None
+        self.captured = [read_captured(captureFile, self.limit)
+                         for captureFile in self.captureFiles]
+
+    def recordTest(self, suiteName, testCase):
+        # A test may be recorded more than once, e.g. if both the test and
+        # its tearDown() fail; its output only needs to be kept once
+        if self.captured is None:
+            return
+
+        stdout, stderr = [self.keep(output) for output in self.captured]
+        self.captured = None
+        testCase.systemOut = stdout
+        testCase.systemErr = stderr
+
+    def keep(self, output):
+        if output is None or len(output) <= INLINE_LIMIT:
+            return output
+        return self.spillFile.append(output)
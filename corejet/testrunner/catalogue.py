@@ -0,0 +1,357 @@
+"""Loading CoreJet requirements catalogues from repository sources, with a
+cache of parsed catalogues.
+
+Cached catalogues are stored as pickled nested lists and dicts rather than as
+pickled model objects, which takes a fraction of the time to load.
+
+A repository source is a callable registered under the
+``corejet.repositorysource`` entry point, which is passed an option string
+and returns a ``RequirementsCatalogue``. Sources opt in to caching by giving
+the callable a ``cacheToken`` attribute: a function which is passed the same
+option string and returns a validity token, such as the modification time and
+size of a file, or a version number reported by a remote backend. The cached
+catalogue is used for as long as the source returns the same token. Return
+``None`` to skip the cache for a call.
+"""
+
+from __future__ import with_statement
+
+import cPickle
+import gc
+import hashlib
+import os
+import os.path
+import sys
+import threading
+import traceback
+
+import pkg_resources
+
+import zope.testrunner.feature
+
+from zope.dottedname.resolve import resolve
+
+from corejet.core.model import Epic
+from corejet.core.model import RequirementsCatalogue
+from corejet.core.model import Scenario
+from corejet.core.model import Step
+from corejet.core.model import Story
+
+from corejet.testrunner.utils import write_file_atomically
+
+# Bump this when the pickled form of catalogues changes
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = '.catalogue'
+
+# Default size of the catalogue cache, in bytes
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def parse_source(source):
+    """Split a ``--corejet`` value into ``(source type, options)``.
+    """
+
+    try:
+        sourceType, sourceOptions = source.split(',', 1)
+    except ValueError:
+        # need more than 1 value to unpack
+        sourceType = source.strip()
+        sourceOptions = ''
+    return sourceType, sourceOptions
+
+
+def resolve_source(sourceType):
+    """Return the repository source function registered for the given
+    source type. Raises ValueError if there is none.
+    """
+
+    functionName = None
+
+    for ep in pkg_resources.iter_entry_points('corejet.repositorysource'):
+        if ep.name == sourceType and len(ep.attrs) > 0:
+            functionName = "%s.%s" % (ep.module_name, ep.attrs[0],)
+            break
+
+    if not functionName:
+        raise ValueError("Unknown CoreJet source type %s" % sourceType)
+
+    return resolve(functionName)
+
+
+def dump_steps(steps):
+    return [(step.text, step.step_type,) for step in steps]
+
+
+def load_steps(steps):
+    loaded = []
+    for text, stepType in steps:
+        step = object.__new__(Step)
+        step.__dict__.update(text=text, step_type=stepType)
+        loaded.append(step)
+    return loaded
+
+
+def load_object(cls, attributes):
+    # The model classes sanitize values in __setattr__; these have already
+    # been sanitized, so set them directly
+    instance = object.__new__(cls)
+    instance.__dict__.update(attributes)
+    return instance
+
+
+def dump_catalogue(catalogue):
+    """Convert a catalogue into nested lists, tuples and dicts, which can be
+    pickled and loaded much faster than the model objects themselves.
+    """
+
+    epics = []
+    for epic in catalogue.epics:
+        stories = []
+        for story in epic.stories:
+            scenarios = []
+            for scenario in story.scenarios:
+                attributes = dict(scenario.__dict__)
+                for name in ('story', 'givens', 'whens', 'thens',):
+                    del attributes[name]
+                scenarios.append((attributes,
+                                  dump_steps(scenario.givens),
+                                  dump_steps(scenario.whens),
+                                  dump_steps(scenario.thens),))
+
+            attributes = dict(story.__dict__)
+            for name in ('epic', 'givens', 'whens', 'thens', 'scenarios',):
+                del attributes[name]
+            stories.append((attributes,
+                            dump_steps(story.givens),
+                            dump_steps(story.whens),
+                            dump_steps(story.thens),
+                            scenarios,))
+
+        attributes = dict(epic.__dict__)
+        del attributes['stories']
+        epics.append((attributes, stories,))
+
+    attributes = dict(catalogue.__dict__)
+    del attributes['epics']
+    return (attributes, epics,)
+
+
+def load_catalogue_data(data):
+    """Rebuild a catalogue from the output of ``dump_catalogue()``.
+    """
+
+    attributes, epicsData = data
+    catalogue = load_object(RequirementsCatalogue, attributes)
+    catalogue.__dict__['epics'] = epics = []
+
+    for attributes, storiesData in epicsData:
+        epic = load_object(Epic, attributes)
+        epic.__dict__['stories'] = stories = []
+        epics.append(epic)
+
+        for attributes, givens, whens, thens, scenariosData in storiesData:
+            story = load_object(Story, attributes)
+            scenarios = []
+            story.__dict__.update(epic=epic, givens=load_steps(givens),
+                                  whens=load_steps(whens),
+                                  thens=load_steps(thens),
+                                  scenarios=scenarios)
+            stories.append(story)
+
+            for attributes, givens, whens, thens in scenariosData:
+                scenario = load_object(Scenario, attributes)
+                scenario.__dict__.update(story=story,
+                                         givens=load_steps(givens),
+                                         whens=load_steps(whens),
+                                         thens=load_steps(thens))
+                scenarios.append(scenario)
+
+    return catalogue
+
+
+class CatalogueCache(object):
+    """Pickled catalogues, stored in ``directory``. When the files take up
+    more than ``maxSize`` bytes, the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, maxSize=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.maxSize = maxSize
+
+    def filename(self, sourceType, sourceOptions, token):
+        key = repr((CACHE_VERSION, sourceType, sourceOptions, token,))
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + CACHE_SUFFIX)
+
+    def get(self, sourceType, sourceOptions, token):
+        """Return the cached catalogue, or None if there is none.
+        """
+
+        filename = self.filename(sourceType, sourceOptions, token)
+
+        # Loading creates a great many small objects, which would otherwise
+        # trigger repeated, fruitless garbage collection passes. Garbage
+        # collection is global to the process, so it is only paused when
+        # loading on the main thread, not while the tests run alongside a
+        # CataloguePrefetch.
+        pauseGC = isinstance(threading.current_thread(),
+                             threading._MainThread) and gc.isenabled()
+        if pauseGC:
+            gc.disable()
+        try:
+            with open(filename, 'rb') as stream:
+                data = stream.read()
+            catalogue = load_catalogue_data(cPickle.loads(data))
+        except Exception:
+            # A missing, corrupt or outdated entry is as good as none
+            return None
+        finally:
+            if pauseGC:
+                gc.enable()
+
+        # Mark the entry as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        return catalogue
+
+    def set(self, sourceType, sourceOptions, token, catalogue):
+        """Store a catalogue in the cache, then evict old entries if the
+        cache has grown too large.
+        """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        write_file_atomically(
+            self.filename(sourceType, sourceOptions, token),
+            cPickle.dumps(dump_catalogue(catalogue), cPickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        ``maxSize`` bytes.
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename,))
+
+        total = sum([size for mtime, size, filename in entries])
+        for mtime, size, filename in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+
+def load_catalogue(source, cache=None, resolved=None):
+    """Load the catalogue for a ``--corejet`` value of the form
+    ``<source type>,<options>``, using ``cache`` (a CatalogueCache) if given
+    and if the source supports it. If given, the ``resolved`` callback is
+    called once the source function has been found.
+    """
+
+    sourceType, sourceOptions = parse_source(source)
+    sourceFunction = resolve_source(sourceType)
+    if resolved is not None:
+        resolved()
+
+    tokenFunction = getattr(sourceFunction, 'cacheToken', None)
+    token = None
+    if cache is not None and tokenFunction is not None:
+        token = tokenFunction(sourceOptions)
+
+    if token is None:
+        return sourceFunction(sourceOptions)
+
+    catalogue = cache.get(sourceType, sourceOptions, token)
+    if catalogue is None:
+        catalogue = sourceFunction(sourceOptions)
+
+        # Only the standard model can be stored in its compact form
+        if type(catalogue) is RequirementsCatalogue:
+            cache.set(sourceType, sourceOptions, token, catalogue)
+
+    return catalogue
+
+
+class CataloguePrefetch(zope.testrunner.feature.Feature):
+    """Load the CoreJet catalogue in a background thread while the tests
+    run, so that a slow repository source does not hold up the report at
+    the end of the run.
+
+    The thread is started as soon as the feature is created. The run is
+    stopped before any tests are run if the source type is unknown or the
+    catalogue has already failed to load by then; later failures are
+    reported as soon as a new layer is set up, and again by ``join()``.
+    """
+
+    def __init__(self, runner, cache=None):
+        super(CataloguePrefetch, self).__init__(runner)
+        options = runner.options
+        self.active = bool(options.corejet and options.resume_layer is None)
+
+        self.catalogue = None
+        self.excInfo = None
+        self.reported = False
+        self.resolved = threading.Event()
+
+        if self.active:
+            self.thread = threading.Thread(target=self.load,
+                                           args=(options.corejet, cache,),
+                                           name='corejet-catalogue')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def load(self, source, cache):
+        try:
+            self.catalogue = load_catalogue(source, cache,
+                                            resolved=self.resolved.set)
+        except:
+            self.excInfo = sys.exc_info()
+        self.resolved.set()
+
+    def reportFailure(self):
+        if self.excInfo is None or self.reported:
+            return False
+
+        self.reported = True
+        self.runner.options.output.error(
+            "Could not load the CoreJet catalogue: %s" % ''.join(
+                traceback.format_exception_only(*self.excInfo[:2])).strip())
+        return True
+
+    def late_setup(self):
+        # Finding the source is quick; wait for it so that a misconfigured
+        # source type always stops the run before the tests start
+        self.resolved.wait()
+        if self.reportFailure():
+            self.runner.do_run_tests = False
+            self.runner.options.fail = True
+
+    def layer_setup(self, layer):
+        self.reportFailure()
+
+    def join(self):
+        """Wait for the catalogue, returning it or raising the exception the
+        source raised.
+        """
+
+        self.thread.join()
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.catalogue
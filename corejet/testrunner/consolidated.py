@@ -0,0 +1,218 @@
+"""Writing all JUnit reports into a single ``<testsuites />`` document.
+
+Instead of one file per suite in ``testreports``, every ``<testsuite />`` is
+written to one file, one suite at a time, so that memory use is bounded by
+the largest suite. The file name decides whether it is compressed: a name
+ending in ``.gz`` is written with gzip, as a separate gzip member for each
+suite. Concatenated members are a valid gzip file, so ``gunzip`` and other
+tools read the whole document as usual.
+
+Next to the report, an index (``<report>.index.json``) lists the name, test
+counts and position of each suite: the offset and length of its bytes in the
+file (of its gzip member, if compressed) and their length once uncompressed.
+``read_suite()`` uses it to read a single suite without touching the rest of
+the file.
+"""
+
+from __future__ import with_statement
+
+import gzip
+import json
+import os
+import os.path
+import zlib
+
+from corejet.testrunner.utils import atomic_file
+from corejet.testrunner.utils import write_file_atomically
+
+INDEX_VERSION = 1
+
+# Extension appended to the name of the report for its index
+INDEX_SUFFIX = '.index.json'
+
+# Extension of report files which are compressed
+GZIP_SUFFIX = '.gz'
+
+# Compression level used for each suite; higher levels are a lot slower for
+# little gain on XML
+COMPRESS_LEVEL = 6
+
+# Number of suites serialized in parallel by each worker before they are
+# written, which bounds the memory used for serialized suites
+BATCH_SIZE = 8
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+
+def index_filename(filename):
+    return filename + INDEX_SUFFIX
+
+
+def is_compressed(filename):
+    return filename.endswith(GZIP_SUFFIX)
+
+
+class ConsolidatedReportWriter(object):
+    """Writes ``<testsuite />`` elements, serialized by the caller, into a
+    ``<testsuites />`` document in ``outputFile``, and keeps the index.
+    """
+
+    def __init__(self, outputFile, compress=False):
+        self.outputFile = outputFile
+        self.compress = compress
+        self.suites = [] # index entries, in the order written
+
+    def start(self, suites):
+        """Write the start of the document, with the totals of the given
+        TestSuiteInfos.
+        """
+
+        tests = errors = failures = 0
+        time = 0.0
+        for suite in suites:
+            tests += suite.tests
+            errors += suite.errors
+            failures += suite.failures
+            time += suite.time
+
+        self.write(HEADER + '<testsuites tests="%d" errors="%d" '
+                   'failures="%d" time="%s">\n' % (tests, errors, failures,
+                                                   str(time),))
+
+    def addSuite(self, name, suite, data):
+        """Write ``data``, the ``<testsuite />`` element for the TestSuiteInfo
+        ``suite`` called ``name``.
+        """
+
+        offset, length = self.write(data)
+        self.suites.append({
+            'name': name,
+            'tests': suite.tests,
+            'errors': suite.errors,
+            'failures': suite.failures,
+            'offset': offset,
+            'length': length,
+            'size': len(data),
+        })
+
+    def finish(self):
+        self.write('</testsuites>\n')
+
+    def write(self, data):
+        """Write ``data`` to the file, as a gzip member of its own if the
+        file is compressed. Returns the offset and length of what was written.
+        """
+
+        offset = self.outputFile.tell()
+        if self.compress:
+            member = gzip.GzipFile('', 'wb', COMPRESS_LEVEL, self.outputFile,
+                                   mtime=0)
+            member.write(data)
+            member.close() # leaves outputFile open
+        else:
+            self.outputFile.write(data)
+        return offset, self.outputFile.tell() - offset
+
+    @property
+    def index(self):
+        return {
+            'version': INDEX_VERSION,
+            'compressed': self.compress,
+            'suites': self.suites,
+        }
+
+
+def serialize_in_batches(items, serialize, workers):
+    """Yield ``(item, serialize(item))`` for each of ``items``, in order.
+    With more than one worker, a batch of items is serialized in parallel
+    while none is written.
+    """
+
+    if workers <= 1:
+        for item in items:
+            yield item, serialize(item)
+        return
+
+    from multiprocessing.pool import ThreadPool
+
+    # lxml releases the GIL while serializing
+    pool = ThreadPool(workers)
+    try:
+        size = workers * BATCH_SIZE
+        for start in range(0, len(items), size):
+            batch = items[start:start + size]
+            for item, data in zip(batch, pool.map(serialize, batch)):
+                yield item, data
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_consolidated_report(filename, suites, serialize, workers=1):
+    """Write the suites, a list of ``(name, TestSuiteInfo)``, to the report
+    ``filename``, and write its index. ``serialize`` is called with each
+    item of ``suites`` and returns its ``<testsuite />`` element as a string.
+
+    The report is replaced atomically, like the reports in ``testreports``.
+    """
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with atomic_file(filename) as outputFile:
+        writer = ConsolidatedReportWriter(outputFile, is_compressed(filename))
+        writer.start([suite for name, suite in suites])
+        for (name, suite), data in serialize_in_batches(suites, serialize,
+                                                        workers):
+            writer.addSuite(name, suite, data)
+        writer.finish()
+
+    write_file_atomically(index_filename(filename),
+                          json.dumps(writer.index, indent=1, sort_keys=True))
+
+
+def open_report(filename):
+    """Open the report ``filename`` for reading, decompressing it if needed.
+    """
+
+    if is_compressed(filename):
+        return gzip.GzipFile(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_index(filename):
+    """Return the index of the report ``filename``, as a dict.
+    """
+
+    with open(index_filename(filename), 'rb') as stream:
+        index = json.load(stream)
+
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError("Unsupported report index version in %s" % (
+            index_filename(filename),))
+    return index
+
+
+def read_suite(filename, name, index=None):
+    """Return the ``<testsuite />`` element of the suite called ``name`` in
+    the report ``filename`` as a string, using its index. Returns None if
+    there is no such suite.
+    """
+
+    if index is None:
+        index = read_index(filename)
+
+    for entry in index['suites']:
+        if entry['name'] == name:
+            break
+    else:
+        return None
+
+    with open(filename, 'rb') as stream:
+        stream.seek(entry['offset'])
+        data = stream.read(entry['length'])
+
+    if index['compressed']:
+        data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    return data
@@ -0,0 +1,474 @@
+"""Keeping layers set up in a long-lived process, to rerun tests instantly.
+
+Started with ``--daemon``, the test runner imports the test modules, sets up
+the layers given with ``--daemon-layer`` and then waits for runs to be
+requested on a Unix socket. ``bin/test --warm`` sends its arguments to the
+daemon instead of running the tests itself, and shows the output of the run
+as it happens.
+
+Each run happens in a process forked from the daemon, so that it starts with
+the modules imported and the layers set up, and cannot change them for later
+runs. Before running the tests, the forked process reloads the modules in the
+test paths which have changed since the daemon started, along with any test
+modules using them. A layer in a reloaded module is a new layer, which is
+set up again. Otherwise, the run is the same as any other, including the
+reports it writes. The warm layers are never torn down in the forked process,
+only by the daemon when it exits.
+
+Threads do not survive the fork, so layers which start threads (e.g. to run
+a server) cannot be kept warm. Layers run in subprocesses, e.g. with ``-j``,
+are set up in those subprocesses as usual.
+"""
+
+from __future__ import with_statement
+
+import errno
+import json
+import os
+import os.path
+import signal
+import socket
+import sys
+import time
+import traceback
+import types
+from StringIO import StringIO
+
+from zope.testrunner.find import find_tests
+from zope.testrunner.formatter import terminal_has_colors
+from zope.testrunner.options import get_options
+from zope.testrunner.runner import layer_from_name
+from zope.testrunner.runner import setup_layer
+from zope.testrunner.runner import tear_down_unneeded
+import zope.testrunner.runner
+
+from corejet.testrunner.runner import CoreJetRunner
+from corejet.testrunner.runner import run_internal
+
+# Sent by the daemon after the output of each run, with its exit status; the
+# output itself is passed through as it is
+TRAILER = '\0corejet-daemon-exit %03d\n'
+TRAILER_SIZE = len(TRAILER % 0)
+
+BUFFER_SIZE = 64 * 1024
+
+
+class WarmLayers(dict):
+    """The layers set up during a run in a forked process, like the dict
+    used by ``zope.testrunner``. The warm layers, set up by the daemon, count
+    as set up, but are not listed, so that they are never torn down.
+    """
+
+    def __init__(self, warm):
+        super(WarmLayers, self).__init__()
+        self.warm = warm
+
+    def __contains__(self, layer):
+        return layer in self.warm or dict.__contains__(self, layer)
+
+
+class WarmRunner(CoreJetRunner):
+    """Runs the tests in a process forked from the daemon, in which the warm
+    layers are already set up.
+    """
+
+    # Layers set up by the daemon
+    warmLayers = {}
+
+    def run_tests(self):
+        # Runner.run_tests() keeps the layers it sets up in a dict of its
+        # own, which it passes to run_layer(). While it runs, run_layer() is
+        # given one in which the warm layers count as set up instead. The
+        # other layers are copied back, so that those left over are torn
+        # down as usual.
+        setupLayers = WarmLayers(self.warmLayers)
+        runLayer = zope.testrunner.runner.run_layer
+
+        def run_layer(options, layer_name, layer, tests, setup_layers,
+                      failures, errors):
+            try:
+                return runLayer(options, layer_name, layer, tests,
+                                setupLayers, failures, errors)
+            finally:
+                setup_layers.clear()
+                setup_layers.update(setupLayers)
+
+        zope.testrunner.runner.run_layer = run_layer
+        try:
+            super(WarmRunner, self).run_tests()
+        finally:
+            zope.testrunner.runner.run_layer = runLayer
+
+
+class ModuleSnapshot(object):
+    """The modification times of the modules in the given directories, to
+    find out which have changed since.
+    """
+
+    def __init__(self, directories):
+        self.directories = [os.path.join(os.path.realpath(directory), '')
+                            for directory in directories]
+        self.modules = {} # module name -> (source file, modification time)
+        for name, module in sys.modules.items():
+            filename = self.sourceFile(module)
+            if filename is not None:
+                self.modules[name] = (filename, self.modified(filename),)
+
+    def sourceFile(self, module):
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            return None
+        if filename.endswith(('.pyc', '.pyo',)):
+            filename = filename[:-1]
+        filename = os.path.realpath(filename)
+        for directory in self.directories:
+            if filename.startswith(directory):
+                return filename
+        return None
+
+    def modified(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def changed(self):
+        """Return the names of the modules which have changed, in order.
+        """
+
+        return sorted([name for name, (filename, mtime) in
+                       self.modules.items()
+                       if self.modified(filename) not in (mtime, None,)])
+
+    def reloadChanged(self, isTestModule):
+        """Reload the modules which have changed, followed by the test modules
+        using them, and return their names. Modules are reloaded in order of
+        their names, so that packages come before the modules in them.
+        """
+
+        changed = self.changed()
+        if not changed:
+            return []
+
+        changedModules = set(changed)
+        reloaded = []
+        for name in changed:
+            if not isTestModule(name) and name in sys.modules:
+                reload(sys.modules[name])
+                reloaded.append(name)
+
+        for name in sorted(self.modules):
+            if not isTestModule(name) or name not in sys.modules:
+                continue
+            module = sys.modules[name]
+            if name in changedModules or uses_modules(module, changedModules):
+                reload(module)
+                reloaded.append(name)
+
+        return reloaded
+
+
+def uses_modules(module, names):
+    """Tell whether ``module`` has imported any of the modules ``names``, or
+    anything from them.
+    """
+
+    for value in vars(module).values():
+        if isinstance(value, types.ModuleType):
+            if value.__name__ in names:
+                return True
+        elif getattr(value, '__module__', None) in names:
+            return True
+    return False
+
+
+def resolve_terminal_options(args):
+    """Replace ``--auto-color`` and ``--auto-progress`` in ``args`` according
+    to the terminal of this process, as ``zope.testrunner`` does; the
+    daemon's output is not a terminal.
+    """
+
+    isatty = sys.stdout.isatty()
+    resolved = []
+    for arg in args:
+        if arg == '--auto-color':
+            arg = isatty and terminal_has_colors() and '--color' or \
+                '--no-color'
+        elif arg == '--auto-progress':
+            arg = isatty and '--progress' or '--no-progress'
+        resolved.append(arg)
+    return resolved
+
+
+# Client
+
+def run_client(socketPath, args, defaults=None, stdin=None):
+    """Ask the daemon listening on ``socketPath`` to run the tests with
+    ``args`` and ``defaults``, like ``run_internal()``, and copy the output to
+    ``sys.stdout``. ``stdin`` is what the tests read from the standard input,
+    if anything. Returns whether the tests failed, or None if there is no
+    daemon.
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except socket.error, e:
+        sock.close()
+        if e.args[0] in (errno.ENOENT, errno.ECONNREFUSED,):
+            return None
+        raise
+
+    request = {
+        'args': resolve_terminal_options([arg for arg in args
+                                          if arg != '--warm']),
+        'defaults': resolve_terminal_options(defaults or []),
+        'cwd': os.getcwd(),
+        'stdin': stdin,
+    }
+
+    pending = ''
+    try:
+        sock.sendall(json.dumps(request) + '\n')
+        while True:
+            data = sock.recv(BUFFER_SIZE)
+            if not data:
+                break
+            # Hold back what may be the trailer
+            pending += data
+            if len(pending) > TRAILER_SIZE:
+                sys.stdout.write(pending[:-TRAILER_SIZE])
+                sys.stdout.flush()
+                pending = pending[-TRAILER_SIZE:]
+    finally:
+        sock.close()
+
+    prefix = TRAILER.split('%')[0]
+    if len(pending) == TRAILER_SIZE and pending.startswith(prefix):
+        return int(pending[len(prefix):-1]) != 0
+
+    sys.stdout.write(pending)
+    print >> sys.stderr, "The test daemon closed the connection"
+    return True
+
+
+# Daemon
+
+def listen(socketPath):
+    """Listen on the Unix socket ``socketPath``, replacing a stale socket
+    left behind by a daemon which did not exit cleanly. Raises ValueError if
+    a daemon is already listening on it.
+    """
+
+    if os.path.exists(socketPath):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socketPath)
+        except socket.error:
+            os.remove(socketPath)
+        else:
+            raise ValueError("A test daemon is already listening on %s" % (
+                socketPath,))
+        finally:
+            probe.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socketPath)
+    listener.listen(5)
+    return listener
+
+
+class TestDaemon(object):
+    """Keeps the layers set up and runs the tests requested by clients, one
+    run at a time.
+    """
+
+    def __init__(self, options, listener, script_parts=None):
+        self.options = options
+        self.listener = listener
+        self.script_parts = script_parts
+        self.warmLayers = {}
+        self.snapshot = None
+        self.runs = 0
+
+    def setUp(self):
+        """Import the test modules and set up the warm layers.
+        """
+
+        options = self.options
+        for path in options.path:
+            if path not in sys.path:
+                sys.path.append(path)
+
+        importErrors = find_tests(options).pop(None, None)
+        options.output.import_errors(importErrors)
+        self.snapshot = ModuleSnapshot([path for path, package in
+                                        options.test_path])
+        for name in options.daemonLayers or ():
+            setup_layer(options, layer_from_name(name), self.warmLayers)
+
+    def tearDown(self):
+        if self.warmLayers:
+            self.options.output.info("Tearing down warm layers:")
+            tear_down_unneeded(self.options, (), self.warmLayers, True)
+
+    def isTestModule(self, name):
+        for part in name.split('.'):
+            if self.options.tests_pattern(part):
+                return True
+        return False
+
+    def serve(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            # A bad request, or a client which goes away, must not stop the
+            # daemon
+            try:
+                self.handle(connection)
+            except (ValueError, KeyError, TypeError, socket.error,):
+                self.options.output.error(
+                    "Could not handle a request:\n" + traceback.format_exc())
+            finally:
+                connection.close()
+
+    def handle(self, connection):
+        line = connection.makefile('rb').readline()
+        if not line:
+            # e.g. listen() checking whether a daemon is already running
+            return
+
+        request = json.loads(line)
+        if not isinstance(request, dict) or not isinstance(
+                request['args'], list):
+            raise ValueError("Not a request: %r" % line[:200])
+        self.runs += 1
+        output = self.options.output
+        output.info("Run %d: %s" % (self.runs, ' '.join(request['args'][1:]),))
+
+        start = time.time()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 2
+            try:
+                self.listener.close()
+                status = self.runForked(connection, request)
+            finally:
+                os._exit(status)
+
+        while True:
+            try:
+                pid, status = os.waitpid(pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            break
+
+        if os.WIFSIGNALED(status):
+            message = "Test run killed by signal %d\n" % os.WTERMSIG(status)
+            status = 128 + os.WTERMSIG(status)
+        else:
+            message = ''
+            status = os.WEXITSTATUS(status)
+
+        try:
+            connection.sendall(message + TRAILER % status)
+        except socket.error:
+            # The client has gone away
+            pass
+        output.info("Run %d: exit status %d in %.3f seconds" % (
+            self.runs, status, time.time() - start,))
+
+    def runForked(self, connection, request):
+        """Run the tests in the forked process, with the output going to the
+        client. Returns the exit status.
+        """
+
+        for fd in (1, 2,):
+            os.dup2(connection.fileno(), fd)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        connection.close()
+        sys.stdout = os.fdopen(1, 'w', 1)
+        sys.stderr = os.fdopen(2, 'w', 0)
+        if request.get('stdin') is not None:
+            # e.g. --changed-files -
+            sys.stdin = StringIO(request['stdin'].encode('utf-8'))
+
+        try:
+            os.chdir(request['cwd'])
+            reloaded = self.snapshot.reloadChanged(self.isTestModule)
+        except Exception:
+            print >> sys.stderr, "Could not reload the changed modules:"
+            traceback.print_exc()
+            return 1
+        if reloaded:
+            print "Reloaded %s" % ', '.join(reloaded)
+
+        WarmRunner.warmLayers = self.warmLayers
+        try:
+            failed = run_internal(request['defaults'], request['args'],
+                                  script_parts=self.script_parts,
+                                  runnerClass=WarmRunner)
+        except SystemExit, e:
+            # e.g. invalid options
+            failed = e.code
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        return int(bool(failed))
+
+
+def run_daemon(defaults=None, args=None, script_parts=None):
+    """Run the test daemon until it is interrupted or terminated. Returns
+    whether it failed to start.
+    """
+
+    options = get_options(list(args or sys.argv), list(defaults or []))
+    if options.fail:
+        return True
+
+    output = options.output
+    socketPath = os.path.abspath(options.daemonSocket)
+    try:
+        listener = listen(socketPath)
+    except (ValueError, socket.error,), e:
+        output.error(str(e))
+        return True
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    daemon = TestDaemon(options, listener, script_parts)
+    previousHandler = signal.signal(signal.SIGTERM, terminate)
+    try:
+        start = time.time()
+        try:
+            daemon.setUp()
+        except Exception:
+            output.error("Could not set up the test daemon:\n" +
+                         traceback.format_exc())
+            return True
+
+        output.info("Ready in %.3f seconds, listening on %s" % (
+            time.time() - start, socketPath,))
+        try:
+            daemon.serve()
+        except KeyboardInterrupt:
+            pass
+        return False
+    finally:
+        signal.signal(signal.SIGTERM, previousHandler)
+        listener.close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        daemon.tearDown()
@@ -0,0 +1,248 @@
+"""Streaming test events as newline-delimited JSON while the tests run.
+
+Each event is a JSON object on a line of its own, with an ``event`` type,
+the ``time`` it happened and the ``pid`` of the process running the tests:
+
+- ``run-start``, when the test runner starts;
+- ``layer-setup`` and ``layer-setup-done``, ``layer-teardown`` and
+  ``layer-teardown-done`` around setting up and tearing down each layer
+  (``layer``, ``seconds``), and ``layer-teardown-unsupported``;
+- ``test-start`` (``test``, ``number``, ``total``) and ``test-stop``
+  (``suite``, ``classname``, ``name``, ``seconds``, ``outcome``, and the
+  first line of the ``message`` of a failure or error);
+- ``layer-summary`` and ``totals`` (``tests``, ``failures``, ``errors``,
+  ``seconds``), and ``run-end``.
+
+Events are sent to a file, a FIFO or a Unix socket. Emitting an event only
+appends it to a buffer, which a background thread encodes and writes out
+every so often, so that neither the encoding nor a slow reader hold up the
+tests. If the reader goes away, events are no longer sent, but the tests
+carry on.
+
+Layers run in subprocesses send their events to the same target: a file is
+appended to, and each subprocess connects to a socket on its own. Events are
+written in whole lines, so that those of several processes writing to a
+FIFO at once are not mixed up.
+"""
+
+from __future__ import with_statement
+
+import errno
+import fcntl
+import json
+import os
+import os.path
+import select
+import socket
+import stat
+import threading
+import time
+
+# Seconds between writes of the buffered events
+DEFAULT_INTERVAL = 0.2
+
+# Prefix of targets which are Unix sockets that do not exist yet
+SOCKET_PREFIX = 'unix:'
+
+# Writes of up to this many bytes to a FIFO are not interleaved with the
+# writes of other processes
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+# Number of characters of failure messages included in events
+MESSAGE_LIMIT = 500
+
+# json.dumps() creates a new encoder for each call with any non-default
+# arguments, which takes longer than the encoding itself
+ENCODER = json.JSONEncoder(separators=(',', ':',))
+FALLBACK_ENCODER = json.JSONEncoder(separators=(',', ':',),
+                                    encoding='latin-1')
+
+
+def encode_event(data):
+    """Return the event ``data`` as a line of JSON.
+    """
+
+    data['time'] = round(data['time'], 3)
+    try:
+        return ENCODER.encode(data) + '\n'
+    except UnicodeDecodeError:
+        # Names which are not UTF-8; an event must not stop the tests
+        return FALLBACK_ENCODER.encode(data) + '\n'
+
+
+class FileSink(object):
+    """Writes events to a file descriptor, a whole number of lines of at
+    most ``PIPE_BUF`` bytes at a time where possible.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, lines):
+        chunk = []
+        size = 0
+        for line in lines:
+            if chunk and size + len(line) > PIPE_BUF:
+                self.writeAll(''.join(chunk))
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line)
+        if chunk:
+            self.writeAll(''.join(chunk))
+
+    def writeAll(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SocketSink(object):
+    """Writes events to a connected socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, lines):
+        self.sock.sendall(''.join(lines))
+
+    def close(self):
+        self.sock.close()
+
+
+def open_sink(target, append=False):
+    """Open the file, FIFO or Unix socket ``target`` to write events to.
+    Sockets are given as ``unix:PATH``, or by the path of an existing socket.
+    Files are truncated, unless ``append`` is true. Raises EnvironmentError
+    (or ``socket.error``) if the target cannot be opened.
+    """
+
+    path = target
+    if target.startswith(SOCKET_PREFIX):
+        path = target[len(SOCKET_PREFIX):]
+
+    mode = None
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode
+
+    if target.startswith(SOCKET_PREFIX) or (mode is not None and
+                                            stat.S_ISSOCK(mode)):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            sock.close()
+            raise
+        return SocketSink(sock)
+
+    if mode is not None and stat.S_ISFIFO(mode):
+        # Opening a FIFO blocks until there is a reader; rather than
+        # hanging, fail if there is none
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                raise IOError(errno.ENXIO, "No process is reading from the "
+                              "FIFO", path)
+            raise
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        return FileSink(fd)
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+    if not append:
+        flags |= os.O_TRUNC
+    return FileSink(os.open(path, flags, 0666))
+
+
+class EventStream(object):
+    """Buffers events and writes them to a sink (see ``open_sink()``) every
+    ``interval`` seconds from a background thread.
+    """
+
+    def __init__(self, sink, interval=DEFAULT_INTERVAL):
+        self.sink = sink
+        self.interval = interval
+        self.pid = os.getpid()
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run,
+                                       name='corejet-events')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def emit(self, event, **data):
+        # Events are encoded when they are written, by the background thread
+        data['event'] = event
+        data['time'] = time.time()
+        data['pid'] = self.pid
+        with self.lock:
+            self.buffer.append(data)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            events = self.buffer
+            self.buffer = []
+
+        if not events or self.sink is None:
+            return
+
+        try:
+            self.sink.write([encode_event(data) for data in events])
+        except (EnvironmentError, socket.error,):
+            # e.g. the reader has gone away; carry on without it
+            self.closeSink()
+
+    def close(self):
+        """Write the remaining events and close the sink.
+        """
+
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        self.closeSink()
+
+    def closeSink(self):
+        sink = self.sink
+        self.sink = None
+        if sink is not None:
+            try:
+                sink.close()
+            except (EnvironmentError, socket.error,):
+                pass
+
+    # Events
+
+    def testStarted(self, test, testsRun, totalTests):
+        self.emit('test-start', test=test.id(), number=testsRun,
+                  total=totalTests)
+
+    def testFinished(self, suiteName, testCase):
+        """Emit the result of a test, given its TestCaseInfo.
+        """
+
+        problem = testCase.error or testCase.failure
+        if testCase.error is not None:
+            outcome = 'error'
+        elif testCase.failure is not None:
+            outcome = 'failure'
+        else:
+            outcome = 'success'
+
+        data = {}
+        if problem is not None:
+            data['message'] = problem.firstLine[:MESSAGE_LIMIT]
+            data['type'] = problem.type
+
+        self.emit('test-stop', suite=suiteName,
+                  classname=testCase.testClassName, name=testCase.testName,
+                  seconds=testCase.time, outcome=outcome, **data)
@@ -0,0 +1,189 @@
+"""Remembering which tests failed, to run them again on their own or first.
+
+After each run, the tests which failed or had errors are saved to a small
+JSON file in the working directory (``--failures-file``), once any have
+failed. Tests are identified by their suite, class and test name, like in the
+timing history. Only failures are kept: a test which failed before is
+forgotten once it has run and passed, and one which was not run this time
+(e.g. because of ``-t``) stays as it was.
+
+Layers run in subprocesses only pass on the names of the tests which failed,
+or passed after failing before, not all of their results.
+
+With ``--last-failed``, only the tests which failed last time are run;
+layers without any of them are not set up at all. With ``--failed-first``,
+they are run first in each layer, followed by all others.
+"""
+
+from __future__ import with_statement
+
+import json
+import os
+import os.path
+
+import zope.testrunner.feature
+
+from corejet.testrunner.formatter import TestParser
+from corejet.testrunner.utils import write_file_atomically
+
+FAILURES_VERSION = 1
+
+# Extension of the files holding the outcomes of subprocesses
+FAILURES_SUFFIX = '.failures'
+
+
+def decode_keys(keys):
+    # Names are str, unless a test explicitly uses unicode
+    return set([tuple([part.encode('utf-8') for part in key])
+                for key in keys])
+
+
+class FailureHistory(object):
+    """The tests which failed in previous runs, and the outcome of the tests
+    of the current run, which are added one at a time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._previous = None
+        self.failed = set() # tests failing in this run
+        self.passed = set() # previously failing tests passing in this run
+
+    @property
+    def previous(self):
+        """The set of ``(suite, classname, name)`` of the tests which failed
+        in previous runs.
+        """
+
+        if self._previous is None:
+            self._previous = self.load()
+        return self._previous
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return set()
+
+        try:
+            with open(self.filename, 'rb') as stream:
+                data = json.load(stream)
+        except (IOError, ValueError,):
+            return set()
+
+        if not isinstance(data, dict) or data.get(
+                'version') != FAILURES_VERSION:
+            return set()
+        return decode_keys(data['failures'])
+
+    def add(self, suiteName, testCase):
+        """Record the outcome of a test, given its TestCaseInfo.
+        """
+
+        key = (suiteName, testCase.testClassName, testCase.testName,)
+        if testCase.failure is not None or testCase.error is not None:
+            self.failed.add(key)
+        elif key in self.previous:
+            self.passed.add(key)
+
+    @property
+    def failures(self):
+        """The tests failing as of the end of this run.
+        """
+
+        return (self.previous - self.passed) | self.failed
+
+    def writeFragment(self, directory, name):
+        """Save the outcomes recorded by a subprocess to a file in
+        ``directory``, to be merged by the parent with ``mergeFragments()``.
+        """
+
+        filename = os.path.join(directory, name + FAILURES_SUFFIX)
+        with open(filename, 'wb') as stream:
+            json.dump({
+                'failed': sorted(self.failed),
+                'passed': sorted(self.passed),
+            }, stream)
+
+    def mergeFragments(self, directory):
+        """Add the outcomes saved by subprocesses in ``directory``.
+        """
+
+        names = [name for name in os.listdir(directory)
+                 if name.endswith(FAILURES_SUFFIX)]
+        names.sort()
+
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as stream:
+                data = json.load(stream)
+            self.failed.update(decode_keys(data['failed']))
+            self.passed.update(decode_keys(data['passed']))
+
+    def save(self):
+        """Save the failures, unless nothing has changed. No file is created
+        as long as no test has failed.
+        """
+
+        failures = self.failures
+        if failures == self.previous:
+            return
+
+        write_file_atomically(self.filename, json.dumps({
+            'version': FAILURES_VERSION,
+            'failures': sorted(failures),
+        }, indent=1))
+
+
+class LastFailed(zope.testrunner.feature.Feature):
+    """Only run the tests which failed last time (``--last-failed``), or run
+    them first in each layer (``--failed-first``).
+    """
+
+    def __init__(self, runner, history):
+        super(LastFailed, self).__init__(runner)
+        self.active = True
+        self.history = history
+        self.selected = 0
+
+    def global_setup(self):
+        options = self.runner.options
+        layers = self.runner.tests_by_layer_name
+        failures = self.history.previous
+        parseTest = TestParser()
+
+        def failed(test):
+            testSuite, testName, testClassName = parseTest(test)
+            return (testSuite, testClassName, testName,) in failures
+
+        selected = {} # layer name -> failed tests, in their order
+        if failures:
+            for layerName, suite in layers.items():
+                tests = [test for test in suite if failed(test)]
+                if tests:
+                    selected[layerName] = tests
+        self.selected = sum([len(tests) for tests in selected.values()])
+
+        if not self.selected:
+            if options.resume_layer is None:
+                options.output.info(
+                    "No tests which failed last time found, running all "
+                    "tests")
+            return
+
+        for layerName, suite in list(layers.items()):
+            tests = selected.get(layerName, [])
+            if options.failedFirst:
+                failedIds = set([id(test) for test in tests])
+                tests = tests + [test for test in suite
+                                 if id(test) not in failedIds]
+
+            if tests:
+                layers[layerName] = suite.__class__(tests)
+            else:
+                # Layers without failed tests are never set up
+                del layers[layerName]
+
+        if options.resume_layer is None:
+            if options.failedFirst:
+                message = "Running %d tests which failed last time first"
+            else:
+                message = "Running %d tests which failed last time"
+            options.output.info(message % self.selected)
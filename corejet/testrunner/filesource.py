@@ -1,5 +1,7 @@
 from __future__ import with_statement 
 
+import os
+
 from corejet.core.model import RequirementsCatalogue
 
 def fileSource(path):
@@ -10,3 +12,13 @@ def fileSource(path):
     with open(path) as stream:
         catalogue.populate(stream)
     return catalogue
+
+
+def fileCacheToken(path):
+    """The parsed file may be cached for as long as it is not modified
+    """
+
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime, stat.st_size,)
+
+fileSource.cacheToken = fileCacheToken
@@ -1,67 +1,175 @@
 from __future__ import with_statement 
 
-import pkg_resources
 import datetime
 import doctest
 import os
 import os.path
 import shutil
 import socket
+import sys
+import tempfile
 import traceback
+import cPickle
 
-from zope.dottedname.resolve import resolve
+from corejet.testrunner.utils import write_file_atomically
 
-from corejet.core.interfaces import IStory
-from corejet.visualization import generateReportFromCatalogue
+# This module is imported by every test run, so the dependencies that are
+# only needed for XML or CoreJet output (lxml, corejet.core,
+# corejet.visualization and the modules using them) are imported where they
+# are used. See benchmarks/startup.py.
 
-from lxml import etree
 
-try:
-    import manuel.testing
-    HAVE_MANUEL = True
-except ImportError:
-    HAVE_MANUEL = False
+# Extension of the files written by writeFragment()
+FRAGMENT_SUFFIX = '.fragment'
+
+# Number of superfluous scenarios listed in the output of a test run; all of
+# them are added to the CoreJet report
+SUPERFLUOUS_LISTED = 20
 
 
 class TestSuiteInfo(object):
 
+    __slots__ = ('testCases', 'tests', 'errors', 'failures', 'time',)
+
     def __init__(self):
         self.testCases = []
+        self.tests = 0
         self.errors = 0
         self.failures = 0
         self.time = 0.0
 
-    @property
-    def tests(self):
-        return len(self.testCases)
-
     @property
     def successes(self):
         return self.tests - (self.errors + self.failures)
 
 
 class TestCaseInfo(object):
+    """The recorded result of a single test. We deliberately do not keep a
+    reference to the test itself, so that it and its fixtures can be garbage
+    collected; anything the reports need is resolved by ``_record``.
+    """
 
-    def __init__(self, test, time, testClassName, testName, failure=None,
-                 error=None):
-        self.test = test
+    __slots__ = ('time', 'testClassName', 'testName', 'failure', 'error',
+                 'scenario', 'properties', 'systemOut', 'systemErr',)
+
+    def __init__(self, time, testClassName, testName, failure=None,
+                 error=None, scenario=None, properties=None, systemOut=None,
+                 systemErr=None):
         self.time = time
         self.testClassName = testClassName
         self.testName = testName
         self.failure = failure
         self.error = error
+        self.scenario = scenario
+        self.properties = properties # tuple of (name, value), or None
+        # Captured output, see corejet.testrunner.capture
+        self.systemOut = systemOut
+        self.systemErr = systemErr
+
+
+class TestedScenario(object):
+    """The identity of the CoreJet story and scenario a test implements,
+    along with the text of its steps.
+    """
+
+    __slots__ = ('storyName', 'scenarioName', 'givens', 'whens', 'thens',)
+
+    def __init__(self, storyName, scenarioName, givens, whens, thens):
+        self.storyName = storyName
+        self.scenarioName = scenarioName
+        self.givens = givens
+        self.whens = whens
+        self.thens = thens
+
+
+class ExceptionInfo(object):
+    """A failure or error, formatted as soon as it is recorded so that we do
+    not keep the traceback (and with it every frame and local variable of
+    the failing test) alive until the reports are written.
+    """
+
+    __slots__ = ('type', 'message', 'stackTrace',)
+
+    def __init__(self, type, message, stackTrace):
+        self.type = type
+        self.message = message
+        self.stackTrace = stackTrace
+
+    @property
+    def firstLine(self):
+        return self.message.split('\n')[0]
+
+    @property
+    def text(self):
+        return self.message + '\n\n' + self.stackTrace
+
+
+def format_exception_info(exc_info, limit=None):
+    """Turn an ``exc_info`` tuple into an ExceptionInfo. If ``limit`` is
+    given, at most the last ``limit`` characters of the stack trace are kept.
+    """
+
+    try:
+        excType, excInstance, tb = exc_info
+        errorMessage = str(excInstance)
+        stackTrace = ''.join(traceback.format_tb(tb))
+    finally: # Avoids a memory leak
+        del tb
+
+    if limit and len(stackTrace) > limit:
+        # Keep whole lines where possible
+        tail = stackTrace[-limit:]
+        if '\n' in tail[:-1]:
+            tail = tail[tail.index('\n') + 1:]
+        stackTrace = "... (%d characters truncated)\n%s" % (
+            len(stackTrace) - len(tail), tail,)
+
+    return ExceptionInfo(str(excType), errorMessage, stackTrace)
+
+
+def intern_name(name):
+    """Intern a name which is likely to be repeated across many results."""
+    try:
+        return intern(name)
+    except TypeError: # unicode
+        return name
+
+
+def resolve_scenario(test):
+    """Look up the CoreJet story and scenario for the given test, if any.
+    """
+
+    from corejet.core.interfaces import IStory
+
+    # look up the story for the test through adaptation:
+    # - for @story-decorated test, the class implements IStory
+    # - for others, the test case may have an adapter for IStory
+    story = IStory(test, IStory(test.__class__, None))
+    if not story:
+        return None
+
+    # XXX: Relying on _testMethodName here is not very good
+    scenario = getattr(story, test._testMethodName).scenario
+
+    return TestedScenario(story.name, scenario.name,
+                          tuple([step.text for step in scenario.givens]),
+                          tuple([step.text for step in scenario.whens]),
+                          tuple([step.text for step in scenario.thens]),)
+
 
 def get_test_class_name(test):
     """Compute the test class name from the test object."""
     return "%s.%s" % (test.__module__, test.__class__.__name__, )
 
 
-def filename_to_suite_name_parts(filename):
+def filename_to_suite_name_parts(filename, cwd=None):
     # lop off whatever portion of the path we have in common
     # with the current working directory; crude, but about as
     # much as we can do :(
+    if cwd is None:
+        cwd = os.getcwd()
     filenameParts = filename.split(os.path.sep)
-    cwdParts = os.getcwd().split(os.path.sep)
+    cwdParts = cwd.split(os.path.sep)
     longest = min(len(filenameParts), len(cwdParts))
     for i in range(longest):
         if filenameParts[i] != cwdParts[i]:
@@ -84,12 +192,42 @@ def filename_to_suite_name_parts(filename):
         return suiteNameParts
 
 
+class SuiteNamePartsCache(object):
+    """Memoizes ``filename_to_suite_name_parts()`` per filename.
+
+    The result depends on the current working directory, so the cache works
+    from a snapshot of it which is passed to ``refresh()``. The cache is only
+    cleared when that directory actually changes.
+    """
+
+    def __init__(self):
+        self.cwd = None
+        self._parts = {}
+
+    def refresh(self, cwd):
+        if cwd != self.cwd:
+            self.cwd = cwd
+            self._parts = {}
+
+    def __call__(self, filename):
+        if self.cwd is None:
+            return filename_to_suite_name_parts(filename)
+        try:
+            return self._parts[filename]
+        except KeyError:
+            parts = self._parts[filename] = filename_to_suite_name_parts(
+                filename, self.cwd)
+            return parts
+
+suite_name_parts = SuiteNamePartsCache()
+
+
 def parse_doc_file_case(test):
     if not isinstance(test, doctest.DocFileCase):
         return None, None, None
 
     filename = test._dt_test.filename
-    suiteNameParts = filename_to_suite_name_parts(filename)
+    suiteNameParts = suite_name_parts(filename)
     testSuite = 'doctest-' + '-'.join(suiteNameParts)
     testName = test._dt_test.name
     testClassName = '.'.join(suiteNameParts[:-1])
@@ -107,11 +245,20 @@ def parse_doc_test_case(test):
     return testSuite, testName, testClassName
 
 
+def get_manuel_test_case_class():
+    """Return manuel's TestCase class, or None if manuel is not in use. There
+    can only be manuel tests if the test modules have imported manuel.
+    """
+
+    return getattr(sys.modules.get('manuel.testing'), 'TestCase', None)
+
+
 def parse_manuel(test):
-    if not (HAVE_MANUEL and isinstance(test, manuel.testing.TestCase)):
+    manuelTestCase = get_manuel_test_case_class()
+    if manuelTestCase is None or not isinstance(test, manuelTestCase):
         return None, None, None
     filename = test.regions.location
-    suiteNameParts = filename_to_suite_name_parts(filename)
+    suiteNameParts = suite_name_parts(filename)
     testSuite = 'manuel-' + '-'.join(suiteNameParts)
     testName = suiteNameParts[-1]
     testClassName = '.'.join(suiteNameParts[:-1])
@@ -128,19 +275,249 @@ def parse_unittest(test):
     return testSuite, testName, testClassName
 
 
+def select_parser(testType):
+    """Pick the function used to compute the suite, test and class names for
+    tests of the given type.
+    """
+
+    # DocFileCase is a subclass of DocTestCase, so check for it first
+    if issubclass(testType, doctest.DocFileCase):
+        return parse_doc_file_case
+    if issubclass(testType, doctest.DocTestCase):
+        return parse_doc_test_case
+    manuelTestCase = get_manuel_test_case_class()
+    if manuelTestCase is not None and issubclass(testType, manuelTestCase):
+        return parse_manuel
+    return parse_unittest
+
+
+class TestParser(object):
+    """Computes the suite, test and class names of a test. The parse function
+    only depends on the type of the test, so it is looked up once per type.
+    """
+
+    def __init__(self):
+        self._parsers = {} # test type -> parse function
+
+    def __call__(self, test):
+        testType = test.__class__
+        parser = self._parsers.get(testType)
+        if parser is None:
+            parser = self._parsers[testType] = select_parser(testType)
+        return parser(test)
+
+
+def make_test_suite_node(name, suite, timestamp, hostname, properties={}):
+    """Build the ``<testsuite />`` element for the given TestSuiteInfo.
+    """
+
+    from lxml import etree
+
+    testSuiteNode = etree.Element('testsuite')
+
+    testSuiteNode.set('tests', str(suite.tests))
+    testSuiteNode.set('errors', str(suite.errors))
+    testSuiteNode.set('failures', str(suite.failures))
+    testSuiteNode.set('hostname', hostname)
+    testSuiteNode.set('name', name)
+    testSuiteNode.set('time', str(suite.time))
+    testSuiteNode.set('timestamp', timestamp)
+
+    propertiesNode = etree.Element('properties')
+    testSuiteNode.append(propertiesNode)
+
+    for k, v in properties.items():
+        propertyNode = etree.Element('property')
+        propertiesNode.append(propertyNode)
+
+        propertyNode.set('name', k)
+        propertyNode.set('value', v)
+
+    for testCase in suite.testCases:
+        testSuiteNode.append(make_test_case_node(testCase))
+
+    # Output is captured per test case, if at all
+    systemOutNode = etree.Element('system-out')
+    testSuiteNode.append(systemOutNode)
+    systemErrNode = etree.Element('system-err')
+    testSuiteNode.append(systemErrNode)
+
+    return testSuiteNode
+
+
+def make_test_case_node(testCase):
+    """Build the ``<testcase />`` element for the given TestCaseInfo.
+    """
+
+    from lxml import etree
+
+    testCaseNode = etree.Element('testcase')
+
+    testCaseNode.set('classname', testCase.testClassName)
+    testCaseNode.set('name', testCase.testName)
+    testCaseNode.set('time', str(testCase.time))
+
+    if testCase.properties:
+        propertiesNode = etree.SubElement(testCaseNode, 'properties')
+        for name, value in testCase.properties:
+            propertyNode = etree.SubElement(propertiesNode, 'property')
+            propertyNode.set('name', name)
+            propertyNode.set('value', str(value))
+
+    if testCase.error:
+        errorNode = etree.Element('error')
+        testCaseNode.append(errorNode)
+
+        errorNode.set('message', testCase.error.firstLine)
+        errorNode.set('type', testCase.error.type)
+        errorNode.text = testCase.error.text
+
+    if testCase.failure:
+
+        failureNode = etree.Element('failure')
+        testCaseNode.append(failureNode)
+
+        failureNode.set('message', testCase.failure.firstLine)
+        failureNode.set('type', testCase.failure.type)
+        failureNode.text = testCase.failure.text
+
+    if testCase.systemOut is not None or testCase.systemErr is not None:
+        from corejet.testrunner.capture import output_text
+
+        for tag, output in (('system-out', testCase.systemOut,),
+                            ('system-err', testCase.systemErr,),):
+            if output is not None:
+                outputNode = etree.SubElement(testCaseNode, tag)
+                outputNode.text = output_text(output)
+
+    return testCaseNode
+
+
 class CoreJetOutputFormattingWrapper(object):
     """Output formatter which delegates to another formatter for all
     operations, but also prepares an element tree of test output.
+
+    ``observers`` are notified of each test: ``startTest(test)`` is called
+    just before the test runs, ``stopTest(test)`` as soon as its result is
+    known (in reverse order, so that the observers are nested), and
+    ``recordTest(suiteName, testCase)`` with the TestCaseInfo that is about
+    to be recorded for it, e.g. to add properties. ``stopTest()`` is called
+    again when the test has finished, and should do nothing if it has
+    already been called.
     """
 
-    def __init__(self, delegate, cwd):
+    def __init__(self, delegate, cwd, xmlStream=False, retainTestCases=True,
+                 tracebackLimit=None, resolveScenarios=True, xmlWorkers=1,
+                 observers=(), xmlFile=None, failureHistory=None,
+                 events=None):
         self.delegate = delegate
+        self.observers = list(observers)
         self._testSuites = {} # test class -> list of test names
         self.cwd = cwd
+        self.tracebackLimit = tracebackLimit
+        self.resolveScenarios = resolveScenarios
+        if resolveScenarios:
+            # corejet.robot registers CoreJet-adapters for Robot Framework
+            # tests, which are needed as soon as tests are recorded
+            # XXX: there should be a more dynamic way to configure plugin
+            # adapters
+            try:
+                import corejet.robot
+            except ImportError:
+                pass
+        self.xmlWorkers = xmlWorkers
+        # If set, all suites are written to this one file (see
+        # corejet.testrunner.consolidated) instead of to testreports
+        self.xmlFile = xmlFile
+        # Told about every test case recorded or merged, see
+        # corejet.testrunner.failures
+        self.failureHistory = failureHistory
+        # Sent the start and result of each test and layer transitions, see
+        # corejet.testrunner.events
+        self.events = events
+        self._parseTest = TestParser()
+
+        # In streaming mode, each <testcase /> is written out as soon as it
+        # has been recorded. Test cases then only need to be kept in memory
+        # if something else (i.e. the CoreJet report) needs them later.
+        self.retainTestCases = retainTestCases
+        self._xmlStream = None
+        if xmlStream:
+            from corejet.testrunner.stream import StreamingXMLReportWriter
+
+            reportsDir = os.path.join(cwd, 'testreports')
+            if xmlFile:
+                # The suites are streamed to their own files as usual, and
+                # combined into the one file at the end
+                directory = os.path.dirname(xmlFile)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                reportsDir = tempfile.mkdtemp(
+                    dir=directory, prefix='.' + os.path.basename(xmlFile))
+
+            self._xmlStream = StreamingXMLReportWriter(
+                reportsDir,
+                timestamp=datetime.datetime.now().isoformat(),
+                hostname=socket.gethostname())
 
     def __getattr__(self, name):
         return getattr(self.delegate, name)
 
+    def start_test(self, test, tests_run, total_tests):
+        result = self.delegate.start_test(test, tests_run, total_tests)
+        for observer in self.observers:
+            observer.startTest(test)
+        if self.events is not None:
+            self.events.testStarted(test, tests_run, total_tests)
+        return result
+
+    def stop_test(self, test):
+        # Normally, observers have already been told when the result was
+        # recorded; this is for tests which ended without a result, e.g.
+        # because they were interrupted
+        for observer in reversed(self.observers):
+            observer.stopTest(test)
+        return self.delegate.stop_test(test)
+
+    def start_set_up(self, layer_name):
+        if self.events is not None:
+            self.events.emit('layer-setup', layer=layer_name)
+        return self.delegate.start_set_up(layer_name)
+
+    def stop_set_up(self, seconds):
+        if self.events is not None:
+            self.events.emit('layer-setup-done', seconds=seconds)
+        return self.delegate.stop_set_up(seconds)
+
+    def start_tear_down(self, layer_name):
+        if self.events is not None:
+            self.events.emit('layer-teardown', layer=layer_name)
+        return self.delegate.start_tear_down(layer_name)
+
+    def stop_tear_down(self, seconds):
+        if self.events is not None:
+            self.events.emit('layer-teardown-done', seconds=seconds)
+        return self.delegate.stop_tear_down(seconds)
+
+    def tear_down_not_supported(self):
+        if self.events is not None:
+            self.events.emit('layer-teardown-unsupported')
+        return self.delegate.tear_down_not_supported()
+
+    def summary(self, n_tests, n_failures, n_errors, n_seconds):
+        if self.events is not None:
+            self.events.emit('layer-summary', tests=n_tests,
+                             failures=n_failures, errors=n_errors,
+                             seconds=n_seconds)
+        return self.delegate.summary(n_tests, n_failures, n_errors,
+                                     n_seconds)
+
+    def totals(self, n_tests, n_failures, n_errors, n_seconds):
+        if self.events is not None:
+            self.events.emit('totals', tests=n_tests, failures=n_failures,
+                             errors=n_errors, seconds=n_seconds)
+        return self.delegate.totals(n_tests, n_failures, n_errors, n_seconds)
+
     def test_failure(self, test, seconds, exc_info):
         self._record(test, seconds, failure=exc_info)
         return self.delegate.test_failure(test, seconds, exc_info)
@@ -154,138 +531,207 @@ class CoreJetOutputFormattingWrapper(object):
         return self.delegate.test_success(test, seconds)
 
     def _record(self, test, seconds, failure=None, error=None):
-        
+
+        for observer in reversed(self.observers):
+            observer.stopTest(test)
+
         try:
-            os.getcwd()
+            cwd = os.getcwd()
         except OSError:
             # In case the current directory is no longer available fallback to
             # the default working directory.
             os.chdir(self.cwd)
+            cwd = self.cwd
 
-        for parser in [parse_doc_file_case,
-                       parse_doc_test_case,
-                       parse_manuel,
-                       parse_unittest]:
-            testSuite, testName, testClassName = parser(test)
-            if (testSuite, testName, testClassName) != (None, None, None):
-                break
+        suite_name_parts.refresh(cwd)
+
+        testSuite, testName, testClassName = self._parseTest(test)
 
         if (testSuite, testName, testClassName) == (None, None, None):
             raise TypeError(
                 "Unknown test type: Could not compute testSuite, testName, "
                 "testClassName: %r" % test)
 
-        suite = self._testSuites.setdefault(testSuite, TestSuiteInfo())
-        suite.testCases.append(TestCaseInfo(
-            test, seconds, testClassName, testName, failure, error))
-
         if failure is not None:
-            suite.failures += 1
+            failure = format_exception_info(failure, self.tracebackLimit)
 
         if error is not None:
+            error = format_exception_info(error, self.tracebackLimit)
+
+        scenario = None
+        if self.resolveScenarios:
+            scenario = resolve_scenario(test)
+
+        testSuite = intern_name(testSuite)
+        testCase = TestCaseInfo(seconds, intern_name(testClassName),
+                                testName, failure, error, scenario)
+
+        for observer in self.observers:
+            observer.recordTest(testSuite, testCase)
+
+        if self.events is not None:
+            self.events.testFinished(testSuite, testCase)
+
+        self._addTestCase(testSuite, testCase)
+
+    def _addTestCase(self, testSuite, testCase):
+        suite = self._testSuites.get(testSuite)
+        if suite is None:
+            suite = self._testSuites[testSuite] = TestSuiteInfo()
+
+        suite.tests += 1
+
+        if testCase.failure is not None:
+            suite.failures += 1
+
+        if testCase.error is not None:
             suite.errors += 1
 
-        if seconds:
-            suite.time += seconds
+        if testCase.time:
+            suite.time += testCase.time
+
+        if self.failureHistory is not None:
+            self.failureHistory.add(testSuite, testCase)
+
+        if self._xmlStream is not None:
+            self._xmlStream.write(
+                testSuite, suite, make_test_case_node(testCase))
+
+        if self.retainTestCases:
+            suite.testCases.append(testCase)
+
+    def iterTestCases(self):
+        """Iterate over ``(suite name, TestCaseInfo)`` for each recorded test
+        case, unless test cases are not being retained.
+        """
+
+        for name, suite in self._testSuites.items():
+            for testCase in suite.testCases:
+                yield name, testCase
+
+    def iterTestSuites(self):
+        """Iterate over ``(suite name, TestSuiteInfo)`` for each suite.
+        """
+
+        return self._testSuites.iteritems()
+
+    def writeFragment(self, directory, name):
+        """Save the results recorded so far to a file in ``directory``, so
+        that they can be merged into the results of another process. The
+        name is used to order fragments when they are merged.
+
+        This is used when layers are run in subprocesses: each child writes a
+        fragment, and the parent merges them before writing any reports.
+        """
+
+        filename = os.path.join(directory, '%s%s' % (name, FRAGMENT_SUFFIX))
+        write_file_atomically(filename, cPickle.dumps(
+            self._testSuites, cPickle.HIGHEST_PROTOCOL))
+
+    def mergeFragments(self, directory):
+        """Merge the results from all fragments in ``directory``, in order of
+        their names, as if the tests had been recorded by this process.
+        """
+
+        names = [name for name in os.listdir(directory)
+                 if name.endswith(FRAGMENT_SUFFIX)]
+        names.sort()
+
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as stream:
+                testSuites = cPickle.load(stream)
+
+            for testSuite, suite in testSuites.items():
+                for testCase in suite.testCases:
+                    self._addTestCase(intern_name(testSuite), testCase)
 
     def writeXMLReports(self, properties={}):
 
+        if self._xmlStream is not None:
+            # Test cases have already been written; just finish the files
+            self.finishXMLStream(properties)
+            return
+
+        from lxml import etree
+        from multiprocessing.pool import ThreadPool
+
         timestamp = datetime.datetime.now().isoformat()
         hostname = socket.gethostname()
 
+        def serializeSuite(item):
+            name, suite = item
+            testSuiteNode = make_test_suite_node(
+                name, suite, timestamp, hostname, properties)
+            return etree.tostring(testSuiteNode, pretty_print=True)
+
+        suites = self._testSuites.items()
+        workers = min(self.xmlWorkers, len(suites))
+
+        if self.xmlFile:
+            self._writeConsolidatedReport(serializeSuite, workers)
+            return
+
         workingDir = os.getcwd()
         reportsDir = os.path.join(workingDir, 'testreports')
         if not os.path.exists(reportsDir):
             os.mkdir(reportsDir)
 
-        for name, suite in self._testSuites.items():
+        def writeSuite(item):
+            name, suite = item
             filename = os.path.join(reportsDir, name + '.xml')
-
-            testSuiteNode = etree.Element('testsuite')
-
-            testSuiteNode.set('tests', str(suite.tests))
-            testSuiteNode.set('errors', str(suite.errors))
-            testSuiteNode.set('failures', str(suite.failures))
-            testSuiteNode.set('hostname', hostname)
-            testSuiteNode.set('name', name)
-            testSuiteNode.set('time', str(suite.time))
-            testSuiteNode.set('timestamp', timestamp)
-
-            propertiesNode = etree.Element('properties')
-            testSuiteNode.append(propertiesNode)
-
-            for k, v in properties.items():
-                propertyNode = etree.Element('property')
-                propertiesNode.append(propertyNode)
-
-                propertyNode.set('name', k)
-                propertyNode.set('value', v)
-
-            for testCase in suite.testCases:
-                testCaseNode = etree.Element('testcase')
-                testSuiteNode.append(testCaseNode)
-
-                testCaseNode.set('classname', testCase.testClassName)
-                testCaseNode.set('name', testCase.testName)
-                testCaseNode.set('time', str(testCase.time))
-
-                if testCase.error:
-                    errorNode = etree.Element('error')
-                    testCaseNode.append(errorNode)
-
-                    try:
-                        excType, excInstance, tb = testCase.error
-                        errorMessage = str(excInstance)
-                        stackTrace = ''.join(traceback.format_tb(tb))
-                    finally: # Avoids a memory leak
-                        del tb
-
-                    errorNode.set('message', errorMessage.split('\n')[0])
-                    errorNode.set('type', str(excType))
-                    errorNode.text = errorMessage + '\n\n' + stackTrace
-
-                if testCase.failure:
-
-                    failureNode = etree.Element('failure')
-                    testCaseNode.append(failureNode)
-
-                    try:
-                        excType, excInstance, tb = testCase.failure
-                        errorMessage = str(excInstance)
-                        stackTrace = ''.join(traceback.format_tb(tb))
-                    finally: # Avoids a memory leak
-                        del tb
-
-                    failureNode.set('message', errorMessage.split('\n')[0])
-                    failureNode.set('type', str(excType))
-                    failureNode.text = errorMessage + '\n\n' + stackTrace
-
-            # XXX: We don't have a good way to capture these yet
-            systemOutNode = etree.Element('system-out')
-            testSuiteNode.append(systemOutNode)
-            systemErrNode = etree.Element('system-err')
-            testSuiteNode.append(systemErrNode)
-
-            # Write file
-            outputFile = open(filename, 'w')
-            outputFile.write(etree.tostring(testSuiteNode, pretty_print=True))
-            outputFile.close()
+            write_file_atomically(filename, serializeSuite(item))
+
+        if workers > 1:
+            # lxml releases the GIL while serializing, and the rest is I/O
+            pool = ThreadPool(workers)
+            try:
+                pool.map(writeSuite, suites)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for item in suites:
+                writeSuite(item)
+
+    def finishXMLStream(self, properties={}):
+        """Finish the reports written with ``--xml-stream``, unless that has
+        been done already. This is also called when the run is interrupted,
+        so that the ``--xml-file`` report holds the tests run so far and the
+        temporary directory its suites were streamed to is removed.
+        """
+
+        if self._xmlStream is None or self._xmlStream.closed:
+            return
+
+        self._xmlStream.close(properties)
+        if self.xmlFile:
+            try:
+                self._writeConsolidatedReport(self._readStreamedSuite, 1)
+            finally:
+                shutil.rmtree(self._xmlStream.reportsDir, True)
+
+    def _writeConsolidatedReport(self, serialize, workers):
+        from corejet.testrunner.consolidated import write_consolidated_report
+
+        # Sorted, so that the report does not depend on the order in which
+        # the tests were run
+        suites = sorted(self._testSuites.items())
+        write_consolidated_report(self.xmlFile, suites, serialize, workers)
+
+    def _readStreamedSuite(self, item):
+        name, suite = item
+        with open(self._xmlStream.reportFilename(name), 'rb') as stream:
+            return stream.read()
     
-    def writeCoreJetReports(self, source, directory=None, filename='corejet.xml'):
+    def writeCoreJetReports(self, source, directory=None, filename='corejet.xml',
+                            incremental=False, cache=None, catalogue=None):
 
-        # corejet.robot registers CoreJet-adapters for Robot Framework tests
-        # XXX: there should be a more dynamic way to configure plugin adapters
-        try:
-            import corejet.robot
-        except ImportError:
-            pass
-        
-        try:
-            sourceType, sourceOptions = source.split(',', 1)
-        except ValueError:
-            # need more than 1 value to unpack
-            sourceType = source.strip()
-            sourceOptions = ''
+        from corejet.visualization import generateReportFromCatalogue
+
+        from corejet.testrunner.catalogue import load_catalogue
+        from corejet.testrunner.matching import add_superfluous_scenarios
+        from corejet.testrunner.matching import match_catalogue
+        from corejet.testrunner.report import update_corejet_report
         
         # Prepare output directory
         if directory is None:
@@ -294,95 +740,38 @@ class CoreJetOutputFormattingWrapper(object):
         
         print "Writing CoreJet report to %s" % directory
         
-        functionName = None
-        
-        for ep in pkg_resources.iter_entry_points('corejet.repositorysource'):
-            if ep.name == sourceType and len(ep.attrs) > 0:
-                functionName = "%s.%s" % (ep.module_name, ep.attrs[0],)
-                break
-        
-        if not functionName:
-            raise ValueError("Unknown CoreJet source type %s" % sourceType)
-        
-        sourceFunction = resolve(functionName)
-        catalogue = sourceFunction(sourceOptions)
+        # The catalogue may have been loaded already, e.g. while the tests
+        # were running
+        if catalogue is None:
+            catalogue = load_catalogue(source, cache)
         
         # Set test time
         catalogue.testTime = datetime.datetime.now()
         
-        # Find everything we've done so far
-        
-        testedStories = {} # story name -> {scenario name -> (scenario, info)}
-        
-        for suiteInfo in self._testSuites.values():
-            for caseInfo in suiteInfo.testCases:
-                # look up the story for the test through adaptation:
-                # - for @story-decorated test, the class implements IStory
-                # - for others, the test case may have an adapter for IStory
-                story = IStory(caseInfo.test,
-                               IStory(caseInfo.test.__class__, None))
-                if not story:
-                    continue
-                scenarios = testedStories.setdefault(story.name.strip().lower(), {})
-                
-                # XXX: Relying on _testMethodName here is not very good
-                scenario = getattr(story, caseInfo.test._testMethodName).scenario
-                scenarios[scenario.name.strip().lower()] = (scenario, caseInfo,)
-
-        # Allocate a status to each scenario
-        for epic in catalogue.epics:
-            for story in epic.stories:
-                
-                testedStory = testedStories.get(story.name.strip().lower(), {})
-                
-                for scenario in story.scenarios:
-                    scenario.status = "pending"
-                    
-                    testedScenario, info = testedStory.get(scenario.name.strip().lower(), (None, None,))
-                    
-                    # Check for pass/fail
-                    if info is not None:
-                        if info.failure or info.error:
-                            scenario.status = "fail"
-                        else:
-                            scenario.status = "pass"
-                        
-                        # Init 'global' steps when they are missing
-                        setattr(story, "givens", getattr(story, "givens", []))
-                        setattr(story, "thens", getattr(story, "thens", []))
-                        setattr(story, "givens", getattr(story, "givens", []))
-
-                        # Check for mismatch
-                        if (
-                            len(story.givens + scenario.givens) != len(testedScenario.givens) or
-                            len(story.whens + scenario.whens) != len(testedScenario.whens) or
-                            len(story.thens + scenario.thens) != len(testedScenario.thens)
-                        ):
-                            scenario.status = "mismatch"
-                        
-                        if scenario.status != "mismatch":
-                            for left, right in zip(story.givens + scenario.givens,
-                                                   testedScenario.givens):
-                                if left.text.strip().lower() != right.text.strip().lower():
-                                    scenario.status = "mismatch"
-                                    break
-                        
-                        if scenario.status != "mismatch":
-                            for left, right in zip(story.whens + scenario.whens,
-                                                   testedScenario.whens):
-                                if left.text.strip().lower() != right.text.strip().lower():
-                                    scenario.status = "mismatch"
-                                    break
-                        
-                        if scenario.status != "mismatch":
-                            for left, right in zip(story.thens + scenario.thens,
-                                                   testedScenario.thens):
-                                if left.text.strip().lower() != right.text.strip().lower():
-                                    scenario.status = "mismatch"
-                                    break
-        
-        # TODO: We don't handle superfluous tests yet
-        
+        # Allocate a status to each scenario, and report tested scenarios
+        # which are not in the catalogue
+        superfluous = match_catalogue(
+            catalogue, (caseInfo for suiteName, caseInfo
+                        in self.iterTestCases()))
+        count = add_superfluous_scenarios(catalogue, superfluous)
+        if count:
+            print "%d tested scenarios not found in the catalogue:" % count
+            names = sorted([(testedScenario.scenario.storyName,
+                             testedScenario.scenario.scenarioName,)
+                            for testedStory in superfluous.values()
+                            for testedScenario in testedStory.values()])
+            for storyName, scenarioName in names[:SUPERFLUOUS_LISTED]:
+                print "  %s: %s" % (storyName, scenarioName,)
+            if count > SUPERFLUOUS_LISTED:
+                print "  ... and %d more" % (count - SUPERFLUOUS_LISTED)
+
+        if incremental:
+            changed, total, written = update_corejet_report(
+                catalogue, directory, filename)
+            print "%d of %d stories changed, %d files written" % (
+                changed, total, written,)
+            return
+
         if os.path.exists(directory):
             shutil.rmtree(directory)
             
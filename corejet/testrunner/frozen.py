@@ -0,0 +1,249 @@
+"""A precomputed index of where each top-level module lives, used by scripts
+generated with the recipe's ``freeze`` option.
+
+A buildout script puts every egg in the working set on ``sys.path``. Each
+import of a top-level module then looks for it in every one of those
+directories in turn, which adds up with hundreds of eggs. When the script is
+generated, the recipe records which path entry provides each top-level
+module. At run time, an import hook looks such modules up in the index and
+only searches the one directory; modules that are not in the index are only
+searched for in the path entries that were not indexed, e.g. the standard
+library.
+
+Anything the index cannot answer with certainty, such as namespace packages
+spread over several eggs, zipped eggs or a ``sys.path`` that no longer starts
+with the indexed entries, is left to the normal import machinery.
+"""
+
+import imp
+import marshal
+import os
+import os.path
+import re
+import sys
+import zipfile
+
+INDEX_VERSION = 1
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def module_name(filename, suffixes):
+    """Return the module name for ``filename``, or None if it is not a
+    module.
+    """
+
+    for suffix in suffixes:
+        if filename.endswith(suffix):
+            name = filename[:-len(suffix)]
+            if IDENTIFIER.match(name):
+                return name
+            return None
+    return None
+
+
+def list_modules(directory):
+    """Return the names of the top-level modules and packages found in
+    ``directory``, and the names of directories without an ``__init__``
+    module, which may be portions of namespace packages set up by ``.pth``
+    files.
+    """
+
+    suffixes = [suffix for suffix, mode, kind in imp.get_suffixes()]
+
+    names = set()
+    portions = set()
+    for entry in os.listdir(directory):
+        path = os.path.join(directory, entry)
+        if os.path.isdir(path):
+            if not IDENTIFIER.match(entry):
+                continue
+            if [suffix for suffix in suffixes
+                if os.path.isfile(os.path.join(path, '__init__' + suffix))]:
+                names.add(entry)
+            else:
+                portions.add(entry)
+        else:
+            name = module_name(entry, suffixes)
+            if name is not None:
+                names.add(name)
+
+    return names, portions
+
+
+def list_zip_modules(filename):
+    """Return the names of the top-level modules and packages which may be
+    found in the zip file ``filename``.
+    """
+
+    suffixes = ['.py', '.pyc', '.pyo']
+
+    names = set()
+    try:
+        archive = zipfile.ZipFile(filename)
+        try:
+            for entry in archive.namelist():
+                if '/' in entry:
+                    name = entry.split('/', 1)[0]
+                else:
+                    name = module_name(entry, suffixes)
+                if name is not None and IDENTIFIER.match(name):
+                    names.add(name)
+        finally:
+            archive.close()
+    except (IOError, zipfile.BadZipfile,):
+        pass
+    return names
+
+
+def build_index(paths):
+    """Map the name of each top-level module found in ``paths`` to the
+    position of the entry it is found in. Names found in more than one entry
+    (e.g. namespace packages), in zip files (e.g. zipped eggs) or as
+    directories without an ``__init__`` module map to None: the index cannot
+    tell where these will be imported from.
+    """
+
+    index = {}
+    for position, path in enumerate(paths):
+        if os.path.isdir(path):
+            names, portions = list_modules(path)
+        else:
+            names, portions = set(), list_zip_modules(path)
+
+        for name in names:
+            if name in index:
+                index[name] = None
+            else:
+                index[name] = position
+
+        for name in portions:
+            index[name] = None
+
+    return index
+
+
+def write_index(filename, paths):
+    """Index the modules in ``paths``, the entries of ``sys.path`` added by
+    the generated script, and save the index to ``filename``.
+    """
+
+    # Like the script, only keep the first occurrence of each entry
+    unique = []
+    for path in paths:
+        path = normalize_path(os.path.realpath(path))
+        if path not in unique:
+            unique.append(path)
+    paths = unique
+
+    data = {'version': INDEX_VERSION,
+            'paths': paths,
+            'modules': build_index(paths)}
+
+    stream = open(filename, 'wb')
+    try:
+        marshal.dump(data, stream)
+    finally:
+        stream.close()
+
+
+class IndexedLoader(object):
+
+    def __init__(self, file, pathname, description):
+        self.file = file
+        self.pathname = pathname
+        self.description = description
+
+    def load_module(self, fullname):
+        try:
+            return imp.load_module(fullname, self.file, self.pathname,
+                                   self.description)
+        finally:
+            if self.file is not None:
+                self.file.close()
+
+
+class IndexedFinder(object):
+    """A ``sys.meta_path`` hook finding top-level modules through the index.
+    ``paths`` are the indexed entries at the start of ``sys.path``, as they
+    appear there.
+    """
+
+    def __init__(self, paths, modules):
+        self.paths = list(paths)
+        self.indexed = set(paths)
+        self.modules = modules
+
+    def find_module(self, fullname, path=None):
+        # Submodules are found through their package's __path__
+        if path is not None or '.' in fullname:
+            return None
+
+        if imp.is_builtin(fullname) or imp.is_frozen(fullname):
+            return None
+
+        # The index is only valid while sys.path still starts with the
+        # indexed entries, in the same order
+        count = len(self.paths)
+        if sys.path[:count] != self.paths:
+            return None
+
+        if fullname in self.modules:
+            location = self.modules[fullname]
+            if location is None:
+                return None
+            search = [location]
+        else:
+            search = [p for p in sys.path[count:] if p not in self.indexed]
+
+        try:
+            file, pathname, description = imp.find_module(fullname, search)
+        except ImportError:
+            # e.g. a module added since the index was built, or one in a zip
+            # file; let the normal import machinery look for it
+            return None
+
+        return IndexedLoader(file, pathname, description)
+
+
+def install_index(filename):
+    """Install the import hook for the index saved in ``filename``. Does
+    nothing if the index cannot be used.
+    """
+
+    try:
+        stream = open(filename, 'rb')
+        try:
+            data = marshal.load(stream)
+        finally:
+            stream.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError,):
+        return None
+
+    if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+        return None
+
+    # The script may have been moved, or the environment changed, since
+    # the index was built. Depending on the version of zc.buildout, the
+    # script's paths may or may not have had symlinks resolved.
+    count = len(data['paths'])
+    paths = sys.path[:count]
+    if ([normalize_path(path) for path in paths] != data['paths'] and
+        [normalize_path(os.path.realpath(path)) for path in paths] !=
+            data['paths']):
+        return None
+
+    modules = {}
+    for name, position in data['modules'].items():
+        if position is None:
+            modules[name] = None
+        else:
+            modules[name] = paths[position]
+
+    finder = IndexedFinder(paths, modules)
+    sys.meta_path.insert(0, finder)
+    return finder
@@ -0,0 +1,389 @@
+"""Selecting the tests affected by a change, from the files each test runs.
+
+With ``--impact``, the source files whose code runs during each test are
+recorded in a test impact map (``impact.json`` in the working directory). A
+trace function set with ``sys.settrace()`` is called each time a function
+starts, and only notes the file it belongs to; it does not trace lines, so
+tests run only a little slower. The test's own module, doctest file or
+manuel document is always included. Only files in the working tree are
+kept, as paths relative to its root (the top of the git checkout, or the
+working directory outside of git), so that they can be compared with the
+output of ``git diff``. Code run by other threads is not seen.
+
+With ``--changed-since=REV`` or ``--changed-files=FILE``, only the tests
+which ran code in any of the changed files are run, along with the tests
+which are not in the map yet, e.g. because they are new. Layers without any
+of these tests are not set up at all.
+
+The map is updated with the tests run each time it is recorded; tests which
+did not run keep their entry. Changes which the tracer cannot see, e.g. to
+configuration files or to module level code which only runs on import, do
+not select any tests, so the full suite should still run now and then.
+"""
+
+from __future__ import with_statement
+
+import json
+import os
+import os.path
+import posixpath
+import subprocess
+import sys
+
+import zope.testrunner.feature
+
+from corejet.testrunner.formatter import TestParser
+from corejet.testrunner.formatter import get_manuel_test_case_class
+from corejet.testrunner.utils import write_file_atomically
+
+IMPACT_VERSION = 1
+
+# Extension of the files holding the maps recorded by subprocesses
+IMPACT_SUFFIX = '.impact'
+
+# File in which the parent passes the changed files on to subprocesses
+CHANGED_FILES = 'changed-files.txt'
+
+
+def find_root(directory):
+    """Return the top of the git checkout containing ``directory``, or
+    ``directory`` itself if it is not in one.
+    """
+
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--show-toplevel'],
+                                   cwd=directory, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, error = process.communicate()
+    except OSError: # no git
+        return os.path.realpath(directory)
+    if process.returncode != 0:
+        return os.path.realpath(directory)
+    return os.path.realpath(output.strip())
+
+
+def git_changed_files(revision, directory):
+    """Return the files changed in the working tree since ``revision``, as
+    paths relative to the root of the checkout. Raises ValueError if git
+    fails.
+    """
+
+    # Without renames, both the old and the new name of a moved file count
+    try:
+        process = subprocess.Popen(['git', 'diff', '--name-only',
+                                    '--no-renames', revision, '--'],
+                                   cwd=directory, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, error = process.communicate()
+    except OSError, e:
+        raise ValueError("Cannot run git: %s" % e)
+    if process.returncode != 0:
+        raise ValueError(error.strip() or "git diff failed")
+    return [line for line in output.splitlines() if line]
+
+
+def read_changed_files(filename):
+    """Return the paths listed in ``filename``, one per line, e.g. the
+    output of ``git diff --name-only``. ``-`` reads standard input.
+    """
+
+    if filename == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(filename, 'rb') as stream:
+            lines = stream.readlines()
+    return [posixpath.normpath(line.strip().replace(os.path.sep, '/'))
+            for line in lines if line.strip()]
+
+
+def test_source_files(test):
+    """Return the files a test is defined in: its module, and its doctest
+    file or manuel document, if any.
+    """
+
+    filenames = []
+
+    docTest = getattr(test, '_dt_test', None)
+    if docTest is not None and docTest.filename:
+        filenames.append(docTest.filename)
+
+    manuelTestCase = get_manuel_test_case_class()
+    if manuelTestCase is not None and isinstance(test, manuelTestCase):
+        filenames.append(test.regions.location)
+
+    module = sys.modules.get(test.__class__.__module__)
+    filename = getattr(module, '__file__', None)
+    if filename:
+        if filename.endswith(('.pyc', '.pyo',)):
+            filename = filename[:-1]
+        filenames.append(filename)
+
+    return filenames
+
+
+class ImpactMap(object):
+    """The files run by each test, saved as JSON in ``filename``.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._tests = None
+
+    @property
+    def tests(self):
+        """A dict mapping ``(suite, classname, name)`` to the files the test
+        ran, as a tuple of paths relative to the root of the working tree.
+        """
+
+        if self._tests is None:
+            self._tests = self.load()
+        return self._tests
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return {}
+
+        try:
+            with open(self.filename, 'rb') as stream:
+                data = json.load(stream)
+        except (IOError, ValueError,):
+            return {}
+
+        if not isinstance(data, dict) or data.get(
+                'version') != IMPACT_VERSION:
+            return {}
+
+        # Each file is listed once, and tests refer to it by its index.
+        # Names are str, unless a test explicitly uses unicode.
+        files = [path.encode('utf-8') for path in data['files']]
+        return dict([((suite.encode('utf-8'), classname.encode('utf-8'),
+                       name.encode('utf-8'),),
+                      tuple([files[index] for index in indexes]),)
+                     for suite, classname, name, indexes in data['tests']])
+
+    def update(self, tests):
+        """Replace the entries of the given tests, a dict like ``tests``.
+        """
+
+        self.tests.update(tests)
+
+    def save(self):
+        indexes = {}
+        files = []
+        entries = []
+        for key, paths in sorted(self.tests.items()):
+            entry = []
+            for path in sorted(paths):
+                index = indexes.get(path)
+                if index is None:
+                    index = indexes[path] = len(files)
+                    files.append(path)
+                entry.append(index)
+            entries.append(list(key) + [entry])
+
+        write_file_atomically(self.filename, json.dumps({
+            'version': IMPACT_VERSION,
+            'files': files,
+            'tests': entries,
+        }, separators=(',', ':',)))
+
+
+class ImpactRecorder(zope.testrunner.feature.Feature):
+    """Record the files run by each test, and add them to the impact map.
+
+    This is a test observer (see ``CoreJetOutputFormattingWrapper``) as well
+    as a feature of the test runner.
+    """
+
+    def __init__(self, runner, impactMap, root):
+        super(ImpactRecorder, self).__init__(runner)
+        self.active = True
+        self.impactMap = impactMap
+        self.root = root + os.path.sep
+
+        self.previousTrace = None
+        self.tracing = None # code file names, while a test runs
+        self.testFiles = None
+        self.finished = None
+        self.paths = {} # code file name -> path in the working tree, or None
+        self.tests = {} # (suite, classname, name) -> paths
+
+    # Test observer
+
+    def startTest(self, test):
+        self.stopTest(test)
+        self.finished = None
+        self.testFiles = test_source_files(test)
+
+        filenames = set()
+        add = filenames.add
+
+        def trace(frame, event, arg):
+            # Only called when a function starts; returning None means its
+            # lines are not traced
+            add(frame.f_code.co_filename)
+
+        self.tracing = filenames
+        self.previousTrace = sys.gettrace()
+        sys.settrace(trace)
+
+    def stopTest(self, test):
+        if self.tracing is None:
+            return
+
+        sys.settrace(self.previousTrace)
+        self.previousTrace = None
+        self.finished = self.tracing
+        self.finished.update(self.testFiles)
+        self.tracing = None
+
+    def recordTest(self, suiteName, testCase):
+        # A test may be recorded more than once, e.g. if both the test and
+        # its tearDown() fail; it has only been traced once
+        filenames = self.finished
+        self.finished = None
+        if filenames is None:
+            return
+
+        paths = set()
+        for filename in filenames:
+            path = self.paths.get(filename, False)
+            if path is False:
+                path = self.paths[filename] = self.relativePath(filename)
+            if path is not None:
+                paths.add(path)
+
+        key = (suiteName, testCase.testClassName, testCase.testName,)
+        self.tests[key] = tuple(paths)
+
+    def relativePath(self, filename):
+        """Return the path of ``filename`` relative to the root of the
+        working tree, with forward slashes like git, or None if it is
+        outside of it (or not a file, e.g. ``<doctest ...>``).
+        """
+
+        if filename.startswith('<'):
+            return None
+        filename = os.path.realpath(filename)
+        if not filename.startswith(self.root):
+            return None
+        return filename[len(self.root):].replace(os.path.sep, '/')
+
+    # Subprocesses
+
+    def global_teardown(self):
+        options = self.runner.options
+        directory = self.runner.fragmentsDirectory
+        if options.resume_layer is None or not directory:
+            return
+
+        filename = os.path.join(directory, '%06d%s' % (options.resume_number,
+                                                       IMPACT_SUFFIX,))
+        with open(filename, 'wb') as stream:
+            json.dump([list(key) + [list(paths)]
+                       for key, paths in self.tests.items()], stream)
+
+    def mergeSubprocesses(self, directory):
+        """Add the files recorded by subprocesses in ``directory``.
+        """
+
+        names = [name for name in os.listdir(directory)
+                 if name.endswith(IMPACT_SUFFIX)]
+        names.sort()
+
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as stream:
+                entries = json.load(stream)
+            for suite, classname, testName, paths in entries:
+                key = (suite.encode('utf-8'), classname.encode('utf-8'),
+                       testName.encode('utf-8'),)
+                self.tests[key] = tuple([path.encode('utf-8')
+                                         for path in paths])
+
+    # Reporting
+
+    def report(self):
+        options = self.runner.options
+        if options.resume_layer is not None:
+            return
+
+        if self.runner.fragmentsDirectory:
+            self.mergeSubprocesses(self.runner.fragmentsDirectory)
+
+        if not self.tests:
+            return
+
+        self.impactMap.update(self.tests)
+        self.impactMap.save()
+        options.output.info("Recorded the files run by %d tests in %s" % (
+            len(self.tests), self.impactMap.filename,))
+
+
+class ImpactSelection(zope.testrunner.feature.Feature):
+    """Only run the tests which ran code in any of the ``changed`` files, and
+    those which are not in the impact map.
+
+    The changed files are only found in the parent process, which passes
+    them on to subprocesses in the fragments directory (``changed`` is None
+    there): the standard input cannot be read again, and the working tree
+    may change while the tests run.
+    """
+
+    def __init__(self, runner, impactMap, changed):
+        super(ImpactSelection, self).__init__(runner)
+        self.active = True
+        self.impactMap = impactMap
+        self.changed = frozenset(changed) if changed is not None else None
+        self.selected = 0
+
+    def global_setup(self):
+        options = self.runner.options
+        directory = self.runner.fragmentsDirectory
+        if directory:
+            filename = os.path.join(directory, CHANGED_FILES)
+            if options.resume_layer is None:
+                write_file_atomically(filename, ''.join(
+                    ['%s\n' % path for path in sorted(self.changed)]))
+            elif self.changed is None and os.path.exists(filename):
+                self.changed = frozenset(read_changed_files(filename))
+
+        if self.changed is None:
+            # Not passed on by the parent; rather run all tests than drop any
+            return
+
+        layers = self.runner.tests_by_layer_name
+        impact = self.impactMap.tests
+        changed = self.changed
+        parseTest = TestParser()
+
+        if not impact:
+            if options.resume_layer is None:
+                options.output.info(
+                    "No test impact map found in %s, running all tests" % (
+                        self.impactMap.filename,))
+            return
+
+        def affected(test):
+            testSuite, testName, testClassName = parseTest(test)
+            paths = impact.get((testSuite, testClassName, testName,))
+            # New tests, and any others not recorded yet, always run
+            return paths is None or not changed.isdisjoint(paths)
+
+        total = 0
+        self.selected = 0
+        for layerName, suite in list(layers.items()):
+            tests = list(suite)
+            total += len(tests)
+            tests = [test for test in tests if affected(test)]
+            self.selected += len(tests)
+
+            if tests:
+                layers[layerName] = suite.__class__(tests)
+            else:
+                # Layers without affected tests are never set up
+                del layers[layerName]
+
+        if options.resume_layer is None:
+            options.output.info(
+                "Running %d of %d tests, affected by %d changed files" % (
+                    self.selected, total, len(changed),))
@@ -0,0 +1,164 @@
+"""Match the results of a test run against a CoreJet requirements catalogue.
+
+Story, scenario and step names are compared case-insensitively and ignoring
+surrounding whitespace. Each name is normalized once, and both the tested
+scenarios and the catalogue are indexed by normalized name, so matching takes
+time linear in the number of scenarios and steps.
+"""
+
+from corejet.core.model import Epic
+from corejet.core.model import Scenario
+from corejet.core.model import Step
+from corejet.core.model import Story
+
+# Name and title of the epic holding tested stories which are not in the
+# catalogue
+SUPERFLUOUS_EPIC = ('superfluous', 'Stories not in the catalogue',)
+
+
+def normalize(text):
+    return (text or '').strip().lower()
+
+
+def text_keys(texts):
+    """Return the normalized form of the given step texts as a tuple, e.g.
+    the steps of a tested scenario or the texts of Step objects.
+    """
+
+    # Like normalize(), without a call for each text
+    return tuple([(text or '').strip().lower() for text in texts])
+
+
+class IndexedScenario(object):
+    """A tested scenario with its normalized steps and the result of the test
+    that implements it.
+    """
+
+    __slots__ = ('scenario', 'caseInfo', 'givens', 'whens', 'thens',)
+
+    def __init__(self, scenario, caseInfo):
+        self.scenario = scenario
+        self.caseInfo = caseInfo
+        self.givens = text_keys(scenario.givens)
+        self.whens = text_keys(scenario.whens)
+        self.thens = text_keys(scenario.thens)
+
+
+def index_tested_scenarios(testCases):
+    """Index the tested scenarios among ``testCases``, an iterable of
+    TestCaseInfo objects. Returns a dict mapping normalized story names to
+    dicts mapping normalized scenario names to IndexedScenario objects. If a
+    scenario was tested more than once, the last result wins.
+    """
+
+    index = {}
+    for caseInfo in testCases:
+        scenario = caseInfo.scenario
+        if scenario is None:
+            continue
+        index.setdefault(normalize(scenario.storyName), {})[
+            normalize(scenario.scenarioName)] = IndexedScenario(scenario,
+                                                                caseInfo)
+    return index
+
+
+def match_catalogue(catalogue, testCases):
+    """Set the status of each scenario in ``catalogue`` from the results in
+    ``testCases``: ``pass``, ``fail``, ``mismatch`` if the steps of the test
+    differ from those in the catalogue, or ``pending`` if it was not tested.
+
+    Returns a dict of the tested scenarios not found in the catalogue, in the
+    form returned by ``index_tested_scenarios()``.
+    """
+
+    tested = index_tested_scenarios(testCases)
+    matched = set()
+
+    for epic in catalogue.epics:
+        for story in epic.stories:
+            storyKey = normalize(story.name)
+            testedStory = tested.get(storyKey)
+            if testedStory is None:
+                for scenario in story.scenarios:
+                    scenario.status = "pending"
+                continue
+
+            # Story level steps apply to each scenario of the story
+            storyGivens = text_keys([step.text for step in
+                                     getattr(story, 'givens', [])])
+            storyWhens = text_keys([step.text for step in
+                                    getattr(story, 'whens', [])])
+            storyThens = text_keys([step.text for step in
+                                    getattr(story, 'thens', [])])
+
+            for scenario in story.scenarios:
+                scenarioKey = normalize(scenario.name)
+                testedScenario = testedStory.get(scenarioKey)
+                if testedScenario is None:
+                    scenario.status = "pending"
+                    continue
+
+                matched.add((storyKey, scenarioKey,))
+                caseInfo = testedScenario.caseInfo
+                if (storyGivens + text_keys([step.text for step in
+                                             scenario.givens]) !=
+                        testedScenario.givens or
+                    storyWhens + text_keys([step.text for step in
+                                            scenario.whens]) !=
+                        testedScenario.whens or
+                    storyThens + text_keys([step.text for step in
+                                            scenario.thens]) !=
+                        testedScenario.thens):
+                    scenario.status = "mismatch"
+                elif caseInfo.failure or caseInfo.error:
+                    scenario.status = "fail"
+                else:
+                    scenario.status = "pass"
+
+    superfluous = {}
+    for storyKey, testedStory in tested.items():
+        for scenarioKey, testedScenario in testedStory.items():
+            if (storyKey, scenarioKey,) not in matched:
+                superfluous.setdefault(storyKey, {})[scenarioKey] = \
+                    testedScenario
+    return superfluous
+
+
+def add_superfluous_scenarios(catalogue, superfluous):
+    """Add the tested scenarios which were not found in ``catalogue`` to it,
+    with the status ``superfluous``. Scenarios of known stories are added to
+    the story; unknown stories are added to an extra epic. Returns the number
+    of scenarios added.
+    """
+
+    stories = {}
+    for epic in catalogue.epics:
+        for story in epic.stories:
+            stories.setdefault(normalize(story.name), story)
+
+    extraEpic = None
+    count = 0
+
+    for storyKey, testedStory in sorted(superfluous.items()):
+        story = stories.get(storyKey)
+        for scenarioKey, testedScenario in sorted(testedStory.items()):
+            tested = testedScenario.scenario
+            if story is None:
+                if extraEpic is None:
+                    extraEpic = Epic(*SUPERFLUOUS_EPIC)
+                    catalogue.epics.append(extraEpic)
+                story = Story(tested.storyName, tested.storyName,
+                              epic=extraEpic)
+                extraEpic.stories.append(story)
+                stories[storyKey] = story
+
+            story.scenarios.append(Scenario(
+                tested.scenarioName,
+                givens=[Step(text, 'given') for text in tested.givens],
+                whens=[Step(text, 'when') for text in tested.whens],
+                thens=[Step(text, 'then') for text in tested.thens],
+                status="superfluous",
+                story=story))
+            count += 1
+
+    return count
@@ -0,0 +1,306 @@
+"""Merge the reports written by several test runs, e.g. the shards of a test
+suite run with ``--shard``, into one set of reports that looks as if all the
+tests had been run at once.
+
+This is installed as the ``corejet-merge`` console script::
+
+    $ corejet-merge -o merged shard1/parts/test shard2/parts/test
+
+Each directory given is the working directory of one test run, containing
+the ``testreports`` directory written by ``--xml`` and/or the ``corejet``
+directory written by ``--corejet``. Single report files written with
+``--xml-file`` are merged as well: give them as arguments, or they are found
+next to their index in the directories given. The merged JUnit reports are
+always written to a ``testreports`` directory.
+"""
+
+from __future__ import with_statement
+
+import glob
+import optparse
+import os
+import os.path
+import shutil
+import sys
+
+from lxml import etree
+
+from corejet.core.model import Epic
+from corejet.core.model import RequirementsCatalogue
+from corejet.core.model import Scenario
+from corejet.core.model import Story
+from corejet.visualization import generateReportFromCatalogue
+
+from corejet.testrunner.consolidated import GZIP_SUFFIX
+from corejet.testrunner.consolidated import index_filename
+from corejet.testrunner.consolidated import read_index
+from corejet.testrunner.consolidated import read_suite
+from corejet.testrunner.utils import write_file_atomically
+
+# When the same scenario has been run more than once, the first of these
+# statuses found wins
+STATUS_PRECEDENCE = ['fail', 'mismatch', 'pass', 'superfluous', 'pending']
+
+
+def merge_test_suite_nodes(testSuiteNodes):
+    """Merge several ``<testsuite />`` elements for the same suite into one.
+    """
+
+    merged = etree.Element('testsuite')
+
+    totals = {'tests': 0, 'errors': 0, 'failures': 0}
+    time = 0.0
+    for testSuiteNode in testSuiteNodes:
+        for name in totals:
+            totals[name] += int(testSuiteNode.get(name, 0))
+        time += float(testSuiteNode.get('time', 0))
+
+    first = testSuiteNodes[0]
+    merged.set('tests', str(totals['tests']))
+    merged.set('errors', str(totals['errors']))
+    merged.set('failures', str(totals['failures']))
+    merged.set('hostname', first.get('hostname', ''))
+    merged.set('name', first.get('name', ''))
+    merged.set('time', str(time))
+    merged.set('timestamp', min([node.get('timestamp', '')
+                                 for node in testSuiteNodes]))
+
+    propertiesNode = first.find('properties')
+    if propertiesNode is None:
+        propertiesNode = etree.Element('properties')
+    merged.append(propertiesNode)
+
+    for testSuiteNode in testSuiteNodes:
+        for testCaseNode in testSuiteNode.iterchildren(tag='testcase'):
+            merged.append(testCaseNode)
+
+    for tag in ('system-out', 'system-err',):
+        node = etree.SubElement(merged, tag)
+        text = ''.join([n.text or '' for testSuiteNode in testSuiteNodes
+                                     for n in testSuiteNode.iterchildren(tag=tag)])
+        if text:
+            node.text = text
+
+    return merged
+
+
+def find_consolidated_reports(directory):
+    """Return the report files written with ``--xml-file`` in ``directory``,
+    i.e. those with an index next to them.
+    """
+
+    return [filename
+            for pattern in ('*.xml', '*.xml' + GZIP_SUFFIX,)
+            for filename in sorted(glob.glob(os.path.join(directory, pattern)))
+            if os.path.isfile(index_filename(filename))]
+
+
+def merge_junit_reports(sources, outputDirectory):
+    """Merge the JUnit reports in the given ``testreports`` directories and
+    report files written with ``--xml-file``. Reports for the same suite are
+    combined. Returns the number of reports written.
+    """
+
+    parser = etree.XMLParser(remove_blank_text=True)
+
+    def fileReader(filename):
+        return lambda: etree.parse(filename, parser).getroot()
+
+    def suiteReader(filename, name, index):
+        return lambda: etree.fromstring(read_suite(filename, name, index),
+                                        parser)
+
+    # suite name -> functions returning its <testsuite /> in each source, in
+    # the order of the sources
+    reports = {}
+    for source in sources:
+        if os.path.isdir(source):
+            for filename in sorted(glob.glob(os.path.join(source, '*.xml'))):
+                name = os.path.basename(filename)[:-len('.xml')]
+                reports.setdefault(name, []).append(fileReader(filename))
+        else:
+            index = read_index(source)
+            for entry in index['suites']:
+                reports.setdefault(entry['name'], []).append(
+                    suiteReader(source, entry['name'], index))
+
+    if not os.path.exists(outputDirectory):
+        os.makedirs(outputDirectory)
+
+    # One suite at a time, so that memory use is bounded by the largest suite
+    for name, readers in sorted(reports.items()):
+        testSuiteNodes = [read() for read in readers]
+        write_file_atomically(
+            os.path.join(outputDirectory, name + '.xml'),
+            etree.tostring(merge_test_suite_nodes(testSuiteNodes),
+                           pretty_print=True))
+
+    return len(reports)
+
+
+def scenario_key(story, scenario):
+    return (story.name.strip().lower(), scenario.name.strip().lower(),)
+
+
+def merge_catalogues(catalogues):
+    """Merge CoreJet catalogues with test results into the first one, which
+    is returned. Each scenario gets the most significant status it has in any
+    of the catalogues; scenarios, stories and epics only found in later
+    catalogues are added.
+    """
+
+    merged = catalogues[0]
+
+    epics = {} # epic name -> epic in the merged catalogue
+    stories = {} # story name -> story in the merged catalogue
+    scenarios = {} # scenario key -> scenario in the merged catalogue
+    for epic in merged.epics:
+        epics[epic.name] = epic
+        for story in epic.stories:
+            stories[story.name.strip().lower()] = story
+            for scenario in story.scenarios:
+                scenarios[scenario_key(story, scenario)] = scenario
+
+    for catalogue in catalogues[1:]:
+        if catalogue.testTime and (merged.testTime is None or
+                                   catalogue.testTime > merged.testTime):
+            merged.testTime = catalogue.testTime
+
+        for epic in catalogue.epics:
+            for story in epic.stories:
+                for scenario in story.scenarios:
+                    existing = scenarios.get(scenario_key(story, scenario))
+                    if existing is None:
+                        mergedStory = stories.get(story.name.strip().lower())
+                        if mergedStory is None:
+                            # e.g. a superfluous story only tested in one run
+                            mergedStory = merge_story(merged, epics, epic,
+                                                      story)
+                            stories[story.name.strip().lower()] = mergedStory
+                        existing = Scenario(scenario.name,
+                                            givens=scenario.givens,
+                                            whens=scenario.whens,
+                                            thens=scenario.thens,
+                                            status=scenario.status,
+                                            story=mergedStory)
+                        mergedStory.scenarios.append(existing)
+                        scenarios[scenario_key(story, scenario)] = existing
+                    elif status_rank(scenario.status) < status_rank(existing.status):
+                        existing.status = scenario.status
+
+    return merged
+
+
+def merge_story(merged, epics, epic, story):
+    """Add an empty copy of ``story`` from ``epic`` to the ``merged``
+    catalogue, adding the epic as well if needed. ``epics`` maps epic names
+    to the epics of the merged catalogue.
+    """
+
+    mergedEpic = epics.get(epic.name)
+    if mergedEpic is None:
+        mergedEpic = epics[epic.name] = Epic(epic.name, epic.title)
+        merged.epics.append(mergedEpic)
+
+    mergedStory = Story(story.name, story.title,
+                        givens=story.givens, whens=story.whens,
+                        thens=story.thens, points=story.points,
+                        status=story.status, resolution=story.resolution,
+                        priority=story.priority, epic=mergedEpic)
+    mergedEpic.stories.append(mergedStory)
+    return mergedStory
+
+
+def status_rank(status):
+    try:
+        return STATUS_PRECEDENCE.index(status)
+    except ValueError:
+        return len(STATUS_PRECEDENCE)
+
+
+def merge_corejet_reports(filenames, outputDirectory, filename='corejet.xml'):
+    """Merge the given CoreJet XML files and write the merged XML file and
+    HTML report to ``outputDirectory``.
+    """
+
+    catalogues = []
+    for name in filenames:
+        catalogue = RequirementsCatalogue()
+        with open(name) as stream:
+            catalogue.populate(stream)
+        catalogues.append(catalogue)
+
+    catalogue = merge_catalogues(catalogues)
+
+    if os.path.exists(outputDirectory):
+        shutil.rmtree(outputDirectory)
+
+    os.makedirs(outputDirectory)
+
+    with open(os.path.join(outputDirectory, filename), 'w') as output:
+        catalogue.write(output)
+
+    generateReportFromCatalogue(catalogue, outputDirectory)
+
+
+def main(args=None):
+    """Entry point for the ``corejet-merge`` console script.
+    """
+
+    parser = optparse.OptionParser(
+        usage="%prog [options] DIRECTORY|FILE [DIRECTORY|FILE ...]",
+        description="Merge the JUnit and CoreJet reports written by several "
+                    "test runs. Each DIRECTORY is the working directory of a "
+                    "test run, e.g. parts/test; each FILE is a report written "
+                    "with --xml-file.")
+    parser.add_option(
+        '-o', '--output', dest='output', default=os.getcwd(),
+        metavar="DIRECTORY",
+        help="Directory to write the merged testreports and corejet "
+             "directories to. Defaults to the current directory.")
+
+    options, arguments = parser.parse_args(args)
+    if not arguments:
+        parser.error("No directories to merge given")
+
+    directories = []
+    junitSources = []
+    for argument in arguments:
+        if os.path.isdir(argument):
+            directories.append(argument)
+            testreports = os.path.join(argument, 'testreports')
+            if os.path.isdir(testreports):
+                junitSources.append(testreports)
+            junitSources.extend(find_consolidated_reports(argument))
+        elif os.path.isfile(index_filename(argument)):
+            junitSources.append(argument)
+        else:
+            parser.error("Not a directory or report with an index: %s" % (
+                argument,))
+
+    # A report may be found in a directory and be given as well
+    junitSources = [source for index, source in enumerate(junitSources)
+                    if os.path.realpath(source) not in
+                       [os.path.realpath(other)
+                        for other in junitSources[:index]]]
+
+    if junitSources:
+        count = merge_junit_reports(
+            junitSources, os.path.join(options.output, 'testreports'))
+        print "Merged %d JUnit reports from %d sources" % (
+            count, len(junitSources),)
+
+    corejetFiles = [os.path.join(directory, 'corejet', 'corejet.xml')
+                    for directory in directories
+                    if os.path.isfile(os.path.join(directory, 'corejet',
+                                                   'corejet.xml'))]
+    if corejetFiles:
+        merge_corejet_reports(corejetFiles,
+                              os.path.join(options.output, 'corejet'))
+        print "Merged %d CoreJet reports" % len(corejetFiles)
+
+    if not junitSources and not corejetFiles:
+        print >> sys.stderr, "No reports found"
+        return 1
+
+    return 0
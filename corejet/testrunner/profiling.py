@@ -0,0 +1,377 @@
+"""Profiling each test, with the results aggregated per suite and per layer.
+
+Every test is profiled on its own, either with ``cProfile`` or, to keep the
+overhead down, by sampling the stack at a fixed interval. The profiles of the
+tests which took at least a minimum time are added to the profile of their
+suite and layer. At the end of the run, these are saved as ``pstats`` files,
+together with a summary of the hot spots.
+
+When layers are run in subprocesses, each child saves its profiles in the
+directory shared through the environment (see ``runner.py``), and the parent
+merges them before writing anything.
+"""
+
+from __future__ import with_statement
+
+import cProfile
+import marshal
+import os
+import os.path
+import pstats
+import shutil
+import signal
+import sys
+import time
+
+import zope.testrunner.feature
+
+from zope.testrunner.find import name_from_layer
+
+# Extension of the files holding the profiles of subprocesses
+PROFILE_SUFFIX = '.profile'
+
+# Name of the layer the tests run in before any layer has been set up
+UNKNOWN_LAYER = 'unknown'
+
+# File marking a directory as written by TestProfiling, which is then free to
+# replace it. Other directories of the same name are left alone.
+MARKER = '.corejet-profiles'
+
+
+def is_replaceable(directory):
+    """Whether the profiles may be written to ``directory``, i.e. it does not
+    exist, is empty, or holds the profiles of an earlier run.
+    """
+
+    if not os.path.exists(directory):
+        return True
+    return (os.path.isdir(directory) and
+            (not os.listdir(directory) or
+             os.path.isfile(os.path.join(directory, MARKER))))
+
+
+def safe_filename(name):
+    """Turn a suite or layer name into a file name.
+    """
+
+    return name.replace(os.path.sep, '_').replace('/', '_')
+
+
+class StatsData(object):
+    """Profile data in the form used by ``pstats``: a dict mapping functions
+    to their timings. ``pstats.Stats`` accepts any object with a
+    ``create_stats()`` method and a ``stats`` attribute.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class SamplingProfiler(object):
+    """A statistical profiler, which looks at the stack of the main thread
+    every ``interval`` seconds of CPU time.
+
+    Its results can be loaded into ``pstats.Stats`` like those of
+    ``cProfile``. The call counts are the number of samples a function was
+    seen in. Each sample stands for the CPU time since the previous one,
+    which may be longer than the interval, depending on the resolution of the
+    system's timers.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.outer = None
+        self.previousHandler = None
+        self.lastSample = None
+        self.samples = {} # function -> [samples, time on top, time on stack]
+        self.edges = {} # (caller, callee) -> the same
+
+    def enable(self):
+        # Frames which are already running belong to the test runner, not
+        # to the test; don't record them, just like cProfile
+        outer = set()
+        frame = sys._getframe(1)
+        while frame is not None:
+            outer.add(id(frame))
+            frame = frame.f_back
+        self.outer = outer
+
+        self.lastSample = time.clock()
+        self.previousHandler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previousHandler or signal.SIG_DFL)
+        self.outer = None
+
+    def sample(self, signum, frame):
+        outer = self.outer
+        if outer is None:
+            return
+
+        now = time.clock()
+        elapsed = now - self.lastSample
+        self.lastSample = now
+
+        # Recursive functions and calls only count once per sample
+        seen = set()
+        callee = None
+        depth = 0
+        while frame is not None and id(frame) not in outer:
+            code = frame.f_code
+            function = (code.co_filename, code.co_firstlineno, code.co_name,)
+
+            if function not in seen:
+                seen.add(function)
+                counts = self.samples.get(function)
+                if counts is None:
+                    counts = self.samples[function] = [0, 0.0, 0.0]
+                counts[0] += 1
+                if depth == 0:
+                    counts[1] += elapsed
+                counts[2] += elapsed
+
+            if callee is not None and (function, callee,) not in seen:
+                edge = (function, callee,)
+                seen.add(edge)
+                counts = self.edges.get(edge)
+                if counts is None:
+                    counts = self.edges[edge] = [0, 0.0, 0.0]
+                counts[0] += 1
+                if depth == 1:
+                    counts[1] += elapsed
+                counts[2] += elapsed
+
+            callee = function
+            frame = frame.f_back
+            depth += 1
+
+    def create_stats(self):
+        callers = {}
+        for (caller, callee), (count, top, total) in self.edges.items():
+            callers.setdefault(callee, {})[caller] = (count, count, top,
+                                                      total,)
+
+        self.stats = dict([
+            (function, (count, count, top, total,
+                        callers.get(function, {}),),)
+            for function, (count, top, total) in self.samples.items()])
+
+
+class ProfileGroup(object):
+    """The combined profile of the tests in a suite or layer, as a
+    ``pstats.Stats`` object, which cannot be empty.
+    """
+
+    __slots__ = ('stats', 'tests',)
+
+    def __init__(self):
+        self.stats = None
+        self.tests = 0
+
+    def add(self, data, tests=1):
+        """Add profile data, as a dict in the form used by ``pstats``.
+        """
+
+        if self.stats is None:
+            # Stats objects update their dict in place, and the same data
+            # is added to both the suite and the layer
+            self.stats = pstats.Stats(StatsData(dict(data)))
+        else:
+            self.stats.add(StatsData(data))
+        self.tests += tests
+
+
+class TestProfiling(zope.testrunner.feature.Feature):
+    """Profile each test, and aggregate the profiles by suite and layer.
+
+    This is a test observer (see ``CoreJetOutputFormattingWrapper``) as well
+    as a feature of the test runner.
+    """
+
+    def __init__(self, runner, directory, interval=None, minimum=0.0,
+                 top=20):
+        super(TestProfiling, self).__init__(runner)
+        self.active = True
+        self.directory = directory
+        self.interval = interval
+        self.minimum = minimum
+        self.top = top
+
+        self.layerName = UNKNOWN_LAYER
+        self.profiler = None
+        self.finished = None
+
+        self.tests = 0
+        self.suites = {} # suite name -> ProfileGroup
+        self.layers = {} # layer name -> ProfileGroup
+
+    def newProfiler(self):
+        if self.interval:
+            return SamplingProfiler(self.interval)
+        return cProfile.Profile()
+
+    def layer_setup(self, layer):
+        self.layerName = name_from_layer(layer)
+
+    # Test observer
+
+    def startTest(self, test):
+        self.profiler = self.newProfiler()
+        self.profiler.enable()
+
+    def stopTest(self, test):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.finished = self.profiler
+            self.profiler = None
+
+    def recordTest(self, suiteName, testCase):
+        # A test may be recorded more than once, e.g. if both the test and
+        # its tearDown() fail; it has only been profiled once
+        profiler = self.finished
+        self.finished = None
+        if profiler is None or (testCase.time or 0.0) < self.minimum:
+            return
+
+        profiler.create_stats()
+        data = profiler.stats
+        if not data:
+            # e.g. the test finished before the first sample
+            return
+
+        self.group(self.suites, suiteName).add(data)
+        self.group(self.layers, self.layerName).add(data)
+        self.tests += 1
+
+    def group(self, groups, name):
+        group = groups.get(name)
+        if group is None:
+            group = groups[name] = ProfileGroup()
+        return group
+
+    # Subprocesses
+
+    def global_teardown(self):
+        options = self.runner.options
+        directory = self.runner.fragmentsDirectory
+        if options.resume_layer is None or not directory:
+            return
+
+        data = {'tests': self.tests}
+        for key, groups in (('suites', self.suites,),
+                            ('layers', self.layers,),):
+            data[key] = dict([(name, (group.stats.stats, group.tests,))
+                              for name, group in groups.items()])
+
+        filename = os.path.join(directory, '%06d%s' % (options.resume_number,
+                                                       PROFILE_SUFFIX,))
+        with open(filename, 'wb') as stream:
+            marshal.dump(data, stream)
+
+    def mergeSubprocesses(self, directory):
+        """Add the profiles saved by subprocesses in ``directory``.
+        """
+
+        names = [name for name in os.listdir(directory)
+                 if name.endswith(PROFILE_SUFFIX)]
+        names.sort()
+
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as stream:
+                data = marshal.load(stream)
+
+            for key, groups in (('suites', self.suites,),
+                                ('layers', self.layers,),):
+                for groupName, (stats, tests) in data[key].items():
+                    self.group(groups, groupName).add(stats, tests)
+            self.tests += data['tests']
+
+    # Reporting
+
+    def report(self):
+        options = self.runner.options
+        if options.resume_layer is not None:
+            return
+
+        if self.runner.fragmentsDirectory:
+            self.mergeSubprocesses(self.runner.fragmentsDirectory)
+
+        if not is_replaceable(self.directory):
+            # Created while the tests ran; checked before, see runner.py
+            options.output.error(
+                "Not writing the profiles: %s was not written by "
+                "--profile-tests" % self.directory)
+            return
+
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+        os.makedirs(self.directory)
+        with open(os.path.join(self.directory, MARKER), 'w'):
+            pass
+
+        total = ProfileGroup()
+        for subdirectory, groups in (('suites', self.suites,),
+                                     ('layers', self.layers,),):
+            os.makedirs(os.path.join(self.directory, subdirectory))
+            for name, group in groups.items():
+                group.stats.dump_stats(os.path.join(
+                    self.directory, subdirectory,
+                    safe_filename(name) + '.pstats'))
+                if groups is self.layers:
+                    total.add(group.stats.stats, group.tests)
+        if total.stats is not None:
+            total.stats.dump_stats(os.path.join(self.directory,
+                                                'all.pstats'))
+
+        filename = os.path.join(self.directory, 'hotspots.txt')
+        with open(filename, 'w') as stream:
+            self.writeHotSpots(stream, total)
+
+        options.output.info("Profiled %d tests, hot spots written to %s" % (
+            self.tests, filename,))
+
+    def writeHotSpots(self, stream, total):
+        """Write the suites taking the most time, and the functions taking
+        the most time overall and in each layer, to ``stream``.
+        """
+
+        if self.interval:
+            method = "sampled every %s ms of CPU time" % (
+                self.interval * 1000,)
+        else:
+            method = "cProfile"
+        print >> stream, "%d tests profiled (%s)" % (self.tests, method,)
+        if self.minimum:
+            print >> stream, "Tests faster than %s ms are not included" % (
+                self.minimum * 1000,)
+        print >> stream
+
+        print >> stream, "Suites taking the most time:"
+        suites = sorted(self.suites.items(),
+                        key=lambda item: item[1].stats.total_tt,
+                        reverse=True)
+        for name, group in suites[:self.top]:
+            print >> stream, "  %10.3f s  %5d tests  %s" % (
+                group.stats.total_tt, group.tests, name,)
+        print >> stream
+
+        if total.stats is None:
+            return
+
+        sections = [("All tests", total.stats,)]
+        for name, group in sorted(self.layers.items()):
+            sections.append(("Layer %s (%d tests)" % (name, group.tests,),
+                             group.stats,))
+
+        for title, stats in sections:
+            print >> stream, "=" * 79
+            print >> stream, title
+            print >> stream, "=" * 79
+            stats.stream = stream
+            stats.sort_stats('time', 'cumulative').print_stats(self.top)
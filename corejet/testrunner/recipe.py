@@ -14,13 +14,17 @@
 """A recipe based on zc.recipe.testrunner
 """
 
+import logging
 import os
 import os.path
+import subprocess
 
 import pkg_resources
 import zc.buildout.easy_install
 import zc.recipe.egg
 
+from corejet.testrunner.frozen import write_index
+
 
 class TestRunner:
 
@@ -45,6 +49,13 @@ class TestRunner:
         test_paths = [ws.find(pkg_resources.Requirement.parse(spec)).location
                       for spec in eggs]
 
+        freeze = options.get('freeze', 'false').strip().lower() in (
+            'true', 'yes', 'on',)
+        if freeze:
+            # Test discovery imports every module in the test paths, so
+            # compile them now rather than on the first run
+            compile_paths(options['executable'], test_paths)
+
         defaults = options.get('defaults', '').strip()
         if defaults:
             defaults = '(%s) + ' % defaults
@@ -69,6 +80,21 @@ class TestRunner:
 
         initialization = initialization_template % wd
 
+        if freeze:
+            # Index the modules on the path the script will use, and load the
+            # index before anything else is imported
+            index = os.path.join(self.buildout['buildout']['parts-directory'],
+                                 self.name + '.imports')
+            write_index(index, [dist.location for dist in ws] +
+                               list(self.egg.extra_paths))
+            dest.append(index)
+
+            if self.egg._relative_paths:
+                index = _relativize(self.egg._relative_paths, index)
+            else:
+                index = repr(index)
+            initialization = freeze_template % index + initialization
+
         env_section = options.get('environment', '').strip()
         if env_section:
             env = self.buildout[env_section]
@@ -109,6 +135,23 @@ os.chdir(%s)
 env_template = """os.environ['%s'] = %r
 """
 
+freeze_template = """from corejet.testrunner.frozen import install_index
+install_index(%s)
+"""
+
+
+def compile_paths(executable, paths):
+    """Compile the Python files in the given directories to bytecode, using
+    the Python the tests will run with.
+    """
+
+    logger = logging.getLogger('corejet.testrunner')
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        if subprocess.call([executable, '-m', 'compileall', '-q', path]):
+            logger.warning("Could not compile all files in %s", path)
+
 
 def _relativize(base, path):
     base += os.path.sep
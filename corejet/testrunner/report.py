@@ -0,0 +1,236 @@
+"""Incremental generation of the CoreJet XML and HTML report.
+
+``corejet.visualization`` regenerates the whole report into an empty
+directory. For large catalogues, most of that work is wasted when only a few
+scenarios have changed status since the last run. Here, a manifest of content
+hashes is kept in the report directory instead: the hash of each epic and
+story (including the status of its scenarios) and of each file written.
+Files are only rewritten when their content changes, and the XSLT that builds
+the HTML report is only run when the catalogue has changed.
+
+The time of the test run is not part of the hashes, so when no story has
+changed the report, including its ``testTime``, is left as it is.
+"""
+
+from __future__ import with_statement
+
+import hashlib
+import json
+import os
+import os.path
+
+import pkg_resources
+
+from lxml import etree
+
+from corejet.testrunner.utils import write_file_atomically
+
+MANIFEST = '.corejet-manifest.json'
+MANIFEST_VERSION = 1
+
+REQUIREMENTS_JS = 'corejet-requirements.js'
+
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_digest(filename):
+    """Return the digest of the contents of ``filename``, or None if it
+    cannot be read.
+    """
+
+    try:
+        with open(filename, 'rb') as stream:
+            return digest(stream.read())
+    except (IOError, OSError,):
+        return None
+
+
+def load_manifest(directory):
+    """Load the manifest of the report in ``directory``. Returns an empty
+    manifest if there is none or if it cannot be used.
+    """
+
+    empty = {'version': MANIFEST_VERSION, 'catalogue': None,
+             'epics': {}, 'stories': {}, 'files': {}}
+
+    try:
+        with open(os.path.join(directory, MANIFEST)) as stream:
+            manifest = json.load(stream)
+    except (IOError, OSError, ValueError,):
+        return empty
+
+    if (not isinstance(manifest, dict) or
+        manifest.get('version') != MANIFEST_VERSION):
+        return empty
+
+    for key, value in empty.items():
+        manifest.setdefault(key, value)
+    return manifest
+
+
+def catalogue_digests(catalogueElement):
+    """Hash the serialized catalogue. Returns ``(catalogue, epics, stories)``
+    where ``catalogue`` is the digest of the whole catalogue, ignoring the
+    test time, and ``epics`` and ``stories`` map names to digests.
+    """
+
+    epics = {}
+    stories = {}
+
+    for epicElement in catalogueElement.iterchildren(tag='epic'):
+        epics[epicElement.get('id') or epicElement.get('title')] = digest(
+            etree.tostring(epicElement))
+        for storyElement in epicElement.iterchildren(tag='story'):
+            stories[storyElement.get('id') or storyElement.get('title')] = \
+                digest(etree.tostring(storyElement))
+
+    testTime = catalogueElement.attrib.pop('testTime', None)
+    try:
+        catalogue = digest(etree.tostring(catalogueElement))
+    finally:
+        if testTime is not None:
+            catalogueElement.set('testTime', testTime)
+
+    return catalogue, epics, stories
+
+
+def template_files():
+    """Return a list of ``(path, resource name)`` for the static files of
+    the ``corejet.visualization`` report template, with paths relative to the
+    report directory.
+    """
+
+    files = []
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        resource = '/'.join(filter(None, ['report-template', relative]))
+        for name in sorted(pkg_resources.resource_listdir(
+                'corejet.visualization', resource)):
+            path = '/'.join(filter(None, [relative, name]))
+            if pkg_resources.resource_isdir('corejet.visualization',
+                                            resource + '/' + name):
+                pending.append(path)
+            else:
+                files.append((path, resource + '/' + name,))
+    return files
+
+
+def render_requirements(tree):
+    """Run the ``corejet.visualization`` XSLT over the serialized catalogue
+    ``tree``, returning the contents of ``corejet-requirements.js``.
+    """
+
+    stream = pkg_resources.resource_stream('corejet.visualization',
+                                           'xslt/corejet-to-jit.xsl')
+    try:
+        xslt = etree.XSLT(etree.parse(stream))
+    finally:
+        stream.close()
+
+    return str(xslt(tree))
+
+
+class IncrementalReportWriter(object):
+    """Write a CoreJet report into ``directory``, only touching the files
+    whose content has changed since the last report.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = load_manifest(directory)
+        self.files = {}
+        self.written = 0
+
+    def isCurrent(self, path):
+        """Whether the file at ``path`` (relative to the report directory) is
+        the one recorded in the manifest.
+        """
+
+        expected = self.manifest['files'].get(path)
+        return (expected is not None and
+                file_digest(self.filename(path)) == expected)
+
+    def filename(self, path):
+        return os.path.join(self.directory, *path.split('/'))
+
+    def keep(self, path):
+        self.files[path] = self.manifest['files'][path]
+
+    def write(self, path, data):
+        """Write ``data`` to ``path`` unless the file already has that
+        content.
+        """
+
+        dataDigest = digest(data)
+        self.files[path] = dataDigest
+        filename = self.filename(path)
+
+        if (self.manifest['files'].get(path) == dataDigest and
+            file_digest(filename) == dataDigest):
+            return
+
+        parent = os.path.dirname(filename)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        write_file_atomically(filename, data)
+        self.written += 1
+
+    def removeStale(self):
+        """Remove files written by the previous report but not this one.
+        """
+
+        for path in self.manifest['files']:
+            if path not in self.files:
+                filename = self.filename(path)
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def writeManifest(self, catalogue, epics, stories):
+        self.manifest = {'version': MANIFEST_VERSION, 'catalogue': catalogue,
+                         'epics': epics, 'stories': stories,
+                         'files': self.files}
+        write_file_atomically(os.path.join(self.directory, MANIFEST),
+                              json.dumps(self.manifest, indent=1,
+                                         sort_keys=True))
+
+
+def update_corejet_report(catalogue, directory, filename='corejet.xml'):
+    """Bring the CoreJet XML file ``filename`` and HTML report in
+    ``directory`` up to date with ``catalogue``, rewriting only what has
+    changed. Returns ``(changed, total, written)``: the number of stories
+    that have changed since the last report, the total number of stories and
+    the number of files written.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    writer = IncrementalReportWriter(directory)
+    previous = writer.manifest
+
+    tree = catalogue.serialize()
+    catalogueDigest, epics, stories = catalogue_digests(tree.getroot())
+
+    changed = len([name for name, storyDigest in stories.items()
+                   if previous['stories'].get(name) != storyDigest])
+
+    for path, resource in template_files():
+        writer.write(path, pkg_resources.resource_string(
+            'corejet.visualization', resource))
+
+    generated = [filename, REQUIREMENTS_JS]
+    if (previous['catalogue'] == catalogueDigest and
+        all([writer.isCurrent(path) for path in generated])):
+        for path in generated:
+            writer.keep(path)
+    else:
+        writer.write(filename, etree.tostring(tree, pretty_print=True))
+        writer.write(REQUIREMENTS_JS, render_requirements(tree))
+
+    writer.removeStale()
+    writer.writeManifest(catalogueDigest, epics, stories)
+
+    return changed, len(stories), writer.written
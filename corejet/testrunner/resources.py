@@ -0,0 +1,201 @@
+"""Measuring the resources used by each test.
+
+For each test, the CPU time it used, how much it raised the peak resident set
+size of the process, how much memory it left allocated (if ``tracemalloc``
+is available), how many garbage collections ran and how many more file
+descriptors were open afterwards than before are recorded as properties of
+its test case. These end up as ``<properties />`` of the ``<testcase />`` in
+the JUnit reports, and can be written to a CSV or JSON summary.
+
+Measurements which are not available on the current platform are left out.
+"""
+
+from __future__ import with_statement
+
+import csv
+import json
+import os
+import os.path
+import sys
+import weakref
+
+from cStringIO import StringIO
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError: # before Python 3.4
+    tracemalloc = None
+
+from corejet.testrunner.utils import write_file_atomically
+
+# Names of the properties recorded for each test, in the order they are
+# written to summaries
+CPU = 'cpu-seconds'
+MAX_RSS = 'max-rss-kb'
+TRACED_MEMORY = 'traced-memory-bytes'
+GC_COLLECTIONS = 'gc-collections'
+OPEN_FILES = 'open-fds'
+PROPERTIES = (CPU, MAX_RSS, TRACED_MEMORY, GC_COLLECTIONS, OPEN_FILES,)
+
+# Directories listing the open file descriptors of the current process
+FD_DIRECTORIES = ('/proc/self/fd', '/dev/fd',)
+
+# ru_maxrss is in bytes on Mac OS X, and in kilobytes elsewhere
+MAX_RSS_SCALE = sys.platform == 'darwin' and 1024 or 1
+
+
+def get_fd_directory():
+    for directory in FD_DIRECTORIES:
+        if os.path.isdir(directory):
+            return directory
+    return None
+
+
+class Cycle(object):
+    __slots__ = ('cycle', '__weakref__',)
+
+
+class GarbageCollectionCounter(object):
+    """Count garbage collections.
+
+    Before Python 3.3 there is no hook into the garbage collector, so this
+    keeps a small reference cycle alive only through the collector: every
+    collection frees it, which triggers a weak reference callback that counts
+    the collection and creates the next one.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sentinel = None
+        self.arm()
+
+    def arm(self):
+        cycle = Cycle()
+        cycle.cycle = cycle
+        self.sentinel = weakref.ref(cycle, self.collected)
+
+    def collected(self, reference):
+        self.count += 1
+        self.arm()
+
+
+class ResourceMonitor(object):
+    """A test observer (see ``CoreJetOutputFormattingWrapper``) which records
+    the resources used by each test as properties of its test case.
+    """
+
+    def __init__(self):
+        self.fdDirectory = get_fd_directory()
+        self.collections = GarbageCollectionCounter()
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.before = None
+        self.measured = None
+
+    def usage(self):
+        """Return the CPU time used by the process so far, and its peak RSS
+        in KB, or None if that is not available.
+        """
+
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return (usage.ru_utime + usage.ru_stime,
+                    usage.ru_maxrss // MAX_RSS_SCALE,)
+
+        times = os.times()
+        return (times[0] + times[1], None,)
+
+    def counters(self):
+        """Return the traced memory, number of garbage collections and number
+        of open file descriptors, or None for those which are not available.
+        """
+
+        traced = None
+        if tracemalloc is not None:
+            traced = tracemalloc.get_traced_memory()[0]
+
+        openFiles = None
+        if self.fdDirectory is not None:
+            try:
+                openFiles = len(os.listdir(self.fdDirectory))
+            except OSError:
+                pass
+
+        return (traced, self.collections.count, openFiles,)
+
+    def startTest(self, test):
+        self.measured = None
+        # CPU time last, so that it does not include our own work
+        counters = self.counters()
+        self.before = self.usage() + counters
+
+    def stopTest(self, test):
+        if self.before is None:
+            return
+
+        after = self.usage()
+        after += self.counters()
+        before = self.before
+        self.before = None
+
+        measured = []
+        for name, start, end in zip(PROPERTIES, before, after):
+            if start is None or end is None:
+                continue
+            value = end - start
+            if name == CPU:
+                value = round(value, 6)
+            measured.append((name, value,))
+        self.measured = tuple(measured)
+
+    def recordTest(self, suiteName, testCase):
+        # A test may be recorded more than once, e.g. if both the test and
+        # its tearDown() fail
+        if self.measured is not None:
+            testCase.properties = (testCase.properties or ()) + self.measured
+            self.measured = None
+
+
+def write_resource_summary(filename, testCases):
+    """Write the resources used by each test to ``filename``, as JSON if its
+    extension is ``.json`` and as CSV otherwise. ``testCases`` is an iterable
+    of ``(suite name, TestCaseInfo)``. Tests without resource properties are
+    left out.
+    """
+
+    columns = ('suite', 'classname', 'name', 'time',) + PROPERTIES
+
+    rows = []
+    for suiteName, testCase in testCases:
+        properties = dict(testCase.properties or ())
+        if CPU not in properties:
+            continue
+        rows.append((suiteName, testCase.testClassName, testCase.testName,
+                     testCase.time,) +
+                    tuple([properties.get(name) for name in PROPERTIES]))
+    rows.sort()
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    if filename.endswith('.json'):
+        data = json.dumps([dict(zip(columns, row)) for row in rows],
+                          indent=1, sort_keys=True)
+    else:
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([isinstance(value, unicode) and
+                             value.encode('utf-8') or value
+                             for value in row])
+        data = output.getvalue()
+
+    write_file_atomically(filename, data)
+    return len(rows)
@@ -15,13 +15,30 @@
 """
 import os
 import sys
+import shutil
 import optparse
+import tempfile
 
+import zope.testrunner.filter
 from zope.testrunner.runner import Runner
 from zope.testrunner.options import parser
 
 from corejet.testrunner.formatter import CoreJetOutputFormattingWrapper
 
+# The modules implementing optional features, and their dependencies, are
+# only imported when the feature is used, to keep the startup of small test
+# runs fast
+
+# Environment variable used to tell subprocesses where to save their results
+FRAGMENTS_VARIABLE = 'COREJET_TESTRUNNER_FRAGMENTS'
+
+# Directory, relative to the working directory, for parsed catalogues
+CATALOGUE_CACHE = '.corejet-cache'
+
+# Directory, relative to the working directory, for the profiles written by
+# --profile-tests
+PROFILES_DIRECTORY = 'profiles'
+
 # Set up XML output parsing
 
 xmlOptions = optparse.OptionGroup(parser, "Generate XML test reports",
@@ -33,6 +50,55 @@ If given, XML reports will be written to the current directory. If you created
 the testrunner using the buildout recipe provided by this package, this will
 be in the buildout `parts` directroy, e.g. `parts/test`.
 """)
+xmlOptions.add_option(
+    '--xml-stream', action="store_true", dest='xmlStream',
+    help="""\
+Like `--xml`, but write each test case to its report file as soon as the test
+has finished, instead of holding all results in memory until the end of the
+run. Reports are kept well-formed after every test, so an interrupted run
+still leaves usable partial reports.
+""")
+xmlOptions.add_option(
+    '--xml-traceback-limit', action="store", type="int",
+    dest='xmlTracebackLimit', metavar="CHARACTERS",
+    help="""\
+Keep at most this many characters of the stack trace of each failure or
+error. The innermost frames are kept. By default, stack traces are kept in
+full.
+""")
+xmlOptions.add_option(
+    '--xml-workers', action="store", type="int", dest='xmlWorkers',
+    default=4, metavar="N",
+    help="""\
+Number of threads used to serialize and write XML reports at the end of the
+run. Each report is written to a temporary file and then renamed into place,
+so a crash never leaves a truncated report behind. Defaults to 4.
+""")
+xmlOptions.add_option(
+    '--xml-file', action="store", dest='xmlFile', metavar="FILE",
+    help="""\
+Write all suites into a single `<testsuites>` document, FILE, instead of one
+file per suite in the `testreports` directory. If FILE ends in `.gz`, it is
+compressed with gzip. An index giving the position of each suite in the file
+is written to FILE.index.json, so that tools can read a single suite without
+reading the whole file. Implies `--xml`, and can be combined with
+`--xml-stream`.
+""")
+xmlOptions.add_option(
+    '--xml-capture-output', action="store_true", dest='xmlCaptureOutput',
+    help="""\
+Capture what each test writes to `sys.stdout` and `sys.stderr`, and include
+it in the `<system-out>` and `<system-err>` elements of its `<testcase>`,
+instead of showing it on the console. Implies `--xml`.
+""")
+xmlOptions.add_option(
+    '--xml-capture-limit', action="store", type="int",
+    dest='xmlCaptureLimit', default=64, metavar="KB",
+    help="""\
+Keep at most this many kilobytes of each stream of each test: the first and
+the last half, with a note of how much was left out in between. Defaults to
+64.
+""")
 parser.add_option_group(xmlOptions)
 
 # Set up CoreJet parsing
@@ -49,6 +115,329 @@ string, which implies `--corejet=file,path/to/corejet.xml`.
 If you created the testrunner using the buildout recipe provided by this
 package, this will be in the buildout `parts` directroy, e.g. `parts/test`.
 """)
+corejetOptions.add_option(
+    "--corejet-incremental", action="store_true", dest="corejetIncremental",
+    help="""\
+Update the CoreJet report in place instead of regenerating it from scratch.
+A manifest of content hashes is kept in the report directory, and only the
+files that have changed since the last run are rewritten.
+""")
+corejetOptions.add_option(
+    "--corejet-cache-size", action="store", type="int",
+    dest="corejetCacheSize", default=64, metavar="MB",
+    help="""\
+Catalogues read from repository sources which support caching (such as
+`file`) are kept in a parsed form in the `.corejet-cache` directory, and
+reused for as long as the source is unchanged. When the cache grows beyond
+this size, the least recently used catalogues are removed. Defaults to 64.
+""")
+corejetOptions.add_option(
+    "--no-corejet-cache", action="store_false", dest="corejetCache",
+    default=True,
+    help="""\
+Always load the catalogue from the repository source, bypassing the cache.
+""")
+parser.add_option_group(corejetOptions)
+
+# Set up sharding
+
+shardOptions = optparse.OptionGroup(parser, "Sharding",
+    "Split the tests across several test runs, e.g. on different machines")
+shardOptions.add_option(
+    "--shard", action="store", dest="shard", metavar="I/N",
+    help="""\
+Divide the tests into N partitions of roughly equal duration and only run the
+I'th one, counting from 1. The durations are taken from the JUnit reports or
+timing history of a previous run given with `--shard-timings`; without it,
+the tests are dealt out by test id. All shards must use the same timings to
+agree on the partitions. Use the `corejet-merge` script to combine the
+reports of all shards.
+""")
+shardOptions.add_option(
+    "--shard-timings", action="store", dest="shardTimings",
+    metavar="PATH",
+    help="""\
+Directory containing the JUnit reports, single report file (see
+`--xml-file`) or timing history database (see `--timings`), used to balance
+the shards, e.g. the merged reports of the last run. Every shard must be
+given the same timings; the reports and timing history of each machine
+differ after a sharded run, so they are not used by default.
+""")
+parser.add_option_group(shardOptions)
+
+# Set up timing history
+
+timingOptions = optparse.OptionGroup(parser, "Timing history",
+    "Keep track of how long each test takes across test runs")
+timingOptions.add_option(
+    "--timings", action="store_true", dest="timings",
+    help="""\
+Record the duration of each test in a local timing history. The history is
+used to run the slowest tests in each layer first, to report the projected
+run time at the start of the run, and to report tests that have become
+markedly slower than usual at the end.
+""")
+timingOptions.add_option(
+    "--timings-file", action="store", dest="timingsFile",
+    default="timings.db", metavar="FILE",
+    help="""\
+SQLite database holding the timing history. Defaults to `timings.db` in the
+working directory.
+""")
+timingOptions.add_option(
+    "--timing-regression", action="store", type="float",
+    dest="timingRegression", default=2.0, metavar="FACTOR",
+    help="""\
+Report tests which took more than FACTOR times their median duration.
+Defaults to 2.
+""")
+parser.add_option_group(timingOptions)
+
+# Set up duration budgets
+
+budgetOptions = optparse.OptionGroup(parser, "Duration budgets",
+    "Check how long tests, suites and layers take against their budgets")
+budgetOptions.add_option(
+    "--budget", action="store", type="float", dest="budget",
+    metavar="SECONDS",
+    help="""\
+Default budget of each test. Tests taking longer than their budget are listed
+at the end of the run, and get `budget-seconds` and `over-budget-seconds`
+properties in the XML reports. Budgets given with the `budget()` decorator in
+`corejet.testrunner.budgets` or in a budgets file take precedence.
+""")
+budgetOptions.add_option(
+    "--budgets-file", action="store", dest="budgetsFile", metavar="FILE",
+    help="""\
+File giving the budgets of tests, suites and layers, one per line, as `KIND
+PATTERN SECONDS`, where KIND is `test`, `suite` or `layer`, and PATTERN is
+matched against the dotted name of the test, suite or layer. The first line
+matching wins.
+""")
+budgetOptions.add_option(
+    "--budgets-fail", action="store_true", dest="budgetsFail",
+    help="""\
+Turn tests which took longer than their budget into failures in the reports,
+and fail the run if any test, suite or layer went over its budget. Budgets
+given with the decorator are checked with this option alone.
+""")
+parser.add_option_group(budgetOptions)
+
+# Set up rerunning of failed tests
+
+failureOptions = optparse.OptionGroup(parser, "Rerunning failures",
+    "Run the tests which failed last time on their own, or first")
+failureOptions.add_option(
+    "--last-failed", action="store_true", dest="lastFailed",
+    help="""\
+Only run the tests which failed or had errors in the last run. Layers without
+any of them are not set up. If none of these tests are found, e.g. because
+there were no failures, all tests are run.
+""")
+failureOptions.add_option(
+    "--failed-first", action="store_true", dest="failedFirst",
+    help="""\
+Run the tests which failed or had errors in the last run first in each
+layer, followed by all other tests.
+""")
+failureOptions.add_option(
+    "--failures-file", action="store", dest="failuresFile",
+    default="failures.json", metavar="FILE",
+    help="""\
+File in which the tests which failed are recorded after each run. A test
+stays in it until it has run and passed. The file is only written once a test
+has failed. Defaults to `failures.json` in the working directory; an empty
+value turns recording off.
+""")
+parser.add_option_group(failureOptions)
+
+# Set up test impact selection
+
+impactOptions = optparse.OptionGroup(parser, "Test impact",
+    "Only run the tests affected by a change")
+impactOptions.add_option(
+    "--impact", action="store_true", dest="impact",
+    help="""\
+Record which source files in the working tree run during each test in the
+test impact map. Only the files of functions which are called are recorded,
+not individual lines. Cannot be combined with `--coverage`.
+""")
+impactOptions.add_option(
+    "--impact-file", action="store", dest="impactFile",
+    default="impact.json", metavar="FILE",
+    help="""\
+File holding the test impact map. Defaults to `impact.json` in the working
+directory.
+""")
+impactOptions.add_option(
+    "--changed-since", action="store", dest="changedSince", metavar="REV",
+    help="""\
+Only run the tests which ran code in any file changed since the git revision
+REV, as shown by `git diff`, according to the test impact map, and any tests
+which are not in the map yet. Layers without any of these tests are not set
+up. If there is no map, all tests are run.
+""")
+impactOptions.add_option(
+    "--changed-files", action="store", dest="changedFiles", metavar="FILE",
+    help="""\
+Like `--changed-since`, but read the changed files from FILE, one per line
+and relative to the top of the git checkout, e.g. the output of
+`git diff --name-only`. Use `-` to read them from standard input.
+""")
+parser.add_option_group(impactOptions)
+
+# Set up streaming of events
+
+eventOptions = optparse.OptionGroup(parser, "Live events",
+    "Stream events about the test run while it is running")
+eventOptions.add_option(
+    "--events", action="store", dest="events", metavar="TARGET",
+    help="""\
+Write an event in JSON, one per line, when each test starts and finishes and
+when each layer is set up and torn down, e.g. to follow a long run on a
+dashboard. TARGET is a file (which is overwritten), a FIFO (which must be
+opened for reading first) or a Unix socket, given as `unix:PATH` or as the
+path of an existing socket. Layers run in subprocesses write to the same
+target.
+""")
+eventOptions.add_option(
+    "--events-interval", action="store", type="float",
+    dest="eventsInterval", default=200, metavar="MS",
+    help="""\
+Events are buffered, and written every MS milliseconds. Defaults to 200.
+""")
+parser.add_option_group(eventOptions)
+
+# Set up writing reports in the background
+
+backgroundOptions = optparse.OptionGroup(parser, "Background reports",
+    "Write the reports after the test runner has exited")
+backgroundOptions.add_option(
+    "--background-reports", action="store_true", dest="backgroundReports",
+    help="""\
+Write the XML and CoreJet reports in a detached process, and exit as soon as
+the tests have finished. The output of that process goes to FILE.log, where
+FILE is the completion marker (see `--reports-marker`), which is written once
+the reports are complete. Not available on Windows.
+""")
+backgroundOptions.add_option(
+    "--reports-marker", action="store", dest="reportsMarker",
+    default="reports.done", metavar="FILE",
+    help="""\
+Completion marker written when the reports written in the background are
+complete, as JSON giving the exit `status` of the process writing them.
+Defaults to `reports.done` in the working directory.
+""")
+backgroundOptions.add_option(
+    "--join-reports", action="store_true", dest="joinReports",
+    help="""\
+Instead of running the tests, wait for the reports of the last run to be
+written in the background, show the output of the process writing them, and
+exit with status 1 if it failed.
+""")
+backgroundOptions.add_option(
+    "--join-timeout", action="store", type="float", dest="joinTimeout",
+    metavar="SECONDS",
+    help="""\
+Give up waiting with `--join-reports` after SECONDS. By default, wait for as
+long as it takes.
+""")
+parser.add_option_group(backgroundOptions)
+
+# Set up the test daemon
+
+daemonOptions = optparse.OptionGroup(parser, "Test daemon",
+    "Keep layers set up in a long-lived process, to rerun tests instantly")
+daemonOptions.add_option(
+    "--daemon", action="store_true", dest="daemon",
+    help="""\
+Instead of running the tests, import the test modules, set up the layers
+given by `--daemon-layer`, and wait for `--warm` runs until interrupted. Each
+run happens in a process forked from the daemon, which first reloads the
+modules that have changed since the daemon started.
+""")
+daemonOptions.add_option(
+    "--daemon-layer", action="append", dest="daemonLayers", metavar="LAYER",
+    help="""\
+Dotted name of a layer which the daemon sets up when it starts, and keeps set
+up. Can be given more than once.
+""")
+daemonOptions.add_option(
+    "--daemon-socket", action="store", dest="daemonSocket",
+    default=".corejet-daemon.sock", metavar="PATH",
+    help="""\
+Unix socket on which the daemon listens. Defaults to `.corejet-daemon.sock`
+in the working directory.
+""")
+daemonOptions.add_option(
+    "--warm", action="store_true", dest="warm",
+    help="""\
+Let the daemon run the tests, with the other options given, and show the
+output. If no daemon is listening, the tests are run as usual.
+""")
+parser.add_option_group(daemonOptions)
+
+# Set up profiling of individual tests
+
+profilingOptions = optparse.OptionGroup(parser, "Profiling tests",
+    "Profile each test, and find the hot spots of each suite and layer")
+profilingOptions.add_option(
+    "--profile-tests", action="store_true", dest="profileTests",
+    help="""\
+Profile each test on its own, and add its profile to those of its suite and
+layer. At the end of the run, the profiles are saved as `pstats` files in the
+`profiles` directory, next to `testreports`, along with a summary of the
+functions and suites taking the most time in `profiles/hotspots.txt`. By
+default, tests are profiled with cProfile, which records every function call
+but can make the tests several times slower. This cannot be combined with
+`--profile`.
+""")
+profilingOptions.add_option(
+    "--profile-tests-interval", action="store", type="float",
+    dest="profileTestsInterval", metavar="MS",
+    help="""\
+Instead of recording every function call, sample the stack every MS
+milliseconds of CPU time. This has much less overhead, but misses functions
+which take little time, and does not see time spent waiting, e.g. for I/O.
+Not available on Windows.
+""")
+profilingOptions.add_option(
+    "--profile-tests-min", action="store", type="float",
+    dest="profileTestsMinimum", default=0.0, metavar="MS",
+    help="""\
+Only keep the profiles of tests which took at least MS milliseconds, so that
+the hot spots of slow tests are not drowned out by many fast ones.
+""")
+profilingOptions.add_option(
+    "--profile-tests-top", action="store", type="int",
+    dest="profileTestsTop", default=20, metavar="N",
+    help="""\
+Number of functions and suites listed in each section of the hot spot
+summary. Defaults to 20.
+""")
+parser.add_option_group(profilingOptions)
+
+# Set up resource usage statistics
+
+resourceOptions = optparse.OptionGroup(parser, "Resource usage",
+    "Record the resources used by each test")
+resourceOptions.add_option(
+    "--resource-stats", action="store_true", dest="resourceStats",
+    help="""\
+Record the CPU time used by each test, how much it raised the peak resident
+set size (in KB), how much traced memory it left allocated (if tracemalloc is
+available), how many garbage collections ran during it and how many more
+file descriptors were open after it than before. These are added as
+`<properties>` to the `<testcase>` elements of the XML reports.
+""")
+resourceOptions.add_option(
+    "--resource-summary", action="store", dest="resourceSummary",
+    metavar="FILE",
+    help="""\
+Implies `--resource-stats`. Also write the resources used by each test to
+FILE, as JSON if its name ends in `.json` and as CSV otherwise.
+""")
+parser.add_option_group(resourceOptions)
 
 # Test runner and execution methods
 
@@ -56,9 +445,313 @@ class CoreJetRunner(Runner):
     """Add output formatter delegate to the test runner before execution
     """
 
+    # Directory in which the results of layers run in subprocesses are
+    # collected, see `run_internal()`
+    fragmentsDirectory = None
+
+    # Loads the CoreJet catalogue while the tests run
+    cataloguePrefetch = None
+
+    # The tests which failed in this and previous runs
+    failureHistory = None
+
+    # Events streamed with --events
+    eventStream = None
+
+    # The files run by each test, see corejet.testrunner.impact
+    impactMap = None
+
+    # Checks the duration of tests, see corejet.testrunner.budgets
+    durationBudgets = None
+
+    # Whether subprocesses save all their results for the parent
+    collectResults = False
+
     def configure(self):
         super(CoreJetRunner, self).configure()
-        self.options.output = CoreJetOutputFormattingWrapper(self.options.output, cwd=os.getcwd())
+        if self.options.fail:
+            return
+
+        if self.options.corejet and self.options.resume_layer is None:
+            from corejet.testrunner.catalogue import CatalogueCache
+            from corejet.testrunner.catalogue import CataloguePrefetch
+
+            cache = None
+            if self.options.corejetCache:
+                cache = CatalogueCache(
+                    os.path.join(os.getcwd(), CATALOGUE_CACHE),
+                    self.options.corejetCacheSize * 1024 * 1024)
+            self.cataloguePrefetch = CataloguePrefetch(self, cache)
+            self.features.append(self.cataloguePrefetch)
+
+        if self.options.shard:
+            from corejet.testrunner.sharding import Shard, parse_shard
+
+            try:
+                self.options.shard = parse_shard(self.options.shard)
+            except ValueError, e:
+                self.options.output.error(str(e))
+                self.options.fail = True
+                return
+
+            if (self.options.shardTimings and
+                not os.path.exists(self.options.shardTimings)):
+                self.options.output.error(
+                    "--shard-timings: no such file or directory: %s" % (
+                        self.options.shardTimings,))
+                self.options.fail = True
+                return
+
+            # Sharding must see all tests, so it goes before the filter
+            self.insertFeatureBefore(zope.testrunner.filter.Filter,
+                                     Shard(self))
+
+        if self.options.timings:
+            from corejet.testrunner.timings import LongestFirst
+
+            self.options.timingsFile = os.path.abspath(
+                self.options.timingsFile)
+
+            # Before the filter, like sharding, so that subprocesses order
+            # the tests in the same way. The Shuffle feature is only present
+            # with --shuffle, so it cannot be relied on to place this one.
+            self.insertFeatureBefore(zope.testrunner.filter.Filter,
+                                     LongestFirst(self))
+
+        subprocess = self.options.resume_layer is not None
+
+        if self.options.events:
+            import socket
+            from corejet.testrunner.events import EventStream, open_sink
+
+            if not self.options.events.startswith('unix:'):
+                self.options.events = os.path.abspath(self.options.events)
+
+            # Subprocesses add their events to those of the parent
+            try:
+                sink = open_sink(self.options.events, append=subprocess)
+            except (EnvironmentError, socket.error,), e:
+                self.options.output.error(
+                    "Cannot write events to %s: %s" % (self.options.events,
+                                                       e,))
+                self.options.fail = True
+                return
+
+            self.eventStream = EventStream(
+                sink, self.options.eventsInterval / 1000.0)
+            self.eventStream.emit('run-start', subprocess=subprocess)
+
+        if (self.options.lastFailed or self.options.failedFirst) and not \
+                self.options.failuresFile:
+            self.options.output.error(
+                "--last-failed and --failed-first need a --failures-file")
+            self.options.fail = True
+            return
+
+        if self.options.failuresFile and not self.options.list_tests:
+            from corejet.testrunner.failures import FailureHistory
+
+            self.options.failuresFile = os.path.abspath(
+                self.options.failuresFile)
+            self.failureHistory = FailureHistory(self.options.failuresFile)
+
+        if self.options.lastFailed or self.options.failedFirst:
+            from corejet.testrunner.failures import LastFailed
+
+            # Before the filter, like sharding, so that subprocesses select
+            # the same tests; after LongestFirst or shuffling, which then
+            # only apply to the tests that did not fail
+            self.insertFeatureBefore(zope.testrunner.filter.Filter,
+                                     LastFailed(self, self.failureHistory))
+
+        if (self.options.impact or self.options.changedSince or
+            self.options.changedFiles):
+            from corejet.testrunner.impact import ImpactMap, find_root
+
+            self.options.impactFile = os.path.abspath(
+                self.options.impactFile)
+            self.impactMap = ImpactMap(self.options.impactFile)
+            root = find_root(os.getcwd())
+
+        if self.options.changedSince or self.options.changedFiles:
+            from corejet.testrunner.impact import ImpactSelection
+            from corejet.testrunner.impact import git_changed_files
+            from corejet.testrunner.impact import read_changed_files
+
+            # Subprocesses get the changed files from the parent, see
+            # ImpactSelection
+            changed = None
+            if not subprocess:
+                changed = []
+                try:
+                    if self.options.changedSince:
+                        changed.extend(git_changed_files(
+                            self.options.changedSince, root))
+                    if self.options.changedFiles:
+                        changed.extend(read_changed_files(
+                            self.options.changedFiles))
+                except (EnvironmentError, ValueError,), e:
+                    self.options.output.error(
+                        "Cannot find the changed files: %s" % e)
+                    self.options.fail = True
+                    return
+
+            # Before the filter, like sharding, so that subprocesses select
+            # the same tests
+            self.insertFeatureBefore(
+                zope.testrunner.filter.Filter,
+                ImpactSelection(self, self.impactMap, changed))
+
+        # Features which observe each test, see
+        # CoreJetOutputFormattingWrapper
+        observers = []
+
+        if self.options.impact:
+            from corejet.testrunner.impact import ImpactRecorder
+
+            if self.options.coverage:
+                self.options.output.error(
+                    "--impact cannot be combined with --coverage")
+                self.options.fail = True
+                return
+
+            recorder = ImpactRecorder(self, self.impactMap, root)
+            self.features.append(recorder)
+            observers.append(recorder)
+
+        if self.options.profileTests:
+            import signal
+            from corejet.testrunner.profiling import TestProfiling
+            from corejet.testrunner.profiling import is_replaceable
+
+            if self.options.profile:
+                self.options.output.error(
+                    "--profile-tests cannot be combined with --profile")
+                self.options.fail = True
+                return
+
+            interval = self.options.profileTestsInterval
+            if interval and not hasattr(signal, 'setitimer'):
+                self.options.output.error(
+                    "--profile-tests-interval is not supported on this "
+                    "platform")
+                self.options.fail = True
+                return
+
+            directory = os.path.join(os.getcwd(), PROFILES_DIRECTORY)
+            if not is_replaceable(directory):
+                self.options.output.error(
+                    "--profile-tests: %s was not written by --profile-tests "
+                    "and would be replaced; move it out of the way" % (
+                        directory,))
+                self.options.fail = True
+                return
+
+            profiling = TestProfiling(
+                self, directory,
+                interval=interval and interval / 1000.0,
+                minimum=self.options.profileTestsMinimum / 1000.0,
+                top=self.options.profileTestsTop)
+            self.features.append(profiling)
+            observers.append(profiling)
+
+        if (self.options.budget is not None or self.options.budgetsFile or
+            self.options.budgetsFail):
+            from corejet.testrunner.budgets import DurationBudgets
+            from corejet.testrunner.budgets import read_budgets_file
+
+            patterns = ()
+            if self.options.budgetsFile:
+                try:
+                    patterns = read_budgets_file(self.options.budgetsFile)
+                except (IOError, ValueError,), e:
+                    self.options.output.error(
+                        "Cannot read the budgets file: %s" % e)
+                    self.options.fail = True
+                    return
+
+            self.durationBudgets = DurationBudgets(
+                self, self.options.budget, patterns,
+                fail=self.options.budgetsFail)
+            self.features.append(self.durationBudgets)
+            observers.append(self.durationBudgets)
+
+        if self.options.resourceSummary:
+            self.options.resourceSummary = os.path.abspath(
+                self.options.resourceSummary)
+            self.options.resourceStats = True
+
+        if self.options.resourceStats:
+            from corejet.testrunner.resources import ResourceMonitor
+
+            # Outside of any profiler, so that it is not profiled
+            observers.insert(0, ResourceMonitor())
+
+        if self.options.xmlFile:
+            self.options.xmlFile = os.path.abspath(self.options.xmlFile)
+
+        if self.options.backgroundReports:
+            self.options.reportsMarker = os.path.abspath(
+                self.options.reportsMarker)
+
+        if (self.options.xmlStream or self.options.xmlCaptureOutput or
+            self.options.xmlFile):
+            self.options.xmlOutput = True
+
+        # Layers may be run in subprocesses, either because of `-j` or
+        # because they cannot be torn down. Each child then saves its results
+        # as a fragment in a directory shared through the environment, and
+        # the parent merges these before writing any reports. Features which
+        # only need a little of each child's results, like the failure
+        # history, save that on their own.
+        self.collectResults = bool(
+            self.options.xmlOutput or self.options.corejet or
+            self.options.timings or self.options.profileTests or
+            self.options.resourceSummary or self.durationBudgets)
+        if subprocess:
+            self.fragmentsDirectory = os.environ.get(FRAGMENTS_VARIABLE)
+        elif (self.options.xmlOutput or self.options.corejet or
+              self.options.timings or self.options.profileTests or
+              self.options.resourceSummary or self.failureHistory or
+              self.options.impact or self.options.changedSince or
+              self.options.changedFiles or self.durationBudgets):
+            self.fragmentsDirectory = tempfile.mkdtemp(prefix='corejet-')
+            os.environ[FRAGMENTS_VARIABLE] = self.fragmentsDirectory
+
+        if self.options.xmlCaptureOutput and self.fragmentsDirectory:
+            from corejet.testrunner.capture import OutputCapture
+
+            # Last, so that nothing else writes to the captured streams
+            observers.append(OutputCapture(
+                self.fragmentsDirectory,
+                self.options.xmlCaptureLimit * 1024))
+
+        self.options.output = CoreJetOutputFormattingWrapper(
+            self.options.output, cwd=os.getcwd(),
+            xmlStream=self.options.xmlStream and not subprocess,
+            tracebackLimit=self.options.xmlTracebackLimit,
+            resolveScenarios=bool(self.options.corejet),
+            xmlWorkers=self.options.xmlWorkers,
+            observers=observers,
+            xmlFile=self.options.xmlFile,
+            events=self.eventStream,
+            failureHistory=self.failureHistory,
+            retainTestCases=bool(subprocess or self.options.corejet or
+                                 self.options.timings or
+                                 self.options.resourceSummary or
+                                 not self.options.xmlStream))
+
+    def insertFeatureBefore(self, featureClass, feature):
+        """Insert ``feature`` before the first active feature of the given
+        class, or at the end if there is no such feature.
+        """
+
+        for index, existing in enumerate(self.features):
+            if isinstance(existing, featureClass):
+                self.features.insert(index, feature)
+                break
+        else:
+            self.features.append(feature)
 
 
 def run(defaults=None, args=None, script_parts=None):
@@ -67,19 +760,48 @@ def run(defaults=None, args=None, script_parts=None):
     Will execute the tests and exit the process according to the test result.
 
     """
-    failed = run_internal(defaults, args, script_parts=script_parts)
-    sys.exit(int(failed))
+    if args is None:
+        args = sys.argv[:]
 
+    # Subprocesses running a layer are started with --resume-layer, which
+    # is not a real option
+    options = None
+    if len(args) < 2 or args[1] != '--resume-layer':
+        options, positional = parser.parse_args(
+            args[1:], parser.parse_args(list(defaults or []))[0])
 
-def run_internal(defaults=None, args=None, script_parts=None):
-    """Execute tests.
+    if options is not None and options.joinReports:
+        from corejet.testrunner.background import run_join
+        failed = run_join(os.path.abspath(options.reportsMarker),
+                          options.joinTimeout)
+    elif options is not None and options.daemon:
+        from corejet.testrunner.daemon import run_daemon
+        failed = run_daemon(defaults, args, script_parts=script_parts)
+    elif options is not None and options.warm:
+        from corejet.testrunner.daemon import run_client
 
-    Returns whether errors or failures occured during testing.
+        # The daemon cannot read the standard input of this process
+        stdin = None
+        if options.changedFiles == '-':
+            from StringIO import StringIO
+            stdin = sys.stdin.read()
+            sys.stdin = StringIO(stdin)
+
+        failed = run_client(os.path.abspath(options.daemonSocket), args,
+                            defaults, stdin=stdin)
+        if failed is None:
+            print "No test daemon listening on %s, running the tests here" % (
+                options.daemonSocket,)
+            failed = run_internal(defaults, args, script_parts=script_parts)
+    else:
+        failed = run_internal(defaults, args, script_parts=script_parts)
+    sys.exit(int(failed))
 
-    """
 
-    runner = CoreJetRunner(defaults, args, script_parts=script_parts)
-    runner.run()
+def write_reports(runner, catalogue=None):
+    """Write the reports of a test run. ``catalogue`` is the CoreJet
+    catalogue, if it has been loaded already.
+    """
 
     # Write XML file of results if --xml option is given
     if runner.options.xmlOutput:
@@ -87,6 +809,95 @@ def run_internal(defaults=None, args=None, script_parts=None):
     
     # Write Corejet output if --corejet is given
     if runner.options.corejet:
-        runner.options.output.writeCoreJetReports(runner.options.corejet)
-    
-    return runner.failed
+        runner.options.output.writeCoreJetReports(
+            runner.options.corejet,
+            incremental=runner.options.corejetIncremental,
+            catalogue=catalogue)
+
+
+def run_internal(defaults=None, args=None, script_parts=None,
+                 runnerClass=CoreJetRunner):
+    """Execute tests.
+
+    Returns whether errors or failures occured during testing.
+
+    """
+
+    runner = runnerClass(defaults, args, script_parts=script_parts)
+    try:
+        runner.run()
+        if runner.options.fail:
+            return True
+
+        if runner.options.resume_layer is not None:
+            # We are running a layer in a subprocess; leave the reports to
+            # the parent process
+            name = '%06d' % runner.options.resume_number
+            if runner.fragmentsDirectory and runner.collectResults:
+                runner.options.output.writeFragment(
+                    runner.fragmentsDirectory, name)
+            if (runner.fragmentsDirectory and
+                runner.failureHistory is not None):
+                runner.failureHistory.writeFragment(
+                    runner.fragmentsDirectory, name)
+            return runner.failed
+
+        if runner.fragmentsDirectory:
+            runner.options.output.mergeFragments(runner.fragmentsDirectory)
+            if runner.failureHistory is not None:
+                runner.failureHistory.mergeFragments(
+                    runner.fragmentsDirectory)
+
+        if runner.durationBudgets is not None:
+            from corejet.testrunner.budgets import report_budgets
+            if (report_budgets(runner.durationBudgets, runner.options.output)
+                and runner.options.budgetsFail):
+                runner.failed = True
+
+        if runner.failureHistory is not None:
+            runner.failureHistory.save()
+
+        if runner.options.timings:
+            from corejet.testrunner.timings import update_timing_history
+            update_timing_history(runner.options)
+
+        if runner.options.resourceSummary:
+            from corejet.testrunner.resources import write_resource_summary
+            write_resource_summary(runner.options.resourceSummary,
+                                   runner.options.output.iterTestCases())
+
+        if not (runner.options.xmlOutput or runner.options.corejet):
+            return runner.failed
+
+        if runner.options.backgroundReports and hasattr(os, 'fork'):
+            from corejet.testrunner.background import \
+                write_reports_in_background
+
+            pid = write_reports_in_background(runner, write_reports)
+            runner.options.output.info(
+                "Writing the reports in the background (process %d), use "
+                "--join-reports to wait for them" % pid)
+            return runner.failed
+
+        catalogue = None
+        if runner.cataloguePrefetch is not None:
+            catalogue = runner.cataloguePrefetch.join()
+        write_reports(runner, catalogue)
+
+        return runner.failed
+    except:
+        # e.g. interrupted with Ctrl+C: leave complete reports of the tests
+        # run so far, and no temporary files
+        finishXMLStream = getattr(runner.options.output, 'finishXMLStream',
+                                  None)
+        if finishXMLStream is not None:
+            finishXMLStream()
+        raise
+    finally:
+        if runner.eventStream is not None:
+            runner.eventStream.emit('run-end')
+            runner.eventStream.close()
+
+        if (runner.fragmentsDirectory and
+            runner.options.resume_layer is None):
+            shutil.rmtree(runner.fragmentsDirectory, True)
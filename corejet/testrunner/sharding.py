@@ -0,0 +1,207 @@
+"""Split the tests across several test runs, e.g. on different CI nodes.
+
+Tests are divided into partitions ("shards") of roughly equal duration, using
+the test times recorded in the JUnit reports or timing history of previous
+runs, given with ``--shard-timings``. The division only depends on the tests
+found and on those timings, so every shard computes the same partitions
+independently, as long as all of them are given the same timings.
+
+The reports and timing history in the working directory of each node are
+never used by default: after a sharded run, each node only has the times of
+its own shard, so the nodes would disagree on the partitions, and tests would
+be run twice or not at all. Without ``--shard-timings``, the tests are simply
+dealt out in order of their ids.
+
+Use ``corejet-merge`` (see ``merge.py``) to combine the reports of all shards
+afterwards.
+"""
+
+import glob
+import hashlib
+import os.path
+import sqlite3
+import zlib
+
+import zope.testrunner.feature
+
+from lxml import etree
+
+from corejet.testrunner.consolidated import open_report
+from corejet.testrunner.formatter import TestParser
+from corejet.testrunner.timings import TimingHistory
+
+
+def parse_shard(value):
+    """Parse a ``--shard`` value of the form ``I/N``, returning ``(I, N)``.
+    Shards are numbered from 1. Raises ValueError if the value is invalid.
+    """
+
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError("Invalid shard %r: expected I/N, e.g. 1/4" % value)
+
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard %r: I must be between 1 and N" % value)
+
+    return index, count
+
+
+def is_junit_report(filename):
+    """Whether ``filename`` is a single JUnit report, e.g. one written with
+    ``--xml-file``, rather than a timing history database.
+    """
+
+    return filename.endswith('.xml') or filename.endswith('.xml.gz')
+
+
+def read_junit_timings(path):
+    """Read the time taken by each test from the JUnit reports in the given
+    directory, or from the given report file. Returns a dict mapping
+    ``(classname, name)`` to seconds. Reports which cannot be read are
+    skipped.
+    """
+
+    if os.path.isdir(path):
+        filenames = glob.glob(os.path.join(path, '*.xml'))
+    else:
+        filenames = [path]
+
+    timings = {}
+    for filename in filenames:
+        try:
+            stream = open_report(filename)
+        except IOError:
+            continue
+        try:
+            for event, element in etree.iterparse(stream, tag='testcase'):
+                try:
+                    timings[(element.get('classname'), element.get('name'))
+                            ] = float(element.get('time'))
+                except (TypeError, ValueError,):
+                    pass
+                element.clear()
+        except (etree.XMLSyntaxError, IOError, zlib.error,):
+            # e.g. a report left behind by an interrupted run
+            pass
+        stream.close()
+    return timings
+
+
+def read_timings(options):
+    """Read the timings used to balance the shards from the directory, report
+    file or timing history database given with ``--shard-timings``. Returns
+    None if there is none, or if the timing history cannot be read, in which
+    case the tests are dealt out by id.
+    """
+
+    source = options.shardTimings
+    if not source:
+        return None
+
+    if not os.path.isfile(source) or is_junit_report(source):
+        return read_junit_timings(source)
+
+    try:
+        medians = TimingHistory(source).medians()
+    except sqlite3.Error:
+        return None
+
+    return dict([((classname, name), seconds,)
+                 for (suite, classname, name), seconds in medians.items()])
+
+
+def timings_digest(timings):
+    """Return a short digest of ``timings``, which shows whether all shards
+    were balanced with the same timings.
+    """
+
+    return hashlib.sha1(repr(sorted(timings.items()))).hexdigest()[:12]
+
+
+def partition(tests, count, duration):
+    """Divide ``tests`` into ``count`` lists of roughly equal total duration,
+    as given by the ``duration`` function.
+
+    Tests are allocated longest first, each to the partition with the least
+    work so far. Ties are broken by test id, so that the result does not
+    depend on the order in which the tests were found.
+    """
+
+    partitions = [[] for i in range(count)]
+    loads = [0.0] * count
+
+    weighted = [(-duration(test), test.id(), test,) for test in tests]
+    weighted.sort(key=lambda item: item[:2])
+
+    for negativeDuration, testId, test in weighted:
+        lightest = loads.index(min(loads))
+        partitions[lightest].append(test)
+        loads[lightest] -= negativeDuration
+
+    return partitions
+
+
+class Shard(zope.testrunner.feature.Feature):
+    """Only run the tests in one partition of the whole test suite.
+
+    This must run before the Filter feature, which in a subprocess removes
+    all layers but the one being resumed: every process has to partition the
+    full set of tests to agree on which tests belong to the shard.
+    """
+
+    def __init__(self, runner):
+        super(Shard, self).__init__(runner)
+        self.active = bool(runner.options.shard)
+        if self.active:
+            self.index, self.count = runner.options.shard
+
+    def global_setup(self):
+        layers = self.runner.tests_by_layer_name
+        timings = read_timings(self.runner.options)
+        self.digest = None
+        if timings is not None:
+            self.digest = timings_digest(timings)
+        else:
+            # Every test counts the same, so they are dealt out by id
+            timings = {}
+
+        # Tests we have no timings for (e.g. new tests) count as average ones
+        default = 1.0
+        if timings:
+            known = sorted(timings.values())
+            default = known[len(known) // 2] or default
+
+        parseTest = TestParser()
+
+        def duration(test):
+            testSuite, testName, testClassName = parseTest(test)
+            return timings.get((testClassName, testName), default)
+
+        tests = []
+        for suite in layers.values():
+            tests.extend(suite)
+
+        selected = partition(tests, self.count, duration)[self.index - 1]
+        selectedIds = set([id(test) for test in selected])
+        self.selected = len(selected)
+        self.total = len(tests)
+
+        for layerName, suite in list(layers.items()):
+            kept = [test for test in suite if id(test) in selectedIds]
+            if kept:
+                layers[layerName] = suite.__class__(kept)
+            else:
+                # Layers without tests in this shard are never set up
+                del layers[layerName]
+
+    def report(self):
+        if self.runner.options.resume_layer is not None:
+            return
+        if self.digest is None:
+            balance = "dealt out by test id"
+        else:
+            balance = "balanced by timings %s" % self.digest
+        self.runner.options.output.info(
+            "Ran shard %d of %d (%d of %d tests, %s)." % (
+                self.index, self.count, self.selected, self.total, balance,))
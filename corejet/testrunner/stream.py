@@ -0,0 +1,181 @@
+"""Incremental writing of JUnit XML reports.
+
+Rather than building an element tree for each suite at the end of the run,
+``<testcase />`` elements are appended to the relevant report file as soon
+as each test has finished. Every file is kept well-formed after each write,
+so a run that is killed half way through still leaves usable partial reports.
+"""
+
+import os
+import os.path
+
+from lxml import etree
+
+# Space reserved in the opening <testsuite> tag for the running totals, which
+# are patched in place as tests are added. XML allows any amount of
+# whitespace between attributes, so the totals are simply padded out until
+# the report is closed.
+TOTALS_WIDTH = 120
+
+FOOTER = '  <system-out/>\n  <system-err/>\n</testsuite>\n'
+
+
+def indent_test_case_node(testCaseNode):
+    """Serialize a ``<testcase />`` element the way lxml's pretty printer
+    would when it is nested directly inside a ``<testsuite />``.
+    """
+
+    children = list(testCaseNode)
+    if children:
+        testCaseNode.text = '\n    '
+        for child in children:
+            child.tail = '\n    '
+        children[-1].tail = '\n  '
+    return '  ' + etree.tostring(testCaseNode) + '\n'
+
+
+class SuiteStream(object):
+    """Book-keeping for a single, partially written suite report.
+    """
+
+    def __init__(self, filename, totalsOffset):
+        self.filename = filename
+        self.totalsOffset = totalsOffset
+        self.file = None
+        self.finished = False
+
+
+class StreamingXMLReportWriter(object):
+    """Writes one JUnit report file per suite, one test case at a time.
+
+    At most ``maxOpenFiles`` report files are held open at once; tests in a
+    suite normally run together, so a small number is plenty.
+    """
+
+    def __init__(self, reportsDir, timestamp, hostname, maxOpenFiles=32):
+        self.reportsDir = reportsDir
+        self.timestamp = timestamp
+        self.hostname = hostname
+        self.maxOpenFiles = maxOpenFiles
+        self._suites = {} # suite name -> SuiteStream
+        self._open = [] # SuiteStreams with open files, most recent last
+        self.closed = False
+
+    def write(self, name, suite, testCaseNode):
+        """Append the given ``<testcase />`` element to the report for the
+        suite ``name`` and update its totals from the TestSuiteInfo ``suite``.
+        """
+
+        stream = self._suites.get(name)
+        if stream is None:
+            stream = self._suites[name] = self._start(name)
+
+        outputFile = self._activate(stream)
+
+        outputFile.seek(-len(FOOTER), os.SEEK_END)
+        outputFile.write(indent_test_case_node(testCaseNode))
+        outputFile.write(FOOTER)
+
+        outputFile.seek(stream.totalsOffset)
+        outputFile.write(self._totals(suite))
+        outputFile.flush()
+
+    def close(self, properties={}):
+        """Close all report files, trimming the padding after their totals.
+        If ``properties`` are given, they are written into each report's
+        ``<properties />`` node.
+        """
+
+        for stream in self._open:
+            stream.file.close()
+            stream.file = None
+        self._open = []
+
+        for stream in self._suites.values():
+            if not stream.finished:
+                self._finish(stream, properties)
+                stream.finished = True
+        self.closed = True
+
+    def reportFilename(self, name):
+        return os.path.join(self.reportsDir, name + '.xml')
+
+    def _start(self, name):
+        if not os.path.exists(self.reportsDir):
+            os.mkdir(self.reportsDir)
+
+        filename = self.reportFilename(name)
+
+        testSuiteNode = etree.Element('testsuite')
+        testSuiteNode.set('hostname', self.hostname)
+        testSuiteNode.set('name', name)
+        testSuiteNode.set('timestamp', self.timestamp)
+
+        # Chop off the '/>' so that we can add the totals
+        header = etree.tostring(testSuiteNode)[:-2]
+
+        outputFile = open(filename, 'w+b')
+        outputFile.write(header)
+        outputFile.write(' ' * TOTALS_WIDTH + '>\n')
+        outputFile.write('  <properties/>\n')
+        outputFile.write(FOOTER)
+        outputFile.flush()
+
+        stream = SuiteStream(filename, len(header))
+        stream.file = outputFile
+        self._open.append(stream)
+        return stream
+
+    def _activate(self, stream):
+        if stream.file is not None:
+            if self._open[-1] is not stream:
+                self._open.remove(stream)
+                self._open.append(stream)
+            return stream.file
+
+        if len(self._open) >= self.maxOpenFiles:
+            oldest = self._open.pop(0)
+            oldest.file.close()
+            oldest.file = None
+
+        stream.file = open(stream.filename, 'r+b')
+        self._open.append(stream)
+        return stream.file
+
+    def _totals(self, suite):
+        totals = ' tests="%d" errors="%d" failures="%d" time="%s"' % (
+            suite.tests, suite.errors, suite.failures, str(suite.time),)
+        return totals.ljust(TOTALS_WIDTH)
+
+    def _finish(self, stream, properties):
+        propertiesNode = etree.Element('properties')
+        for k, v in properties.items():
+            propertyNode = etree.Element('property')
+            propertiesNode.append(propertyNode)
+
+            propertyNode.set('name', k)
+            propertyNode.set('value', v)
+
+        # Copy the file with the final header and the properties in place, a
+        # line at a time so that memory use does not depend on the size of
+        # the report.
+        tempname = stream.filename + '.tmp'
+        source = open(stream.filename, 'rb')
+        try:
+            target = open(tempname, 'wb')
+            try:
+                header = source.readline() # <testsuite ...>
+                end = stream.totalsOffset + TOTALS_WIDTH
+                target.write(header[:end].rstrip() + header[end:])
+                source.readline() # <properties/>
+                for line in etree.tostring(propertiesNode,
+                                           pretty_print=True).splitlines(True):
+                    target.write('  ' + line)
+                for line in source:
+                    target.write(line)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+        os.rename(tempname, stream.filename)
@@ -0,0 +1,100 @@
+"""Tests of writing all JUnit reports into a single file, see
+corejet.testrunner.consolidated.
+"""
+
+import os.path
+import unittest
+
+from lxml import etree
+
+from corejet.testrunner.consolidated import index_filename
+from corejet.testrunner.consolidated import read_index
+from corejet.testrunner.consolidated import read_suite
+from corejet.testrunner.consolidated import write_consolidated_report
+from corejet.testrunner.formatter import TestSuiteInfo
+from corejet.testrunner.tests.utils import TemporaryDirectoryTestCase
+
+
+def make_suites():
+    suites = []
+    for name, tests, failures, seconds in (('alpha', 3, 1, 1.5,),
+                                           ('beta', 1, 0, 0.25,),
+                                           ('gamma', 20, 2, 4.0,),):
+        suite = TestSuiteInfo()
+        suite.tests = tests
+        suite.failures = failures
+        suite.time = seconds
+        suites.append((name, suite,))
+    return suites
+
+
+def serialize(item):
+    name, suite = item
+    testSuiteNode = etree.Element('testsuite', name=name,
+                                  tests=str(suite.tests))
+    for index in range(suite.tests):
+        etree.SubElement(testSuiteNode, 'testcase', classname='Tests',
+                         name='test_%s_%d' % (name, index,))
+    return etree.tostring(testSuiteNode, pretty_print=True)
+
+
+class ConsolidatedReportTests(TemporaryDirectoryTestCase):
+
+    def roundTrip(self, basename, workers=1):
+        filename = os.path.join(self.directory, 'reports', basename)
+        suites = make_suites()
+        write_consolidated_report(filename, suites, serialize, workers)
+
+        index = read_index(filename)
+        self.assertEqual([(entry['name'], entry['tests'], entry['failures'],)
+                          for entry in index['suites']],
+                         [('alpha', 3, 1,), ('beta', 1, 0,),
+                          ('gamma', 20, 2,)])
+
+        # Each suite reads back as written, with or without the index given
+        for item in suites:
+            name, suite = item
+            self.assertEqual(read_suite(filename, name, index),
+                             serialize(item))
+            self.assertEqual(read_suite(filename, name), serialize(item))
+        self.assertEqual(read_suite(filename, 'missing', index), None)
+
+        # The whole file is one well-formed document with the totals
+        testSuitesNode = etree.parse(filename).getroot()
+        self.assertEqual(testSuitesNode.tag, 'testsuites')
+        self.assertEqual(
+            [testSuitesNode.get(name) for name in
+             ('tests', 'errors', 'failures', 'time',)],
+            ['24', '0', '3', '5.75'])
+        self.assertEqual([node.get('name') for node in testSuitesNode],
+                         ['alpha', 'beta', 'gamma'])
+        return index
+
+    def test_plain(self):
+        index = self.roundTrip('all.xml')
+        self.assertFalse(index['compressed'])
+
+        with open(os.path.join(self.directory, 'reports', 'all.xml'),
+                  'rb') as stream:
+            data = stream.read()
+        for entry in index['suites']:
+            self.assertEqual(entry['length'], entry['size'])
+            self.assertTrue(data[entry['offset']:].startswith('<testsuite'))
+
+    def test_compressed(self):
+        index = self.roundTrip('all.xml.gz')
+        self.assertTrue(index['compressed'])
+
+    def test_workers(self):
+        self.roundTrip('all.xml.gz', workers=3)
+
+    def test_unsupported_index(self):
+        filename = os.path.join(self.directory, 'all.xml')
+        write_consolidated_report(filename, make_suites(), serialize)
+        with open(index_filename(filename), 'wb') as stream:
+            stream.write('{"version": 0, "suites": []}')
+        self.assertRaises(ValueError, read_index, filename)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,183 @@
+"""Tests of the test daemon and its client, see corejet.testrunner.daemon.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+from StringIO import StringIO
+
+from corejet.testrunner.daemon import TRAILER
+from corejet.testrunner.daemon import run_client
+from corejet.testrunner.daemon import run_daemon
+
+SAMPLE_TESTS = """\
+import unittest
+
+class SampleTests(unittest.TestCase):
+
+    def test_ok(self):
+        self.assertEqual(%d, 1)
+
+    def test_fail(self):
+        self.fail("failed on purpose")
+
+class WarmLayer(object):
+
+    @classmethod
+    def setUp(cls):
+        pass
+
+    @classmethod
+    def tearDown(cls):
+        pass
+
+class ColdLayer(WarmLayer):
+    pass
+
+class WarmTests(unittest.TestCase):
+    layer = WarmLayer
+
+    def test_warm(self):
+        pass
+
+class ColdTests(unittest.TestCase):
+    layer = ColdLayer
+
+    def test_cold(self):
+        pass
+"""
+
+# Seconds to wait for the daemon to start listening
+STARTUP_TIMEOUT = 10
+
+
+class DaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='corejet-daemon-test-')
+        package = os.path.join(self.directory, 'corejetdaemonsample')
+        os.mkdir(package)
+        self.writeFile(os.path.join(package, '__init__.py'), '')
+        self.testsFile = os.path.join(package, 'tests.py')
+        self.writeFile(self.testsFile, SAMPLE_TESTS % 1)
+
+        self.socketPath = os.path.join(self.directory, 'daemon.sock')
+        self.args = ['test', '--path', self.directory,
+                     '--daemon-socket', self.socketPath,
+                     '--daemon-layer', 'corejetdaemonsample.tests.WarmLayer']
+        self.pid = self.startDaemon()
+
+        # Test runs leave files in the working directory of the client
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        shutil.rmtree(self.directory, True)
+
+    def writeFile(self, filename, contents):
+        with open(filename, 'wb') as stream:
+            stream.write(contents)
+
+    def startDaemon(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 1)
+                os.dup2(devnull, 2)
+                status = int(bool(run_daemon(args=self.args + ['--daemon'])))
+            finally:
+                os._exit(status)
+
+        deadline = time.time() + STARTUP_TIMEOUT
+        while not os.path.exists(self.socketPath):
+            if time.time() > deadline:
+                self.fail("The test daemon did not start")
+            time.sleep(0.05)
+        return pid
+
+    def runClient(self, *args):
+        """Run the tests in the daemon, and return whether they failed and
+        their output.
+        """
+
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            failed = run_client(self.socketPath,
+                                self.args + ['--warm'] + list(args))
+            return failed, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_round_trip(self):
+        failed, output = self.runClient('-t', 'test_ok')
+        self.assertEqual(failed, False)
+        self.assertTrue("Ran 1 tests with 0 failures" in output, output)
+        self.assertFalse(TRAILER.split('%')[0] in output)
+
+        failed, output = self.runClient()
+        self.assertEqual(failed, True)
+        self.assertTrue("failed on purpose" in output, output)
+
+    def test_reload(self):
+        self.runClient('-t', 'test_ok')
+
+        # Make sure the change is seen, however coarse the modification
+        # times are
+        self.writeFile(self.testsFile, SAMPLE_TESTS % 2)
+        later = time.time() + 10
+        os.utime(self.testsFile, (later, later,))
+
+        failed, output = self.runClient('-t', 'test_ok')
+        self.assertEqual(failed, True)
+        self.assertTrue("Reloaded corejetdaemonsample.tests" in output,
+                        output)
+
+    def test_warm_layers(self):
+        for attempt in range(2):
+            failed, output = self.runClient('-t', 'test_warm', '-t',
+                                            'test_cold')
+            self.assertEqual(failed, False)
+
+            # Only the layer which is not warm is set up and torn down, in
+            # every run
+            self.assertTrue("Total: 2 tests, 0 failures" in output, output)
+            self.assertFalse("Set up corejetdaemonsample.tests.WarmLayer"
+                             in output, output)
+            self.assertFalse("Tear down corejetdaemonsample.tests.WarmLayer"
+                             in output, output)
+            self.assertTrue("Set up corejetdaemonsample.tests.ColdLayer"
+                            in output, output)
+            self.assertTrue("Tear down corejetdaemonsample.tests.ColdLayer"
+                            in output, output)
+
+    def test_bad_requests(self):
+        for request in ('', 'not json\n', '[]\n', '{}\n',):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socketPath)
+            sock.sendall(request)
+            sock.close()
+
+        failed, output = self.runClient('-t', 'test_ok')
+        self.assertEqual(failed, False)
+        self.assertTrue("Ran 1 tests with 0 failures" in output, output)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
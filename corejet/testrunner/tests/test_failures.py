@@ -0,0 +1,147 @@
+"""Tests of remembering which tests failed and running them again, see
+corejet.testrunner.failures.
+"""
+
+import os.path
+import sys
+import unittest
+
+from StringIO import StringIO
+
+from corejet.testrunner.failures import FailureHistory
+from corejet.testrunner.formatter import ExceptionInfo
+from corejet.testrunner.formatter import TestCaseInfo
+from corejet.testrunner.tests.utils import ConfiguredRunnerTestCase
+from corejet.testrunner.tests.utils import TemporaryDirectoryTestCase
+from corejet.testrunner.tests.utils import test_key
+from corejet.testrunner.tests.utils import test_names
+from corejet.testrunner.timings import TimingHistory
+
+
+class SampleTests(unittest.TestCase):
+    # Not collected: the names of the tests do not start with "test"
+
+    def quick(self):
+        pass
+
+    def slow(self):
+        pass
+
+    def medium(self):
+        pass
+
+    def new(self):
+        pass
+
+
+SAMPLE_NAMES = ['quick', 'slow', 'medium', 'new']
+
+
+def sample_layers():
+    return {'sample': unittest.TestSuite([SampleTests(name)
+                                          for name in SAMPLE_NAMES])}
+
+
+def outcome(name, failed=False):
+    """Return the suite name and TestCaseInfo of a sample test.
+    """
+
+    suite, classname, testName = test_key(SampleTests(name))
+    failure = None
+    if failed:
+        failure = ExceptionInfo('AssertionError', 'failed', '')
+    return suite, TestCaseInfo(0.1, classname, testName, failure=failure)
+
+
+class FailureHistoryTests(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(FailureHistoryTests, self).setUp()
+        self.filename = os.path.join(self.directory, 'failures.json')
+
+    def record(self, *outcomes):
+        history = FailureHistory(self.filename)
+        for name, failed in outcomes:
+            history.add(*outcome(name, failed))
+        history.save()
+        return FailureHistory(self.filename).previous
+
+    def test_no_failures(self):
+        self.assertEqual(self.record(('quick', False,)), set())
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_round_trip(self):
+        self.assertEqual(self.record(('quick', True,), ('slow', True,),
+                                     ('medium', False,)),
+                         set([test_key(SampleTests('quick')),
+                              test_key(SampleTests('slow'))]))
+
+        # Passing tests are forgotten, those which did not run are kept
+        self.assertEqual(self.record(('quick', False,)),
+                         set([test_key(SampleTests('slow'))]))
+
+    def test_fragments(self):
+        self.record(('quick', True,), ('slow', True,))
+
+        child = FailureHistory(self.filename)
+        child.add(*outcome('quick', False))
+        child.add(*outcome('medium', True))
+        child.writeFragment(self.directory, '000001')
+
+        parent = FailureHistory(self.filename)
+        parent.mergeFragments(self.directory)
+        parent.save()
+        self.assertEqual(FailureHistory(self.filename).previous,
+                         set([test_key(SampleTests('slow')),
+                              test_key(SampleTests('medium'))]))
+
+
+class LastFailedTests(ConfiguredRunnerTestCase):
+
+    def setUp(self):
+        super(LastFailedTests, self).setUp()
+        history = FailureHistory(os.path.join(self.directory,
+                                              'failures.json'))
+        history.add(*outcome('medium', True))
+        history.save()
+
+    def test_last_failed(self):
+        layers = self.selectTests(self.configure('--last-failed'),
+                                  sample_layers())
+        self.assertEqual(test_names(layers['sample']), ['medium'])
+
+    def test_failed_first(self):
+        layers = self.selectTests(self.configure('--failed-first'),
+                                  sample_layers())
+        self.assertEqual(test_names(layers['sample']),
+                         ['medium', 'quick', 'slow', 'new'])
+
+    def test_failed_first_with_timings(self):
+        # The tests which failed run first, the others longest first
+        timingsFile = os.path.join(self.directory, 'timings.db')
+        TimingHistory(timingsFile).record(
+            [test_key(SampleTests(name)) + (seconds,)
+             for name, seconds in (('quick', 0.1,), ('slow', 3.0,),
+                                   ('medium', 1.0,),)])
+
+        layers = self.selectTests(
+            self.configure('--failed-first', '--timings', '--timings-file',
+                           timingsFile),
+            sample_layers())
+        self.assertEqual(test_names(layers['sample']),
+                         ['medium', 'slow', 'quick', 'new'])
+
+    def test_without_failures_file(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            runner = self.configure('--last-failed', '--failures-file=')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(runner.options.fail)
+        self.assertTrue("need a --failures-file" in output, output)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,105 @@
+"""Tests of selecting the tests affected by a change, see
+corejet.testrunner.impact.
+"""
+
+from __future__ import with_statement
+
+import os.path
+import unittest
+
+from corejet.testrunner.formatter import TestParser
+from corejet.testrunner.impact import ImpactMap
+from corejet.testrunner.impact import ImpactSelection
+from corejet.testrunner.impact import read_changed_files
+from corejet.testrunner.tests.utils import FakeRunner
+from corejet.testrunner.tests.utils import TemporaryDirectoryTestCase
+from corejet.testrunner.tests.utils import test_names
+
+
+class SampleTests(unittest.TestCase):
+    # Not collected: the names of the tests do not start with "test"
+
+    def views(self):
+        pass
+
+    def models(self):
+        pass
+
+    def new(self):
+        pass
+
+
+def sample_layers():
+    return {'sample': unittest.TestSuite([
+        SampleTests('views'),
+        SampleTests('models'),
+        SampleTests('new'),
+    ])}
+
+
+class ImpactSelectionTests(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(ImpactSelectionTests, self).setUp()
+        self.impactMap = ImpactMap(os.path.join(self.directory,
+                                                'impact.json'))
+
+        # new is not in the map yet
+        parseTest = TestParser()
+        tests = {}
+        for name, paths in (('views', ('src/views.py',),),
+                            ('models', ('src/models.py',),),):
+            testSuite, testName, testClassName = parseTest(SampleTests(name))
+            tests[(testSuite, testClassName, testName,)] = paths
+        self.impactMap.update(tests)
+        self.impactMap.save()
+        self.impactMap = ImpactMap(self.impactMap.filename)
+
+    def select(self, changed, runner=None):
+        if runner is None:
+            runner = FakeRunner(layers=sample_layers(),
+                                fragmentsDirectory=self.directory)
+        ImpactSelection(runner, self.impactMap, changed).global_setup()
+        return runner
+
+    def test_changed_file(self):
+        runner = self.select(['src/models.py'])
+        self.assertEqual(test_names(runner.tests_by_layer_name['sample']),
+                         ['models', 'new'])
+
+    def test_no_changed_files(self):
+        runner = self.select([])
+        self.assertEqual(test_names(runner.tests_by_layer_name['sample']),
+                         ['new'])
+        self.assertEqual(runner.options.output.messages,
+                         ["Running 1 of 3 tests, affected by 0 changed "
+                          "files"])
+
+    def test_empty_changed_files(self):
+        filename = os.path.join(self.directory, 'changed.txt')
+        open(filename, 'wb').close()
+        runner = self.select(read_changed_files(filename))
+        self.assertEqual(test_names(runner.tests_by_layer_name['sample']),
+                         ['new'])
+
+    def test_subprocess(self):
+        # The parent passes on the changed files, even if there are none
+        self.select([])
+
+        runner = FakeRunner(layers=sample_layers(),
+                            fragmentsDirectory=self.directory)
+        runner.options.resume_layer = 'sample'
+        self.select(None, runner)
+        self.assertEqual(test_names(runner.tests_by_layer_name['sample']),
+                         ['new'])
+
+    def test_without_impact_map(self):
+        self.impactMap = ImpactMap(os.path.join(self.directory,
+                                                'missing.json'))
+        runner = self.select([])
+        self.assertEqual(test_names(runner.tests_by_layer_name['sample']),
+                         ['views', 'models', 'new'])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
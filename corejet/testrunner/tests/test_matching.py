@@ -0,0 +1,224 @@
+"""Tests of matching test results against a CoreJet catalogue, see
+corejet.testrunner.matching.
+"""
+
+import unittest
+
+from corejet.core.model import Epic
+from corejet.core.model import RequirementsCatalogue
+from corejet.core.model import Scenario
+from corejet.core.model import Step
+from corejet.core.model import Story
+
+from corejet.testrunner.formatter import ExceptionInfo
+from corejet.testrunner.formatter import TestCaseInfo
+from corejet.testrunner.formatter import TestedScenario
+from corejet.testrunner.matching import SUPERFLUOUS_EPIC
+from corejet.testrunner.matching import add_superfluous_scenarios
+from corejet.testrunner.matching import match_catalogue
+
+FAILURE = ExceptionInfo('AssertionError', 'failed', '')
+
+
+def baseline_statuses(catalogue, testCases):
+    """Allocate the statuses the way the formatter did before matching was
+    indexed, for comparison. Returns a dict mapping ``(story name, scenario
+    name)`` to status, and leaves ``catalogue`` alone.
+    """
+
+    testedStories = {}
+    for caseInfo in testCases:
+        testedScenario = caseInfo.scenario
+        if testedScenario is None:
+            continue
+        scenarios = testedStories.setdefault(
+            testedScenario.storyName.strip().lower(), {})
+        scenarios[testedScenario.scenarioName.strip().lower()] = (
+            testedScenario, caseInfo,)
+
+    statuses = {}
+    for epic in catalogue.epics:
+        for story in epic.stories:
+            testedStory = testedStories.get(story.name.strip().lower(), {})
+            for scenario in story.scenarios:
+                status = "pending"
+                testedScenario, info = testedStory.get(
+                    scenario.name.strip().lower(), (None, None,))
+                if info is not None:
+                    if info.failure or info.error:
+                        status = "fail"
+                    else:
+                        status = "pass"
+
+                    for expected, actual in (
+                        (story.givens + scenario.givens,
+                         testedScenario.givens,),
+                        (story.whens + scenario.whens,
+                         testedScenario.whens,),
+                        (story.thens + scenario.thens,
+                         testedScenario.thens,),):
+                        if len(expected) != len(actual):
+                            status = "mismatch"
+                            break
+                        for left, right in zip(expected, actual):
+                            if (left.text.strip().lower() !=
+                                    right.strip().lower()):
+                                status = "mismatch"
+                                break
+                        if status == "mismatch":
+                            break
+
+                statuses[(story.name, scenario.name,)] = status
+    return statuses
+
+
+def make_catalogue():
+    catalogue = RequirementsCatalogue(project="Sample")
+    epic = Epic("E1", "Epic")
+    catalogue.epics.append(epic)
+
+    login = Story("S1", "Logging in", epic=epic,
+                  givens=[Step("A registered user", 'given')])
+    epic.stories.append(login)
+    for name in ("Good password", "Bad password", "Wrong steps",
+                 "Not tested", "Failing and wrong"):
+        login.scenarios.append(Scenario(
+            name, story=login,
+            givens=[Step("The login form", 'given')],
+            whens=[Step("I log in", 'when')],
+            thens=[Step("I see my name", 'then')]))
+
+    search = Story("S2", "Searching", epic=epic)
+    epic.stories.append(search)
+    search.scenarios.append(Scenario(
+        "Simple search", story=search,
+        whens=[Step("I search", 'when')],
+        thens=[Step("I see results", 'then')]))
+
+    return catalogue
+
+
+def tested(storyName, scenarioName, givens=("a registered user",
+                                            "the login form",),
+           whens=("I log in",), thens=("I see my name",), failure=None):
+    return TestCaseInfo(0.0, 'sample.Tests', 'test_%s' % scenarioName,
+                        failure=failure,
+                        scenario=TestedScenario(storyName, scenarioName,
+                                                givens, whens, thens))
+
+
+def make_test_cases():
+    return [
+        # Names and steps differ in case and surrounding whitespace only
+        tested(" s1 ", "GOOD PASSWORD ",
+               givens=(" A Registered User", "THE LOGIN FORM  ",),
+               whens=("i log in",)),
+        tested("S1", "Bad password", failure=FAILURE),
+        # The story level step is missing
+        tested("S1", "Wrong steps", givens=("The login form",)),
+        tested("S1", "Failing and wrong", thens=("I see an error",),
+               failure=FAILURE),
+        TestCaseInfo(0.0, 'sample.Tests', 'test_not_a_scenario'),
+        # Not in the catalogue
+        tested("S1", "Forgotten password"),
+        tested("S3", "Logging out", givens=(), whens=("I log out",),
+               thens=("I am logged out",)),
+        # Only the last result of a scenario counts
+        tested("S2", "Simple search", givens=(), whens=("I search",),
+               thens=("I see results",), failure=FAILURE),
+        tested("S2", "simple search", givens=(), whens=("I search",),
+               thens=("I see results",)),
+    ]
+
+
+def statuses(catalogue):
+    return dict([((story.name, scenario.name,), scenario.status,)
+                 for epic in catalogue.epics
+                 for story in epic.stories
+                 for scenario in story.scenarios])
+
+
+class MatchCatalogueTests(unittest.TestCase):
+
+    def test_statuses(self):
+        catalogue = make_catalogue()
+        match_catalogue(catalogue, make_test_cases())
+        self.assertEqual(statuses(catalogue), {
+            ("S1", "Good password",): "pass",
+            ("S1", "Bad password",): "fail",
+            ("S1", "Wrong steps",): "mismatch",
+            ("S1", "Not tested",): "pending",
+            ("S1", "Failing and wrong",): "mismatch",
+            ("S2", "Simple search",): "pass",
+        })
+
+    def test_baseline(self):
+        catalogue = make_catalogue()
+        testCases = make_test_cases()
+        expected = baseline_statuses(catalogue, testCases)
+        match_catalogue(catalogue, testCases)
+        self.assertEqual(statuses(catalogue), expected)
+
+    def test_baseline_step_variations(self):
+        # Every way of changing one step of a scenario, compared with the
+        # baseline
+        steps = {'givens': ("a registered user", "the login form",),
+                 'whens': ("i log in",), 'thens': ("i see my name",)}
+        variations = []
+        for kind, texts in sorted(steps.items()):
+            variations.append((kind, texts[:-1],))
+            variations.append((kind, texts + ("one more",),))
+            variations.append((kind, texts[:-1] + ("something else",),))
+            variations.append((kind, tuple([" %s " % text.upper()
+                                            for text in texts]),))
+
+        for kind, texts in variations:
+            for failure in (None, FAILURE,):
+                arguments = dict(steps)
+                arguments[kind] = texts
+                testCases = [tested("S1", "Good password", failure=failure,
+                                    **arguments)]
+                catalogue = make_catalogue()
+                expected = baseline_statuses(catalogue, testCases)
+                match_catalogue(catalogue, testCases)
+                self.assertEqual(statuses(catalogue), expected,
+                                 (kind, texts, failure,))
+
+    def test_superfluous(self):
+        catalogue = make_catalogue()
+        superfluous = match_catalogue(catalogue, make_test_cases())
+        self.assertEqual(
+            dict([(storyKey, sorted(scenarios),)
+                  for storyKey, scenarios in superfluous.items()]),
+            {'s1': ['forgotten password'], 's3': ['logging out']})
+
+    def test_add_superfluous_scenarios(self):
+        catalogue = make_catalogue()
+        superfluous = match_catalogue(catalogue, make_test_cases())
+        self.assertEqual(add_superfluous_scenarios(catalogue, superfluous), 2)
+
+        # Scenarios of known stories go to the story, others to an extra epic
+        login = catalogue.epics[0].stories[0]
+        added = login.scenarios[-1]
+        self.assertEqual(added.name, "Forgotten password")
+        self.assertEqual(added.status, "superfluous")
+        self.assertEqual([step.text for step in added.givens],
+                         ["a registered user", "the login form"])
+
+        extraEpic = catalogue.epics[-1]
+        self.assertEqual((extraEpic.name, extraEpic.title,), SUPERFLUOUS_EPIC)
+        self.assertEqual([story.name for story in extraEpic.stories], ["S3"])
+        self.assertEqual([(scenario.name, scenario.status,)
+                          for scenario in extraEpic.stories[0].scenarios],
+                         [("Logging out", "superfluous",)])
+
+    def test_nothing_superfluous(self):
+        catalogue = make_catalogue()
+        superfluous = match_catalogue(catalogue, make_test_cases()[:4])
+        self.assertEqual(superfluous, {})
+        self.assertEqual(add_superfluous_scenarios(catalogue, superfluous), 0)
+        self.assertEqual(len(catalogue.epics), 1)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
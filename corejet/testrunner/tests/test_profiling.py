@@ -0,0 +1,95 @@
+"""Tests of profiling each test, see corejet.testrunner.profiling.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import sys
+import unittest
+
+from StringIO import StringIO
+
+from corejet.testrunner.profiling import MARKER
+from corejet.testrunner.profiling import TestProfiling
+from corejet.testrunner.tests.utils import ConfiguredRunnerTestCase
+from corejet.testrunner.tests.utils import FakeRunner
+
+
+class ProfilesDirectoryTests(ConfiguredRunnerTestCase):
+
+    def setUp(self):
+        super(ProfilesDirectoryTests, self).setUp()
+        self.profilesDir = os.path.join(self.directory, 'profiles')
+
+        # The profiles are written to the working directory
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        super(ProfilesDirectoryTests, self).tearDown()
+
+    def writeFile(self, filename):
+        with open(filename, 'w') as stream:
+            stream.write("keep me")
+
+    def writeProfiles(self):
+        runner = FakeRunner(['--profile-tests'])
+        TestProfiling(runner, self.profilesDir).report()
+        return runner.options.output
+
+    def configureProfiling(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            runner = self.configure('--profile-tests')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return runner, output
+
+    def test_replace_own_profiles(self):
+        self.writeProfiles()
+        self.assertTrue(os.path.isfile(os.path.join(self.profilesDir,
+                                                    MARKER)))
+        self.writeFile(os.path.join(self.profilesDir, 'suites', 'old.pstats'))
+
+        runner, output = self.configureProfiling()
+        self.assertFalse(runner.options.fail, output)
+
+        output = self.writeProfiles()
+        self.assertEqual(output.errors, [])
+        self.assertEqual(os.listdir(os.path.join(self.profilesDir,
+                                                 'suites')), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.profilesDir,
+                                                    'hotspots.txt')))
+
+    def test_empty_directory(self):
+        os.mkdir(self.profilesDir)
+        runner, output = self.configureProfiling()
+        self.assertFalse(runner.options.fail, output)
+        self.assertEqual(self.writeProfiles().errors, [])
+
+    def test_refuse_other_directory(self):
+        os.mkdir(self.profilesDir)
+        self.writeFile(os.path.join(self.profilesDir, 'notes.txt'))
+
+        runner, output = self.configureProfiling()
+        self.assertTrue(runner.options.fail)
+        self.assertTrue("was not written by --profile-tests" in output,
+                        output)
+
+        # Nor are the profiles written, e.g. if it was created during the run
+        output = self.writeProfiles()
+        self.assertEqual(len(output.errors), 1)
+        self.assertEqual(os.listdir(self.profilesDir), ['notes.txt'])
+
+    def test_refuse_file(self):
+        self.writeFile(self.profilesDir)
+        runner, output = self.configureProfiling()
+        self.assertTrue(runner.options.fail)
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,249 @@
+"""Tests of splitting the tests across several test runs and of merging their
+reports, see corejet.testrunner.sharding and corejet.testrunner.merge.
+"""
+
+import os
+import os.path
+import random
+import sys
+import unittest
+
+from StringIO import StringIO
+
+from lxml import etree
+
+from corejet.testrunner.consolidated import write_consolidated_report
+from corejet.testrunner.formatter import TestSuiteInfo
+from corejet.testrunner.merge import merge_junit_reports
+from corejet.testrunner.sharding import partition
+from corejet.testrunner.sharding import read_junit_timings
+from corejet.testrunner.sharding import read_timings
+from corejet.testrunner.tests.utils import ConfiguredRunnerTestCase
+from corejet.testrunner.tests.utils import FakeRunner
+from corejet.testrunner.tests.utils import TemporaryDirectoryTestCase
+from corejet.testrunner.tests.utils import test_key
+from corejet.testrunner.tests.utils import test_names
+
+
+class SampleTests(unittest.TestCase):
+    # Not collected: the names of the tests do not start with "test"
+
+    def quick(self):
+        pass
+
+    def slow(self):
+        pass
+
+    def medium(self):
+        pass
+
+    def new(self):
+        pass
+
+
+SAMPLE_NAMES = ['quick', 'slow', 'medium', 'new']
+
+SAMPLE_TIMES = {'quick': 0.1, 'slow': 3.0, 'medium': 1.0}
+
+
+def sample_layers():
+    return {'sample': unittest.TestSuite([SampleTests(name)
+                                          for name in SAMPLE_NAMES])}
+
+
+class FakeTest(object):
+
+    def __init__(self, name, seconds):
+        self.name = name
+        self.seconds = seconds
+
+    def id(self):
+        return self.name
+
+
+def testsuite_xml(name, cases):
+    """Return a ``<testsuite />`` element with a test case for each
+    ``(classname, name, seconds)`` in ``cases``, as a string.
+    """
+
+    testSuiteNode = etree.Element('testsuite', name=name,
+                                  tests=str(len(cases)), errors='0',
+                                  failures='0', time='0.0')
+    for classname, testName, seconds in cases:
+        etree.SubElement(testSuiteNode, 'testcase', classname=classname,
+                         name=testName, time=str(seconds))
+    return etree.tostring(testSuiteNode)
+
+
+class PartitionTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.tests = [FakeTest('test_%03d' % index,
+                               round(rng.uniform(0.01, 2.0), 2))
+                      for index in range(100)]
+
+    def ids(self, partitions):
+        return [[test.id() for test in tests] for tests in partitions]
+
+    def test_every_test_once(self):
+        partitions = partition(self.tests, 4, lambda test: test.seconds)
+        ids = sorted([testId for tests in self.ids(partitions)
+                             for testId in tests])
+        self.assertEqual(ids, sorted([test.id() for test in self.tests]))
+
+    def test_stable(self):
+        # Every shard finds the tests in its own order, but must agree
+        expected = self.ids(partition(self.tests, 4,
+                                      lambda test: test.seconds))
+        rng = random.Random(1)
+        for attempt in range(5):
+            tests = list(self.tests)
+            rng.shuffle(tests)
+            self.assertEqual(
+                self.ids(partition(tests, 4, lambda test: test.seconds)),
+                expected)
+
+    def test_balanced(self):
+        partitions = partition(self.tests, 4, lambda test: test.seconds)
+        loads = [sum([test.seconds for test in tests])
+                 for tests in partitions]
+
+        # Longest first onto the lightest partition leaves no partition
+        # more than the longest test behind
+        longest = max([test.seconds for test in self.tests])
+        self.assertTrue(max(loads) - min(loads) <= longest, loads)
+
+    def test_equal_durations(self):
+        tests = [FakeTest('test_%d' % index, 1.0) for index in range(7)]
+        partitions = partition(tests, 3, lambda test: test.seconds)
+        self.assertEqual(sorted([len(tests) for tests in partitions]),
+                         [2, 2, 3])
+
+
+class JUnitTimingsTests(TemporaryDirectoryTestCase):
+
+    def writeReports(self):
+        reportsDir = os.path.join(self.directory, 'testreports')
+        os.mkdir(reportsDir)
+        with open(os.path.join(reportsDir, 'one.xml'), 'w') as report:
+            report.write(testsuite_xml('one', [('Tests', 'test_a', 1.5),
+                                               ('Tests', 'test_b', 0.5)]))
+        with open(os.path.join(reportsDir, 'broken.xml'), 'w') as report:
+            report.write('<testsuite><testcase classname="Tests" name="c" '
+                         'time="2.0"/><testcase')
+        return reportsDir
+
+    def test_directory(self):
+        self.assertEqual(read_junit_timings(self.writeReports()), {
+            ('Tests', 'test_a',): 1.5,
+            ('Tests', 'test_b',): 0.5,
+            ('Tests', 'c',): 2.0,
+        })
+
+    def test_unreadable(self):
+        reportsDir = self.writeReports()
+
+        # Opening a directory fails like an unreadable file
+        os.mkdir(os.path.join(reportsDir, 'directory.xml'))
+        self.assertEqual(len(read_junit_timings(reportsDir)), 3)
+
+        self.assertEqual(read_junit_timings(
+            os.path.join(self.directory, 'missing.xml')), {})
+
+    def test_consolidated(self):
+        filename = os.path.join(self.directory, 'testreports.xml.gz')
+        suites = [('one', TestSuiteInfo(),), ('two', TestSuiteInfo(),)]
+        cases = {'one': [('Tests', 'test_a', 1.5)],
+                 'two': [('Other', 'test_a', 0.25)]}
+        write_consolidated_report(
+            filename, suites, lambda item: testsuite_xml(item[0],
+                                                         cases[item[0]]))
+        self.assertEqual(read_junit_timings(filename), {
+            ('Tests', 'test_a',): 1.5,
+            ('Other', 'test_a',): 0.25,
+        })
+
+
+class ShardTests(ConfiguredRunnerTestCase):
+
+    def writeTimings(self):
+        reportsDir = os.path.join(self.directory, 'testreports')
+        os.mkdir(reportsDir)
+        cases = []
+        for name, seconds in SAMPLE_TIMES.items():
+            testSuite, classname, testName = test_key(SampleTests(name))
+            cases.append((classname, testName, seconds,))
+        with open(os.path.join(reportsDir, 'sample.xml'), 'w') as report:
+            report.write(testsuite_xml('sample', cases))
+        return reportsDir
+
+    def test_shards(self):
+        reportsDir = self.writeTimings()
+
+        shards = []
+        for index in (1, 2,):
+            layers = self.selectTests(
+                self.configure('--shard', '%d/2' % index,
+                               '--shard-timings', reportsDir),
+                sample_layers())
+            shards.append(test_names(layers['sample']))
+
+        # The slowest test on its own, everything else on the other shard
+        self.assertEqual(shards, [['slow'], ['quick', 'medium', 'new']])
+
+    def test_missing_timings(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            runner = self.configure(
+                '--shard', '1/2', '--shard-timings',
+                os.path.join(self.directory, 'missing'))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(runner.options.fail)
+        self.assertTrue("no such file or directory" in output, output)
+
+    def test_unreadable_timing_history(self):
+        filename = os.path.join(self.directory, 'timings.db')
+        with open(filename, 'w') as history:
+            history.write('not a database ' * 100)
+
+        # The tests are dealt out by id instead
+        runner = FakeRunner(['--shard', '1/2', '--shard-timings', filename])
+        self.assertEqual(read_timings(runner.options), None)
+
+
+class MergeTests(TemporaryDirectoryTestCase):
+
+    def test_merge_consolidated(self):
+        # One run wrote a testreports directory, the other --xml-file
+        reportsDir = os.path.join(self.directory, 'testreports')
+        os.mkdir(reportsDir)
+        with open(os.path.join(reportsDir, 'one.xml'), 'w') as report:
+            report.write(testsuite_xml('one', [('Tests', 'test_a', 1.0)]))
+
+        filename = os.path.join(self.directory, 'all.xml.gz')
+        cases = {'one': [('Tests', 'test_b', 2.0)],
+                 'two': [('Other', 'test_c', 3.0)]}
+        write_consolidated_report(
+            filename,
+            [('one', TestSuiteInfo(),), ('two', TestSuiteInfo(),)],
+            lambda item: testsuite_xml(item[0], cases[item[0]]))
+
+        outputDir = os.path.join(self.directory, 'merged')
+        self.assertEqual(merge_junit_reports([reportsDir, filename],
+                                             outputDir), 2)
+        self.assertEqual(sorted(os.listdir(outputDir)),
+                         ['one.xml', 'two.xml'])
+
+        one = etree.parse(os.path.join(outputDir, 'one.xml')).getroot()
+        self.assertEqual(one.get('tests'), '2')
+        self.assertEqual(one.get('time'), '0.0')
+        self.assertEqual([node.get('name') for node in one.iter('testcase')],
+                         ['test_a', 'test_b'])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,166 @@
+"""Tests of writing the JUnit reports as the tests run, see
+corejet.testrunner.stream.
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import sys
+import unittest
+
+from lxml import etree
+
+from corejet.testrunner.formatter import TestSuiteInfo
+from corejet.testrunner.runner import run_internal
+from corejet.testrunner.stream import StreamingXMLReportWriter
+from corejet.testrunner.tests.utils import TemporaryDirectoryTestCase
+
+SAMPLE_TESTS = """\
+import unittest
+
+class SampleTests(unittest.TestCase):
+
+    def test_a_pass(self):
+        pass
+
+    def test_b_fail(self):
+        self.fail("failed on purpose")
+
+    def test_c_interrupt(self):
+        raise KeyboardInterrupt()
+
+    def test_d_never_run(self):
+        pass
+"""
+
+
+def test_case_node(name, seconds):
+    return etree.Element('testcase', classname='sample.Tests', name=name,
+                         time=str(seconds))
+
+
+class StreamingXMLReportWriterTests(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(StreamingXMLReportWriterTests, self).setUp()
+        self.reportsDir = os.path.join(self.directory, 'testreports')
+        self.writer = StreamingXMLReportWriter(
+            self.reportsDir, timestamp='2011-01-01T00:00:00',
+            hostname='localhost')
+        self.suite = TestSuiteInfo()
+
+    def addTest(self, name, seconds):
+        self.suite.tests += 1
+        self.suite.time += seconds
+        self.writer.write('sample', self.suite,
+                          test_case_node(name, seconds))
+
+    def readReport(self):
+        with open(self.writer.reportFilename('sample'), 'rb') as stream:
+            return stream.read()
+
+    def test_well_formed_while_running(self):
+        self.addTest('test_one', 0.5)
+        self.addTest('test_two', 0.25)
+
+        # As if the run had been killed now
+        testSuiteNode = etree.fromstring(self.readReport())
+        self.assertEqual(testSuiteNode.get('tests'), '2')
+        self.assertEqual(testSuiteNode.get('time'), '0.75')
+        self.assertEqual([node.get('name') for node in
+                          testSuiteNode.iterchildren(tag='testcase')],
+                         ['test_one', 'test_two'])
+
+    def test_close(self):
+        self.addTest('test_one', 0.5)
+        self.writer.close({'seed': '42'})
+
+        # The space reserved for the totals is trimmed
+        report = self.readReport()
+        header = report.splitlines()[0]
+        self.assertFalse('  ' in header, header)
+        self.assertTrue(header.endswith('time="0.5">'), header)
+
+        testSuiteNode = etree.fromstring(report)
+        self.assertEqual(testSuiteNode.get('tests'), '1')
+        self.assertEqual([(node.get('name'), node.get('value'),) for node in
+                          testSuiteNode.find('properties')],
+                         [('seed', '42',)])
+
+        # Closing again does not trim or add anything
+        self.writer.close({'seed': '42'})
+        self.assertEqual(self.readReport(), report)
+
+
+class InterruptedRunTests(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(InterruptedRunTests, self).setUp()
+        package = os.path.join(self.directory, 'corejetstreamsample')
+        os.mkdir(package)
+        with open(os.path.join(package, '__init__.py'), 'wb') as stream:
+            stream.write('')
+        with open(os.path.join(package, 'tests.py'), 'wb') as stream:
+            stream.write(SAMPLE_TESTS)
+
+    def runInterrupted(self, *args):
+        """Run the sample tests in a child process, which is interrupted by
+        the third test. Returns the exit status of the child: 0 if the run
+        was interrupted, as expected.
+        """
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 1)
+                os.dup2(devnull, 2)
+                os.chdir(self.directory)
+                try:
+                    run_internal(args=['test', '--path', self.directory,
+                                       '-s', 'corejetstreamsample'] +
+                                 list(args))
+                except KeyboardInterrupt:
+                    status = 0
+            finally:
+                os._exit(status)
+
+        return os.waitpid(pid, 0)[1]
+
+    def assertPartialReport(self, testSuiteNode):
+        self.assertEqual(testSuiteNode.get('tests'), '2')
+        self.assertEqual(testSuiteNode.get('failures'), '1')
+        self.assertEqual([node.get('name') for node in
+                          testSuiteNode.iterchildren(tag='testcase')],
+                         ['test_a_pass', 'test_b_fail'])
+
+    def test_xml_stream(self):
+        self.assertEqual(self.runInterrupted('--xml-stream'), 0)
+
+        filenames = os.listdir(os.path.join(self.directory, 'testreports'))
+        self.assertEqual(len(filenames), 1)
+        self.assertPartialReport(etree.parse(
+            os.path.join(self.directory, 'testreports', filenames[0])
+            ).getroot())
+
+    def test_xml_file(self):
+        filename = os.path.join(self.directory, 'reports', 'all.xml.gz')
+        self.assertEqual(self.runInterrupted('--xml-stream',
+                                             '--xml-file', filename), 0)
+
+        # The suites streamed so far end up in the report, and the directory
+        # they were streamed to is gone
+        self.assertEqual(sorted(os.listdir(os.path.dirname(filename))),
+                         ['all.xml.gz', 'all.xml.gz.index.json'])
+        testSuitesNode = etree.parse(filename).getroot()
+        self.assertEqual(testSuitesNode.tag, 'testsuites')
+        self.assertEqual(testSuitesNode.get('tests'), '2')
+        self.assertPartialReport(testSuitesNode.find('testsuite'))
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
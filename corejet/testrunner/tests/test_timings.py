@@ -0,0 +1,140 @@
+"""Tests of the timing history and of running the longest tests first, see
+corejet.testrunner.timings.
+"""
+
+import os.path
+import unittest
+
+import zope.testrunner.filter
+import zope.testrunner.shuffle
+
+from corejet.testrunner.tests.utils import ConfiguredRunnerTestCase
+from corejet.testrunner.tests.utils import TemporaryDirectoryTestCase
+from corejet.testrunner.tests.utils import test_key
+from corejet.testrunner.tests.utils import test_names
+from corejet.testrunner.timings import LongestFirst
+from corejet.testrunner.timings import TimingHistory
+from corejet.testrunner.timings import find_regressions
+
+
+class SampleTests(unittest.TestCase):
+    # Not collected: the names of the tests do not start with "test"
+
+    def quick(self):
+        pass
+
+    def slow(self):
+        pass
+
+    def medium(self):
+        pass
+
+    def new(self):
+        pass
+
+
+SAMPLE_NAMES = ['quick', 'slow', 'medium', 'new']
+
+SAMPLE_TIMES = {'quick': 0.1, 'slow': 3.0, 'medium': 1.0}
+
+
+def sample_layers():
+    return {'sample': unittest.TestSuite([SampleTests(name)
+                                          for name in SAMPLE_NAMES])}
+
+
+class TimingHistoryTests(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(TimingHistoryTests, self).setUp()
+        self.history = TimingHistory(os.path.join(self.directory,
+                                                  'timings.db'), window=3)
+
+    def test_empty(self):
+        self.assertEqual(self.history.load(), {})
+        self.assertEqual(self.history.medians(), {})
+
+    def test_round_trip(self):
+        for seconds in (1.0, 5.0, 2.0,):
+            self.history.record([('suite', 'Tests', 'test_one', seconds,),
+                                 ('suite', 'Tests', 'test_two', None,)])
+
+        history = TimingHistory(self.history.filename)
+        self.assertEqual(history.load(), {
+            ('suite', 'Tests', 'test_one',): [1.0, 5.0, 2.0],
+            ('suite', 'Tests', 'test_two',): [0.0, 0.0, 0.0],
+        })
+        self.assertEqual(history.medians()[('suite', 'Tests', 'test_one',)],
+                         2.0)
+
+    def test_window(self):
+        for seconds in (1.0, 2.0, 3.0, 4.0,):
+            self.history.record([('suite', 'Tests', 'test_one', seconds,)])
+        self.assertEqual(self.history.load(),
+                         {('suite', 'Tests', 'test_one',): [2.0, 3.0, 4.0]})
+
+    def test_find_regressions(self):
+        history = {
+            ('suite', 'Tests', 'test_slower',): [1.0, 1.0, 1.2],
+            ('suite', 'Tests', 'test_same',): [1.0],
+            ('suite', 'Tests', 'test_tiny',): [0.001],
+        }
+        results = [
+            ('suite', 'Tests', 'test_slower', 3.0,),
+            ('suite', 'Tests', 'test_same', 1.1,),
+            ('suite', 'Tests', 'test_tiny', 0.01,),
+            ('suite', 'Tests', 'test_new', 5.0,),
+        ]
+        self.assertEqual(find_regressions(history, results, 2.0),
+                         [('suite', 'Tests', 'test_slower', 3.0, 1.0,)])
+
+
+class LongestFirstTests(ConfiguredRunnerTestCase):
+
+    def setUp(self):
+        super(LongestFirstTests, self).setUp()
+        self.timingsFile = os.path.join(self.directory, 'timings.db')
+        TimingHistory(self.timingsFile).record(
+            [test_key(SampleTests(name)) + (seconds,)
+             for name, seconds in SAMPLE_TIMES.items()])
+
+    def configureTimings(self, *args):
+        return self.configure('--timings', '--timings-file',
+                              self.timingsFile, *args)
+
+    def test_feature_order(self):
+        for args in ((), ('--shuffle',),):
+            features = [feature.__class__ for feature in
+                        self.configureTimings(*args).features]
+            self.assertTrue(features.index(LongestFirst) <
+                            features.index(zope.testrunner.filter.Filter))
+            if args:
+                self.assertTrue(
+                    features.index(zope.testrunner.shuffle.Shuffle) <
+                    features.index(LongestFirst))
+
+    def test_longest_first(self):
+        runner = self.configureTimings()
+        layers = self.selectTests(runner, sample_layers())
+
+        # Tests without timings keep their place after the others
+        self.assertEqual(test_names(layers['sample']),
+                         ['slow', 'medium', 'quick', 'new'])
+        self.assertEqual(runner.options.output.delegate.messages,
+                         ["Projected test time: 4.100 seconds (plus 1 tests "
+                          "without timings)"])
+
+    def test_shuffle(self):
+        # An explicit --shuffle wins over the timing based order
+        shuffled = self.selectTests(
+            self.configure('--shuffle', '--shuffle-seed', '42'),
+            sample_layers())
+        layers = self.selectTests(
+            self.configureTimings('--shuffle', '--shuffle-seed', '42'),
+            sample_layers())
+        self.assertEqual(test_names(layers['sample']),
+                         test_names(shuffled['sample']))
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,122 @@
+"""Helpers for testing features of the test runner without running one.
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import zope.testrunner.filter
+import zope.testrunner.find
+
+from zope.testrunner.options import get_options
+
+from corejet.testrunner.formatter import TestParser
+from corejet.testrunner.runner import CoreJetRunner
+from corejet.testrunner.runner import FRAGMENTS_VARIABLE
+
+
+class RecordingOutput(object):
+    """Collects the messages a feature reports, instead of printing them.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.errors = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+    def error(self, message):
+        self.errors.append(message)
+
+    def format_seconds(self, seconds):
+        return '%.3f seconds' % seconds
+
+
+class FakeRunner(object):
+    """Just enough of a test runner for features: the options parsed from
+    ``args``, the tests of each layer, and a fragments directory.
+    """
+
+    def __init__(self, args=(), layers=None, fragmentsDirectory=None):
+        self.options = get_options(['test'] + list(args), [])
+        self.options.output = RecordingOutput()
+        self.options.resume_layer = None
+        self.options.resume_number = 0
+        self.tests_by_layer_name = layers or {}
+        self.fragmentsDirectory = fragmentsDirectory
+        self.features = []
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    """Runs each test with a temporary directory, ``self.directory``.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='corejet-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+
+class ConfiguredRunnerTestCase(TemporaryDirectoryTestCase):
+    """Configures real test runners, with their files in ``self.directory``.
+    """
+
+    def setUp(self):
+        super(ConfiguredRunnerTestCase, self).setUp()
+        self.runners = []
+
+    def tearDown(self):
+        for runner in self.runners:
+            if runner.fragmentsDirectory:
+                shutil.rmtree(runner.fragmentsDirectory, True)
+        os.environ.pop(FRAGMENTS_VARIABLE, None)
+        super(ConfiguredRunnerTestCase, self).tearDown()
+
+    def configure(self, *args):
+        runner = CoreJetRunner([], ['test', '--test-path', self.directory,
+                                    '--failures-file',
+                                    os.path.join(self.directory,
+                                                 'failures.json')] +
+                               list(args))
+        self.runners.append(runner)
+        runner.configure()
+
+        # The output of the features, see RecordingOutput
+        runner.options.output.delegate = RecordingOutput()
+        return runner
+
+    def selectTests(self, runner, layers):
+        """Run the features which select and order the tests found, i.e.
+        those between finding and filtering them, on ``layers``.
+        """
+
+        features = runner.features
+        start = [index for index, feature in enumerate(features)
+                 if isinstance(feature, zope.testrunner.find.Find)][0]
+        end = [index for index, feature in enumerate(features)
+               if isinstance(feature, zope.testrunner.filter.Filter)][0]
+
+        runner.tests_by_layer_name = layers
+        for feature in features[start + 1:end + 1]:
+            feature.global_setup()
+        return layers
+
+
+def test_key(test):
+    """Return the ``(suite, classname, name)`` identifying ``test`` in the
+    timing and failure histories.
+    """
+
+    testSuite, testName, testClassName = TestParser()(test)
+    return testSuite, testClassName, testName
+
+
+def test_names(suite):
+    """Return the method names of the tests in ``suite``, in order.
+    """
+
+    return [test._testMethodName for test in suite]
@@ -0,0 +1,193 @@
+"""A local history of how long each test took, kept across test runs.
+
+The history is stored in an SQLite database, by default in the working
+directory of the test runner (i.e. the buildout `parts` directory). For each
+test, identified by its suite, class and test name, the durations of the last
+few runs are kept. These are used to run the longest tests in each layer
+first, to predict how long a run will take, and to flag tests that have become
+markedly slower.
+"""
+
+from __future__ import with_statement
+
+import os.path
+import sqlite3
+
+import zope.testrunner.feature
+
+from corejet.testrunner.formatter import TestParser
+
+# Number of durations kept per test
+WINDOW = 10
+
+# Tests that are slower than their median by less than this many seconds are
+# never reported as regressions, however large the factor
+MINIMUM_REGRESSION = 0.1
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class TimingHistory(object):
+    """The durations of recent runs of each test, stored in SQLite.
+    """
+
+    def __init__(self, filename, window=WINDOW):
+        self.filename = filename
+        self.window = window
+
+    def _connect(self):
+        connection = sqlite3.connect(self.filename)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS durations ("
+            "suite TEXT, classname TEXT, name TEXT, history TEXT, "
+            "PRIMARY KEY (suite, classname, name))")
+        return connection
+
+    def load(self):
+        """Return a dict mapping ``(suite, classname, name)`` to a list of
+        durations in seconds, oldest first.
+        """
+
+        if not os.path.exists(self.filename):
+            return {}
+
+        connection = self._connect()
+        try:
+            return dict([((suite, classname, name),
+                          [float(value) for value in history.split()],)
+                         for suite, classname, name, history
+                         in connection.execute("SELECT * FROM durations")])
+        finally:
+            connection.close()
+
+    def medians(self):
+        """Return a dict mapping ``(suite, classname, name)`` to the median
+        of the recorded durations.
+        """
+
+        return dict([(key, median(history),)
+                     for key, history in self.load().items()])
+
+    def record(self, results, history=None):
+        """Add the durations of a test run, given as an iterable of
+        ``(suite, classname, name, seconds)``. ``history`` may be passed in if
+        it has already been loaded.
+        """
+
+        if history is None:
+            history = self.load()
+
+        rows = []
+        for suite, classname, name, seconds in results:
+            durations = history.get((suite, classname, name), [])
+            durations = (durations + [seconds or 0.0])[-self.window:]
+            rows.append((suite, classname, name,
+                         ' '.join([repr(value) for value in durations]),))
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO durations VALUES (?, ?, ?, ?)",
+                    rows)
+        finally:
+            connection.close()
+
+
+def find_regressions(history, results, factor,
+                     minimum=MINIMUM_REGRESSION):
+    """Find tests which took more than ``factor`` times their median duration
+    in ``history``. Returns a list of ``(suite, classname, name, seconds,
+    median)``, worst first.
+    """
+
+    regressions = []
+    for suite, classname, name, seconds in results:
+        durations = history.get((suite, classname, name))
+        if not durations or not seconds:
+            continue
+        typical = median(durations)
+        if seconds > typical * factor and seconds - typical >= minimum:
+            regressions.append((suite, classname, name, seconds, typical,))
+
+    regressions.sort(key=lambda r: r[3] / (r[4] or 1e-6), reverse=True)
+    return regressions
+
+
+class LongestFirst(zope.testrunner.feature.Feature):
+    """Order the tests in each layer by their median duration in the timing
+    history, longest first, and report the projected duration of the run.
+
+    An explicit ``--shuffle`` wins over the timing based order: the tests are
+    then left in the order the Shuffle feature put them in.
+    """
+
+    def __init__(self, runner):
+        super(LongestFirst, self).__init__(runner)
+        self.active = bool(runner.options.timings)
+
+    def global_setup(self):
+        options = self.runner.options
+        medians = TimingHistory(options.timingsFile).medians()
+        parseTest = TestParser()
+
+        projected = 0.0
+        unknown = 0
+
+        for layerName, suite in list(self.runner.tests_by_layer_name.items()):
+            weighted = []
+            for index, test in enumerate(suite):
+                testSuite, testName, testClassName = parseTest(test)
+                seconds = medians.get((testSuite, testClassName, testName))
+                if seconds is None:
+                    unknown += 1
+                    seconds = 0.0
+                projected += seconds
+
+                # Stable: tests with the same duration keep their order
+                weighted.append((-seconds, index, test,))
+
+            if options.shuffle:
+                continue
+
+            weighted.sort(key=lambda item: item[:2])
+            self.runner.tests_by_layer_name[layerName] = suite.__class__(
+                [test for negativeSeconds, index, test in weighted])
+
+        if options.resume_layer is None and medians:
+            message = "Projected test time: %s" % (
+                options.output.format_seconds(projected),)
+            if unknown:
+                message += " (plus %d tests without timings)" % unknown
+            options.output.info(message)
+
+
+def update_timing_history(options):
+    """Add the results of the run that has just finished to the timing
+    history, reporting any tests that have become markedly slower.
+    """
+
+    output = options.output
+    history = TimingHistory(options.timingsFile)
+    previous = history.load()
+
+    results = [(suite, testCase.testClassName, testCase.testName,
+                testCase.time,)
+               for suite, testCase in output.iterTestCases()]
+
+    regressions = find_regressions(previous, results, options.timingRegression)
+    if regressions:
+        output.info("Tests taking more than %s times their median time:" % (
+            options.timingRegression,))
+        for suite, classname, name, seconds, typical in regressions:
+            output.info("  %s (%s): %s, median %s" % (
+                name, classname, output.format_seconds(seconds),
+                output.format_seconds(typical),))
+
+    history.record(results, previous)
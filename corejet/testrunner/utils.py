@@ -0,0 +1,65 @@
+"""Helpers shared by the report writers
+"""
+
+from __future__ import with_statement
+
+import contextlib
+import os
+import os.path
+import tempfile
+
+# mkstemp() creates files readable only by their owner; atomically written
+# files should get the same permissions as any other new file. The umask can
+# only be read by setting it, so do that once, before any threads exist.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def write_file_atomically(filename, data):
+    """Write ``data`` to ``filename`` so that readers only ever see either
+    the old or the complete new file, never a partially written one.
+    """
+
+    with atomic_file(filename) as outputFile:
+        outputFile.write(data)
+
+
+@contextlib.contextmanager
+def atomic_file(filename):
+    """Open a file to write the contents of ``filename`` to, a bit at a time.
+    The file replaces ``filename`` when the block ends, unless it raises an
+    exception.
+
+    The data is written to a temporary file in the same directory, which is
+    then renamed over the target.
+    """
+
+    directory, basename = os.path.split(filename)
+    fd, tempname = tempfile.mkstemp(dir=directory, prefix='.' + basename,
+                                    suffix='.tmp')
+    try:
+        os.chmod(tempname, 0666 & ~UMASK)
+        outputFile = os.fdopen(fd, 'wb')
+        try:
+            yield outputFile
+        finally:
+            outputFile.close()
+        rename(tempname, filename)
+    except:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+
+
+def rename(source, target):
+    """Rename ``source`` to ``target``, replacing ``target`` if it exists.
+    """
+
+    try:
+        os.rename(source, target)
+    except OSError:
+        # Windows will not rename over an existing file
+        if not os.path.exists(target):
+            raise
+        os.remove(target)
+        os.rename(source, target)
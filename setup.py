@@ -38,5 +38,8 @@ setup(name='corejet.testrunner',
 
       [corejet.repositorysource]
       file = corejet.testrunner.filesource:fileSource
+
+      [console_scripts]
+      corejet-merge = corejet.testrunner.merge:main
       """,
       )